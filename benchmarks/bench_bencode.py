@@ -0,0 +1,88 @@
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode  # noqa: E402
+from info import MetaInfo  # noqa: E402
+
+try:
+    import bencodepy
+except ImportError:
+    bencodepy = None
+
+
+def make_torrent(files, pieces):
+    info = {b'name': b'bench', b'piece length': 2 ** 18, b'pieces': os.urandom(20 * pieces),
+            b'files': [{b'length': 1000 + i, b'path': [b'dir%d' % (i % 100), b'file%d.bin' % i]}
+                       for i in range(files)]}
+    return {b'announce': b'http://tracker.example/announce', b'created by': b'bench', b'info': info}
+
+
+def timed(function, repeat):
+    # Best of repeat runs, and the peak memory of one more run
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def report(name, best, peak):
+    print(f"{name:<34} {best * 1000:10.2f} ms {peak / 2 ** 20:10.2f} MiB peak")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bencode decoding and encoding against bencodepy")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--pieces", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    meta = make_torrent(args.files, args.pieces)
+    data = bencode.encode(meta)
+    print(f"{len(data) / 2 ** 20:.2f} MiB torrent, {args.files} files, {args.pieces} pieces")
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, "bench.torrent")
+    with open(path, "wb") as f:
+        f.write(data)
+
+    # Startup is MetaInfo itself: read the file, hash info, index the pieces and list every file
+    def native_files():
+        return sum(file[b'length'] for file in bencode.decode(data)[b'info'][b'files'])
+
+    report("native MetaInfo startup", *timed(lambda: MetaInfo(path, directory.name), args.repeat))
+    report("native decode with lazy files", *timed(native_files, args.repeat))
+    report("native encode", *timed(lambda: bencode.encode(meta), args.repeat))
+
+    if bencodepy is None:
+        print("bencodepy is not installed, nothing to compare against")
+        directory.cleanup()
+        return
+
+    def bencodepy_startup():
+        # The same work as MetaInfo, on a fully decoded torrent
+        with open(path, "rb") as f:
+            meta = bencodepy.decode(f.read())
+        info = meta[b'info']
+        hashlib.sha1(bencodepy.encode(info)).digest()
+        files = [{"path": file[b'path'], "length": file[b'length'], "downloaded": 0} for file in info[b'files']]
+        return len(info[b'pieces']) // 20, sum(file["length"] for file in files)
+
+    report("bencodepy startup (full, re-encode)", *timed(bencodepy_startup, args.repeat))
+    report("bencodepy encode", *timed(lambda: bencodepy.encode(meta), args.repeat))
+    directory.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from dht import DHT  # noqa: E402
+
+
+async def start_nodes(count, bootstrap, directory):
+    nodes = []
+    for i in range(count):
+        node = DHT(0, os.path.join(directory, f"node{i}.dht"), bootstrap, host="127.0.0.1")
+        await node.start()
+        nodes.append(node)
+        if not bootstrap:
+            # Everyone after the first joins through it
+            bootstrap = (("127.0.0.1", node.port),)
+    await asyncio.gather(*(node.ready.wait() for node in nodes))
+    return nodes
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        nodes = await start_nodes(args.nodes, (), directory)
+        # A second round of bootstrapping, the first nodes joined a network that was still nearly empty
+        await asyncio.gather(*(node.lookup(node.node_id) for node in nodes))
+        sizes = [len(node.table) for node in nodes]
+        print(f"{args.nodes} nodes up in {time.perf_counter() - started:.2f} s, "
+              f"routing tables {min(sizes)}-{max(sizes)} nodes, median {statistics.median(sizes)}")
+
+        info_hashes = [os.urandom(20) for _ in range(args.torrents)]
+        # Each torrent announced by a few nodes, each with its own made up peer port
+        announced = {}
+        for t, info_hash in enumerate(info_hashes):
+            announced[info_hash] = set()
+            for s in range(args.seeders):
+                node = nodes[(t * args.seeders + s) % len(nodes)]
+                port = 10000 + t * args.seeders + s
+                await node.get_peers(info_hash, announce_port=port)
+                announced[info_hash].add(("127.0.0.1", port))
+
+        async def search(node):
+            # One lookup at a time per node, so that its query count is the lookup's own
+            results = []
+            for info_hash in info_hashes:
+                start = time.perf_counter()
+                sent = node.queries_sent
+                peers = await node.get_peers(info_hash)
+                results.append((time.perf_counter() - start, node.queries_sent - sent,
+                                set(peers) >= announced[info_hash]))
+            return results
+
+        searches = await asyncio.gather(*(search(node) for node in nodes[-args.searchers:]))
+        results = [result for node_results in searches for result in node_results]
+        times = sorted(result[0] for result in results)
+        found = sum(result[2] for result in results)
+        print(f"{len(results)} lookups: {found} found every announced peer, "
+              f"median {statistics.median(times) * 1000:.1f} ms, max {times[-1] * 1000:.1f} ms, "
+              f"{statistics.mean(result[1] for result in results):.1f} queries each")
+
+        # A node restarted from its saved state finds the network again without any bootstrap node
+        restarted = nodes.pop()
+        restarted.close()
+        node = DHT(0, restarted.state_file, (), host="127.0.0.1")
+        await node.start()
+        await node.ready.wait()
+        peers = await node.get_peers(info_hashes[0])
+        same_id = node.node_id == restarted.node_id
+        print(f"restarted from saved state: same id {same_id}, {len(node.table)} nodes, "
+              f"found {len(set(peers) & announced[info_hashes[0]])}/{len(announced[info_hashes[0]])} peers")
+        node.close()
+        for node in nodes:
+            node.close()
+        ok = found == len(results) and same_id and set(peers) >= announced[info_hashes[0]]
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A DHT of many nodes on loopback, announcing and looking up peers")
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--torrents", type=int, default=5)
+    parser.add_argument("--seeders", type=int, default=3, help="Nodes announcing each torrent")
+    parser.add_argument("--searchers", type=int, default=10, help="Nodes looking each torrent up")
+    args = parser.parse_args()
+    if not asyncio.run(run(args)):
+        sys.exit("Some lookups did not find every announced peer")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode  # noqa: E402
+from bitfield import Bitfield  # noqa: E402
+from block_handler import BlockHandler  # noqa: E402
+from info import MetaInfo  # noqa: E402
+from message import Block, Have, MessageReader, Request, decode  # noqa: E402
+from picker import PiecePicker  # noqa: E402
+from piece import BLOCK_SIZE, BufferPool, Piece  # noqa: E402
+from torrent import Torrent  # noqa: E402
+from utils import FileIndex  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+SEED = 1
+# Slower than the baseline by more than this counts as a regression. Baselines only mean anything on the machine
+# that saved them, rerun with --save after moving.
+THRESHOLD = 1.5
+
+# name -> (generator function, keyword arguments). Each generator builds its inputs, yields the timed callable
+# and the number of operations it performs, and cleans up when resumed.
+BENCHMARKS = {}
+
+
+def benchmark(name, **params):
+    def register(function):
+        BENCHMARKS[name] = (function, params)
+        return function
+    return register
+
+
+def synthetic_torrent(directory, num_pieces, piece_length=2 ** 18, files=1, rnd=None):
+    rnd = rnd or random.Random(SEED)
+    length = num_pieces * piece_length
+    info = {b'name': b'micro', b'piece length': piece_length, b'pieces': rnd.randbytes(20 * num_pieces)}
+    if files > 1:
+        size = length // files
+        info[b'files'] = [{b'length': size + (length - size * files if i == files - 1 else 0),
+                           b'path': [b'd%d' % (i % 100), b'f%d' % i]} for i in range(files)]
+    else:
+        info[b'length'] = length
+    path = os.path.join(directory, "micro.torrent")
+    with open(path, "wb") as f:
+        f.write(bencode.encode({b'announce': b'http://127.0.0.1:1/announce', b'info': info}))
+    return path
+
+
+def frames(rnd, count):
+    # What a downloading peer mostly reads: blocks, with haves and the odd request in between
+    block = rnd.randbytes(BLOCK_SIZE)
+    out = []
+    for i in range(count):
+        kind = rnd.random()
+        if kind < 0.8:
+            message = Block(i % 1000, (i % 16) * BLOCK_SIZE, block)
+        elif kind < 0.95:
+            message = Have(rnd.randrange(10000))
+        else:
+            message = Request(rnd.randrange(10000), 0, BLOCK_SIZE)
+        out.append(message.encode())
+    return out
+
+
+@benchmark("message.decode")
+def bench_decode(count=20000):
+    encoded = [frame[4:] for frame in frames(random.Random(SEED), count)]
+    yield lambda: [decode(frame) for frame in encoded], count
+
+
+@benchmark("MessageReader.read_message")
+def bench_reader(count=20000):
+    data = b''.join(frames(random.Random(SEED), count))
+    loop = asyncio.new_event_loop()
+
+    async def read_all():
+        reader = asyncio.StreamReader(limit=2 ** 22)
+        reader.feed_data(data)
+        reader.feed_eof()
+        messages = MessageReader(reader)
+        for _ in range(count):
+            await messages.read_message(10)
+
+    yield lambda: loop.run_until_complete(read_all()), count
+    loop.close()
+
+
+def picker_with_peers(rnd, num_pieces, peers):
+    picker = PiecePicker(num_pieces)
+    bitfields = []
+    for i in range(peers):
+        # A few seeds, the rest partial
+        data = b'\xff' * ((num_pieces + 7) // 8) if i % 10 == 0 else rnd.randbytes((num_pieces + 7) // 8)
+        bitfield = Bitfield(num_pieces, data)
+        picker.add_bitfield(bitfield)
+        bitfields.append(bitfield)
+    return picker, bitfields
+
+
+def bench_pick(num_pieces, peers, count=20000):
+    rnd = random.Random(SEED)
+    picker, bitfields = picker_with_peers(rnd, num_pieces, peers)
+    order = [bitfields[rnd.randrange(peers)] for _ in range(count)]
+    yield lambda: [picker.pick(bitfield) for bitfield in order], count
+
+
+def bench_add_bitfield(num_pieces, peers):
+    rnd = random.Random(SEED)
+    bitfields = [Bitfield(num_pieces, rnd.randbytes((num_pieces + 7) // 8)) for _ in range(peers)]
+
+    def run():
+        picker = PiecePicker(num_pieces)
+        for bitfield in bitfields:
+            picker.add_bitfield(bitfield)
+
+    yield run, peers
+
+
+def bench_find_block(num_pieces, peers, count=2000):
+    # Every call either continues a started piece or starts the rarest one the peer has
+    rnd = random.Random(SEED)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as directory:
+        meta_info = MetaInfo(synthetic_torrent(directory, num_pieces, rnd=rnd), directory)
+        block_handler = BlockHandler(meta_info)
+        for i in range(peers):
+            data = b'\xff' * ((num_pieces + 7) // 8) if i % 10 == 0 else rnd.randbytes((num_pieces + 7) // 8)
+            block_handler.add_bitfield(i, Bitfield(num_pieces, data))
+        order = [rnd.randrange(peers) for _ in range(count)]
+        yield lambda: [block_handler.find_block(peer_id) for peer_id in order], count
+        block_handler.close()
+        loop.run_until_complete(asyncio.sleep(0))
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+for _pieces in (10000, 100000):
+    for _peers in (50, 500):
+        benchmark(f"PiecePicker.pick[{_pieces}x{_peers}]", num_pieces=_pieces, peers=_peers)(bench_pick)
+        benchmark(f"BlockHandler.find_block[{_pieces}x{_peers}]", num_pieces=_pieces, peers=_peers)(bench_find_block)
+    benchmark(f"PiecePicker.add_bitfield[{_pieces}]", num_pieces=_pieces, peers=50)(bench_add_bitfield)
+
+
+@benchmark("Piece.assemble_verify", piece_length=2 ** 18, count=64)
+def bench_piece(piece_length, count):
+    # Every block of a piece written into its buffer, then the hash checked as the hasher would
+    data = random.Random(SEED).randbytes(piece_length)
+    digest = hashlib.sha1(data).digest()
+    pool = BufferPool(piece_length)
+    blocks = [(begin, memoryview(data)[begin:begin + BLOCK_SIZE]) for begin in range(0, piece_length, BLOCK_SIZE)]
+
+    def run():
+        for index in range(count):
+            piece = Piece(index, digest, piece_length, pool)
+            for _ in blocks:
+                piece.request_block_download()
+            for begin, block in blocks:
+                piece.block_received(begin, block)
+            assert piece.verify_piece(hashlib.sha1(piece.get_data()).digest())
+            piece.clear_data()
+
+    yield run, count
+
+
+@benchmark("FileIndex.spans[100000 files]", files=100000, count=20000)
+def bench_spans(files, count):
+    rnd = random.Random(SEED)
+    file_index = FileIndex([{"length": rnd.randrange(1, 2 ** 20)} for _ in range(files)], 2 ** 18)
+    num_pieces = (file_index.length + 2 ** 18 - 1) // 2 ** 18
+    order = [rnd.randrange(num_pieces) for _ in range(count)]
+    yield lambda: [file_index.spans(piece) for piece in order], count
+
+
+def bench_parse_response(peers):
+    rnd = random.Random(SEED)
+    compact = b''.join(struct.pack("!4sH", rnd.randbytes(4), rnd.randrange(1, 65536)) for _ in range(peers))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as directory:
+        torrent = Torrent(synthetic_torrent(directory, 16), directory, listen=False)
+
+        def run():
+            torrent.connection_manager.candidates.clear()
+            torrent.parse_response({b'peers': compact})
+
+        yield run, peers
+        torrent.close()
+        loop.run_until_complete(asyncio.sleep(0))
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+for _peers in (1000, 50000):
+    benchmark(f"Torrent.parse_response[{_peers} peers]", peers=_peers)(bench_parse_response)
+
+
+@benchmark("Bitfield.andnot[100000]", num_pieces=100000, count=2000)
+def bench_andnot(num_pieces, count):
+    rnd = random.Random(SEED)
+    theirs = Bitfield(num_pieces, rnd.randbytes((num_pieces + 7) // 8))
+    mine = Bitfield(num_pieces, rnd.randbytes((num_pieces + 7) // 8))
+    yield lambda: [theirs.andnot(mine).any() for _ in range(count)], count
+
+
+def measure(function, params, repeat, min_time):
+    # Best time per operation over the repeats, each repeat on fresh inputs and run until min_time
+    best = float("inf")
+    for _ in range(repeat):
+        runner = function(**params)
+        # Setup and cleanup may draw the progress bar
+        with redirect_stdout(io.StringIO()):
+            run, ops = next(runner)
+        total_ops = 0
+        started = time.perf_counter()
+        while True:
+            run()
+            total_ops += ops
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / total_ops)
+        with redirect_stdout(io.StringIO()):
+            next(runner, None)
+    return best
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the protocol hot paths")
+    parser.add_argument("filter", nargs="*", help="Only benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Seconds each repeat runs for at least")
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--check", action="store_true", help="Exit with an error if anything regressed")
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.filter or any(part in name for part in args.filter)]
+    if args.list:
+        print("\n".join(names))
+        return
+
+    try:
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<44} {'per op':>11} {'baseline':>11} {'change':>8}")
+    for name in names:
+        function, params = BENCHMARKS[name]
+        # Inputs are built from a fixed seed, the same draws every time
+        random.seed(SEED)
+        results[name] = measure(function, params, args.repeat, args.min_time)
+        baseline = baselines.get(name)
+        if baseline:
+            ratio = results[name] / baseline
+            flag = "  REGRESSED" if ratio > args.threshold else ""
+            if flag:
+                regressions.append(name)
+            print(f"{name:<44} {format_time(results[name])} {format_time(baseline)} {ratio:7.2f}x{flag}")
+        else:
+            print(f"{name:<44} {format_time(results[name])} {'-':>11} {'-':>8}")
+
+    if args.save:
+        baselines.update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+            f.write("\n")
+    if regressions and args.check:
+        sys.exit(f"{len(regressions)} regressed past {args.threshold}x: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
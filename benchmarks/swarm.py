@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode  # noqa: E402
+from rate_limiter import RateLimiter  # noqa: E402
+from torrent import Torrent  # noqa: E402
+
+CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD, REQUEST, PIECE, CANCEL = range(9)
+
+
+def make_info(payload, piece_length, files, seed):
+    pieces = b''.join(hashlib.sha1(payload[i:i + piece_length]).digest()
+                      for i in range(0, len(payload), piece_length))
+    info = {b'name': b'swarm', b'piece length': piece_length, b'pieces': pieces}
+    if files > 1:
+        # Uneven lengths, so that pieces straddle file boundaries
+        cuts = sorted(random.Random(seed).sample(range(1, len(payload)), files - 1))
+        lengths = [end - start for start, end in zip([0] + cuts, cuts + [len(payload)])]
+        info[b'files'] = [{b'length': length, b'path': [b'file%d.bin' % i]} for i, length in enumerate(lengths)]
+    else:
+        info[b'length'] = len(payload)
+    return info
+
+
+class SeedPeer:
+    # A seed with the whole payload that answers requests after a delay and at a capped rate
+    def __init__(self, index, payload, piece_length, info_hash, latency, rate, choke_every, choke_for, snubbed):
+        self.peer_id = b'-SW0001-' + b'%012d' % index
+        self.payload = memoryview(payload)
+        self.piece_length = piece_length
+        self.info_hash = info_hash
+        self.latency = latency
+        # Bytes per second, the limiter of the client itself
+        self.limiter = RateLimiter(rate)
+        self.choke_every = choke_every
+        self.choke_for = choke_for
+        # Never unchokes anyone
+        self.snubbed = snubbed
+        num_pieces = (len(payload) + piece_length - 1) // piece_length
+        bitfield = bytearray((num_pieces + 7) // 8)
+        for i in range(num_pieces):
+            bitfield[i // 8] |= 0x80 >> (i % 8)
+        self.bitfield = bytes(bitfield)
+
+    def choked_now(self, started):
+        # Choking behaviour: off for choke_for seconds out of every choke_every
+        if self.snubbed:
+            return True
+        return bool(self.choke_every) and (time.monotonic() - started) % self.choke_every < self.choke_for
+
+    async def handle(self, reader, writer):
+        # (index, begin) of requests cancelled before they were served
+        cancelled = set()
+        queue = asyncio.Queue()
+        sender = None
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.info_hash:
+                return
+            writer.write(struct.pack("!B19sQ20s20s", 19, b"BitTorrent protocol", 0, self.info_hash, self.peer_id))
+            writer.write(struct.pack("!IB", 1 + len(self.bitfield), BITFIELD) + self.bitfield)
+            state = {"choked": True, "interested": False, "started": time.monotonic()}
+            sender = asyncio.create_task(self.send_blocks(writer, queue, cancelled, state))
+            while True:
+                length = struct.unpack("!I", await reader.readexactly(4))[0]
+                if not length:
+                    continue
+                body = await reader.readexactly(length)
+                if body[0] == INTERESTED:
+                    state["interested"] = True
+                    await self.update_choke(writer, state)
+                elif body[0] == NOT_INTERESTED:
+                    state["interested"] = False
+                elif body[0] == REQUEST and not state["choked"]:
+                    index, begin, size = struct.unpack_from("!III", body, 1)
+                    cancelled.discard((index, begin))
+                    queue.put_nowait((time.monotonic() + self.latency, index, begin, size))
+                elif body[0] == CANCEL:
+                    index, begin, _ = struct.unpack_from("!III", body, 1)
+                    cancelled.add((index, begin))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if sender:
+                sender.cancel()
+            writer.close()
+
+    async def update_choke(self, writer, state):
+        choked = self.choked_now(state["started"]) or not state["interested"]
+        if choked != state["choked"]:
+            state["choked"] = choked
+            writer.write(struct.pack("!IB", 1, CHOKE if choked else UNCHOKE))
+            await writer.drain()
+
+    async def send_blocks(self, writer, queue, cancelled, state):
+        try:
+            await self.serve(writer, queue, cancelled, state)
+        except ConnectionError:
+            # The reading side sees the connection go and cleans up
+            pass
+
+    async def serve(self, writer, queue, cancelled, state):
+        while True:
+            try:
+                due, index, begin, size = await asyncio.wait_for(queue.get(), 0.5)
+            except asyncio.TimeoutError:
+                await self.update_choke(writer, state)
+                continue
+            await self.update_choke(writer, state)
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # A choke drops every request, as real clients do
+            if (index, begin) in cancelled or state["choked"]:
+                cancelled.discard((index, begin))
+                continue
+            await self.limiter.acquire(size)
+            offset = index * self.piece_length + begin
+            writer.write(struct.pack("!IBII", 9 + size, PIECE, index, begin))
+            writer.write(self.payload[offset:offset + size])
+            await writer.drain()
+
+
+class TrackerProtocol(asyncio.DatagramProtocol):
+    # BEP 15 stand-in, any connection id is accepted
+    def __init__(self, peers):
+        self.peers = peers
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 16 and struct.unpack_from("!i", data, 8)[0] == 0:
+            transaction_id = struct.unpack_from("!i", data, 12)[0]
+            self.transport.sendto(struct.pack("!iiq", 0, transaction_id, random.getrandbits(62)), addr)
+        elif len(data) >= 98:
+            transaction_id = struct.unpack_from("!i", data, 12)[0]
+            self.transport.sendto(struct.pack("!iiiii", 1, transaction_id, 1800, 0, len(self.peers)) + self.peers,
+                                  addr)
+
+
+async def http_tracker(reader, writer, peers):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = bencode.encode({b'interval': 1800, b'complete': len(peers) // 6, b'peers': peers})
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run_swarm(options, channel):
+    loop = asyncio.get_running_loop()
+    rnd = random.Random(options["seed"])
+    # The same payload for the same seed, only ever held by the swarm's process
+    payload = rnd.randbytes(options["size"])
+    info = make_info(payload, options["piece_length"], options["files"], options["seed"])
+    info_hash = hashlib.sha1(bencode.encode(info)).digest()
+    snubbed = set(rnd.sample(range(options["seeds"]), min(options["snubbed"], options["seeds"])))
+    servers = []
+    peers = b''
+    for i in range(options["seeds"]):
+        seed = SeedPeer(i, payload, options["piece_length"], info_hash, options["latency"], options["rate"],
+                        options["choke_every"], options["choke_for"], i in snubbed)
+        server = await asyncio.start_server(seed.handle, "127.0.0.1", 0)
+        servers.append(server)
+        peers += struct.pack("!4sH", bytes([127, 0, 0, 1]), server.sockets[0].getsockname()[1])
+
+    http = await asyncio.start_server(lambda r, w: http_tracker(r, w, peers), "127.0.0.1", 0)
+    udp, _ = await loop.create_datagram_endpoint(lambda: TrackerProtocol(peers), local_addr=("127.0.0.1", 0))
+    channel.send((bencode.encode(info), hashlib.sha1(payload).digest(), http.sockets[0].getsockname()[1],
+                  udp.get_extra_info("sockname")[1]))
+    # Until the client says it is done
+    await loop.run_in_executor(None, channel.recv)
+    udp.close()
+    http.close()
+    for server in servers:
+        server.close()
+
+
+def swarm_process(options, channel):
+    asyncio.run(run_swarm(options, channel))
+
+
+async def download(torrent_path, location, options):
+    torrent = Torrent(torrent_path, location, max_peers=options["seeds"], pipeline_depth=options["pipeline_depth"],
+                      listen=False)
+    block_handler = torrent.block_handler
+    done = asyncio.Event()
+    block_handler.piece_listeners.append(lambda index: block_handler.is_complete() and done.set())
+    started = time.perf_counter()
+    task = asyncio.create_task(torrent.torrent_start())
+    try:
+        await asyncio.wait_for(done.wait(), options["timeout"])
+        elapsed = time.perf_counter() - started
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        torrent.close()
+    return elapsed, torrent.metrics()
+
+
+def verify(location, digest, files):
+    if files > 1:
+        names = sorted(os.listdir(os.path.join(location, "swarm")), key=lambda name: int(name[4:-4]))
+        paths = [os.path.join(location, "swarm", name) for name in names]
+    else:
+        paths = [os.path.join(location, "swarm")]
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            while chunk := f.read(2 ** 20):
+                sha1.update(chunk)
+    return sha1.digest() == digest
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download a synthetic torrent from simulated seeds on loopback")
+    parser.add_argument("--size", type=float, default=64, help="Payload in MiB")
+    parser.add_argument("--piece-length", type=int, default=256, help="Piece length in KiB")
+    parser.add_argument("--files", type=int, default=1, help="Split the payload over this many files")
+    parser.add_argument("--seeds", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=20, help="Milliseconds before a seed answers a request")
+    parser.add_argument("--rate", type=float, default=0, help="Upload cap of each seed in KB/s, 0 for none")
+    parser.add_argument("--choke-every", type=float, default=0, help="Seeds choke for --choke-for seconds out of each")
+    parser.add_argument("--choke-for", type=float, default=0)
+    parser.add_argument("--snubbed", type=int, default=0, help="Seeds that never unchoke")
+    parser.add_argument("--tracker", choices=("udp", "http"), default="udp")
+    parser.add_argument("--pipeline-depth", type=int)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the payload and every random choice")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    options = {"seeds": args.seeds, "piece_length": args.piece_length * 1024, "latency": args.latency / 1000,
+               "rate": int(args.rate * 1024) or None, "choke_every": args.choke_every, "choke_for": args.choke_for,
+               "snubbed": args.snubbed, "seed": args.seed, "pipeline_depth": args.pipeline_depth,
+               "timeout": args.timeout, "size": int(args.size * 2 ** 20), "files": args.files}
+    size = options["size"]
+    times = []
+    cpu = 0
+    channel, child = multiprocessing.Pipe()
+    # The swarm runs in its own process so that CPU time and RSS below are the client's alone
+    swarm = multiprocessing.get_context("spawn").Process(target=swarm_process, args=(options, child))
+    swarm.start()
+    try:
+        info, digest, http_port, udp_port = channel.recv()
+        tracker = f"udp://127.0.0.1:{udp_port}" if args.tracker == "udp" else f"http://127.0.0.1:{http_port}/announce"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "swarm.torrent")
+            with open(path, "wb") as f:
+                f.write(bencode.encode({b'announce': tracker.encode(), b'info': bencode.decode(info)}))
+            for run in range(args.runs):
+                random.seed(args.seed + run)
+                location = os.path.join(directory, f"run{run}")
+                os.makedirs(location)
+                started = time.process_time()
+                with contextlib.redirect_stdout(open(os.devnull, "w")):
+                    elapsed, metrics = asyncio.run(download(path, location, options))
+                cpu += time.process_time() - started
+                ok = verify(location, digest, args.files)
+                times.append(elapsed)
+                rtt = metrics["request_rtt_seconds"]
+                print(f"run {run}: {elapsed:.2f} s, {size / 2 ** 20 / elapsed:.1f} MiB/s, "
+                      f"mean rtt {1000 * rtt['sum'] / max(rtt['count'], 1):.1f} ms, "
+                      f"{metrics['hash_failures']} hash failures, {'ok' if ok else 'CORRUPT'}")
+                if not ok:
+                    sys.exit(1)
+    finally:
+        channel.send("stop")
+        swarm.join(5)
+        if swarm.is_alive():
+            swarm.terminate()
+
+    gigabytes = size * len(times) / 2 ** 30
+    print(f"{args.size} MiB from {args.seeds} seeds, {args.latency} ms latency, "
+          f"{args.rate or 'unlimited'} KB/s per seed, {args.tracker} tracker")
+    print(f"throughput   {size * len(times) / 2 ** 20 / sum(times):.1f} MiB/s")
+    print(f"completion   min {min(times):.2f} s, median {statistics.median(times):.2f} s, "
+          f"p90 {percentile(times, 0.9):.2f} s, max {max(times):.2f} s")
+    print(f"cpu          {cpu / gigabytes:.1f} s per GiB")
+    # ru_maxrss is in KiB on Linux
+    print(f"peak rss     {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+from collections.abc import Mapping
+
+# No string in a real torrent needs a length of more digits than this
+MAX_LENGTH_DIGITS = 20
+# Lists and dictionaries nested deeper than this are refused, decoding recurses once per level and what we decode
+# comes from trackers and DHT nodes we do not trust
+MAX_DEPTH = 64
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def parse_int(data, start, end):
+    text = data[start:end]
+    try:
+        value = int(text)
+    except ValueError:
+        raise BencodeError(f"Bad integer at {start}") from None
+    # Only the canonical form, int() would also take leading zeros, signs, spaces and underscores
+    if text != b'%d' % value:
+        raise BencodeError(f"Bad integer at {start}")
+    return value
+
+
+def string_span(data, pos):
+    # (start, end) of the string whose length prefix starts at pos
+    colon = data.find(b':', pos, pos + MAX_LENGTH_DIGITS + 1)
+    # Digits only, and no leading zero
+    if colon <= pos or not data[pos:colon].isdigit() or (data[pos] == 48 and colon > pos + 1):
+        raise BencodeError(f"Bad string at {pos}")
+    end = colon + 1 + int(data[pos:colon])
+    if end > len(data):
+        raise BencodeError(f"String at {pos} runs past the end")
+    return colon + 1, end
+
+
+def int_end(data, pos):
+    end = data.find(b'e', pos)
+    if end < 0:
+        raise BencodeError(f"Unterminated integer at {pos}")
+    return end
+
+
+def check_depth(depth, pos):
+    if depth >= MAX_DEPTH:
+        raise BencodeError(f"Nested too deeply at {pos}")
+
+
+def skip(data, pos, depth=0):
+    # End of the value starting at pos, nested depth deep, walked without building or checking anything but the
+    # nesting, values are only checked once decoded. Strings are jumped over, so a large pieces string costs nothing.
+    nesting = 0
+    try:
+        while True:
+            kind = data[pos]
+            if kind == 101:
+                nesting -= 1
+                pos += 1
+            elif kind == 100 or kind == 108:
+                check_depth(depth + nesting, pos)
+                nesting += 1
+                pos += 1
+            elif kind == 105:
+                pos = data.index(b'e', pos) + 1
+            elif 48 <= kind <= 57:
+                colon = data.index(b':', pos)
+                pos = colon + 1 + int(data[pos:colon])
+            else:
+                break
+            if nesting <= 0:
+                break
+    except BencodeError:
+        raise
+    except (IndexError, ValueError):
+        raise BencodeError("Truncated data") from None
+    if nesting != 0 or pos > len(data):
+        raise BencodeError(f"Bad data before {pos}")
+    return pos
+
+
+def decode_at(data, pos, depth=0):
+    # (value, end) of the value starting at pos, nested depth deep, dictionaries stay lazy
+    if pos >= len(data):
+        raise BencodeError("Truncated data")
+    kind = data[pos]
+    if kind == 105:
+        end = int_end(data, pos)
+        return parse_int(data, pos + 1, end), end + 1
+    if kind == 108:
+        check_depth(depth, pos)
+        items = []
+        pos += 1
+        while pos < len(data) and data[pos] != 101:
+            item, pos = decode_at(data, pos, depth + 1)
+            items.append(item)
+        if pos >= len(data):
+            raise BencodeError("Truncated data")
+        return items, pos + 1
+    if kind == 100:
+        value = Dict(data, pos, depth)
+        return value, value.end
+    start, end = string_span(data, pos)
+    return data[start:end], end
+
+
+def decode_plain_at(data, pos, depth=0):
+    # (value, end) like decode_at, but dictionaries are read in the same pass into plain dicts, for a long list
+    # of small dictionaries read once, where a Dict would skip each value to find the keys and decode it again
+    kind = data[pos] if pos < len(data) else None
+    if kind != 108 and kind != 100:
+        return decode_at(data, pos, depth)
+    check_depth(depth, pos)
+    items = []
+    pos += 1
+    while True:
+        if pos >= len(data):
+            raise BencodeError("Truncated data")
+        item = data[pos]
+        if item == 101:
+            break
+        # Strings and integers inline, they are most of what a file list holds
+        if 48 <= item <= 57:
+            colon = data.find(b':', pos, pos + MAX_LENGTH_DIGITS + 1)
+            length = data[pos:colon]
+            if colon <= pos or not length.isdigit() or (item == 48 and colon > pos + 1):
+                raise BencodeError(f"Bad string at {pos}")
+            pos = colon + 1 + int(length)
+            if pos > len(data):
+                raise BencodeError(f"String at {colon} runs past the end")
+            items.append(data[colon + 1:pos])
+        elif item == 105:
+            end = int_end(data, pos)
+            items.append(parse_int(data, pos + 1, end))
+            pos = end + 1
+        else:
+            item, pos = decode_plain_at(data, pos, depth + 1)
+            items.append(item)
+    if kind == 108:
+        return items, pos + 1
+    keys = items[::2]
+    if len(items) % 2 or not all(type(key) is bytes for key in keys):
+        raise BencodeError(f"Bad dictionary before {pos}")
+    return dict(zip(keys, items[1::2])), pos + 1
+
+
+class Dict(Mapping):
+    # A dictionary over its encoded bytes. Only the keys are read up front, each value is decoded the
+    # first time it is asked for, and the raw bytes of any value stay available.
+    __slots__ = ("data", "start", "end", "depth", "spans", "values")
+
+    def __init__(self, data, start=0, depth=0):
+        check_depth(depth, start)
+        self.data = data
+        self.start = start
+        self.depth = depth
+        # key -> (start, end) of its encoded value in data
+        self.spans = {}
+        self.values = {}
+        pos = start + 1
+        while pos < len(data) and data[pos] != 101:
+            key_start, key_end = string_span(data, pos)
+            key = data[key_start:key_end]
+            if data[key_end:key_end + 1] == b'd':
+                # Read now rather than skipped, so the keys of a nested dictionary such as info are walked once
+                self.values[key] = Dict(data, key_end, depth + 1)
+                pos = self.values[key].end
+            else:
+                pos = skip(data, key_end, depth + 1)
+            self.spans[key] = (key_end, pos)
+        if pos >= len(data):
+            raise BencodeError("Truncated data")
+        self.end = pos + 1
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            self.values[key] = decode_at(self.data, self.spans[key][0], self.depth + 1)[0]
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __contains__(self, key):
+        return key in self.spans
+
+    def raw(self, key=None):
+        # A value as it was encoded, or the whole dictionary, for hashing info as the torrent file has it
+        start, end = self.spans[key] if key is not None else (self.start, self.end)
+        return memoryview(self.data)[start:end]
+
+    def plain(self, key):
+        # A value decoded in full with decode_plain_at, and not kept
+        return decode_plain_at(self.data, self.spans[key][0], self.depth + 1)[0]
+
+    def view(self, key):
+        # A string value without copying it
+        start, end = string_span(self.data, self.spans[key][0])
+        return memoryview(self.data)[start:end]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def decode(data):
+    # Strings and keys come out as bytes, dictionaries as Dict
+    data = bytes(data)
+    value, end = decode_at(data, 0)
+    if end != len(data):
+        raise BencodeError(f"Trailing data at {end}")
+    return value
+
+
+def encode_bytes(value, parts):
+    parts.append(b'%d:' % len(value))
+    parts.append(value)
+
+
+def encode_dict(value, parts):
+    parts.append(b'd')
+    items = [(key.encode() if isinstance(key, str) else key, item) for key, item in value.items()]
+    items.sort(key=lambda pair: pair[0])
+    for key, item in items:
+        parts.append(b'%d:' % len(key))
+        parts.append(key)
+        encode_into(item, parts)
+    parts.append(b'e')
+
+
+def encode_list(value, parts):
+    parts.append(b'l')
+    for item in value:
+        encode_into(item, parts)
+    parts.append(b'e')
+
+
+ENCODERS = {
+    bytes: encode_bytes, bytearray: encode_bytes, memoryview: encode_bytes,
+    str: lambda value, parts: encode_bytes(value.encode(), parts),
+    int: lambda value, parts: parts.append(b'i%de' % value),
+    dict: encode_dict, list: encode_list, tuple: encode_list,
+    # Decoded from canonical bencode, so the original bytes are the encoding
+    Dict: lambda value, parts: parts.append(value.raw()),
+}
+
+
+def encode_into(value, parts):
+    encoder = ENCODERS.get(type(value))
+    if encoder is None:
+        raise BencodeError(f"Cannot encode {type(value).__name__}")
+    encoder(value, parts)
+
+
+def encode(value):
+    parts = []
+    encode_into(value, parts)
+    return b''.join(parts)
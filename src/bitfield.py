@@ -0,0 +1,67 @@
+class Bitfield:
+    # One bit per piece, the first piece in the high bit of the first byte as on the wire
+    __slots__ = ("length", "bits", "count")
+
+    def __init__(self, length, data=None):
+        self.length = length
+        size = (length + 7) // 8
+        self.bits = bytearray(size)
+        if data is not None:
+            data = memoryview(data)[:size]
+            self.bits[:len(data)] = data
+            # Spare bits past the last piece are meant to be zero, a peer that sets them must not count
+            if length % 8:
+                self.bits[-1] &= (0xff << (8 - length % 8)) & 0xff
+        self.count = int.from_bytes(self.bits, "big").bit_count()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.bits[index >> 3] >> (7 - (index & 7)) & 1
+
+    def set(self, index):
+        mask = 0x80 >> (index & 7)
+        if not self.bits[index >> 3] & mask:
+            self.bits[index >> 3] |= mask
+            self.count += 1
+
+    def clear(self, index):
+        mask = 0x80 >> (index & 7)
+        if self.bits[index >> 3] & mask:
+            self.bits[index >> 3] &= ~mask & 0xff
+            self.count -= 1
+
+    def any(self):
+        return self.count > 0
+
+    def complete(self):
+        return self.count == self.length
+
+    def ones(self):
+        # Indices of the set bits, whole zero bytes are skipped
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield byte_index * 8 + bit
+
+    def as_int(self):
+        return int.from_bytes(self.bits, "big")
+
+    def from_int(self, value):
+        return Bitfield(self.length, value.to_bytes(len(self.bits), "big"))
+
+    def __and__(self, other):
+        return self.from_int(self.as_int() & other.as_int())
+
+    def andnot(self, other):
+        # What we have that other lacks, for a peer's bitfield and ours the pieces worth asking it for
+        return self.from_int(self.as_int() & ~other.as_int())
+
+    def tobytes(self):
+        return bytes(self.bits)
+
+    def view(self):
+        # The wire encoding as it is, without a copy
+        return memoryview(self.bits)
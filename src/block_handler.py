@@ -1,58 +1,165 @@
 import asyncio
-import math
-import os
+import logging
 import sys
 import time
 from collections import defaultdict
 
-import aiofiles
-import bitstring
+from bitfield import Bitfield
+from cache import WRITE_CACHE_BUDGET, ReadCache, WriteCache
+from hasher import Hasher
+from picker import PiecePicker
+from rate_limiter import RateLimiter, kib
+from piece import BufferPool, Piece
+from stats import PICKER_BUCKETS, Histogram
+from storage import Storage
 
-from piece import Piece
-from utils import get_file
+logger = logging.getLogger("bittorrent")
+
+# In endgame a block is requested from at most this many peers at once
+ENDGAME_REQUESTERS = 3
+# Longest a verified piece waits in the write cache
+FLUSH_INTERVAL = 5
+# Seconds between redraws of the progress bar
+PROGRESS_INTERVAL = 0.5
+# Pieces ahead of the read cursor fetched in order before anything else, when streaming
+STREAM_WINDOW = 16
+# Seconds each piece of the window adds to its deadline, the first is due after one
+PIECE_DEADLINE = 1.0
+# A window piece this close to its deadline may be requested from several peers at once
+DEADLINE_MARGIN = 1.0
 
 
 class BlockHandler:
-    def __init__(self, meta_info):
+    def __init__(self, meta_info, hasher=None, write_cache_budget=WRITE_CACHE_BUDGET):
         self.num_pieces = meta_info.num_pieces
-        self.my_bitfield = bitstring.BitArray(length=self.num_pieces)
+        self.my_bitfield = Bitfield(self.num_pieces)
         self.block_size = 2 ** 14
         self.piece_size = meta_info.data[b'info'][b'piece length']
-        self.path = meta_info.path
         self.bitfields = {}
-        self.block_per_piece = math.ceil(self.piece_size / self.block_size)
+        self.picker = PiecePicker(self.num_pieces)
         self.length = meta_info.length
-        self.torrent_hash = meta_info.data[b'info'][b'pieces']
-        self.mode = meta_info.mode
+        self.piece_hashes = meta_info.pieces
         self.file_names = meta_info.files
-        self.pending_pieces = self.piece_initialise()
+        self.storage = Storage(meta_info.path, meta_info.files, meta_info.file_index)
+        # Pieces are only built once they are started, index -> Piece
+        self.pending_pieces = {}
+        self.buffer_pool = BufferPool(self.piece_size)
+        # A session shares one hasher between its torrents, on our own we make and close our own
+        self.own_hasher = hasher is None
+        self.hasher = hasher if hasher else Hasher()
+        # Whole verified pieces read back from disk for uploading
+        self.read_cache = ReadCache()
+        # Verified pieces not yet on disk. They are only set in my_bitfield once written, so we never
+        # advertise a piece we might lose.
+        self.write_cache = WriteCache(write_cache_budget)
+        # Task writing the write cache out, only ever one at a time
+        self.flush_job = None
+        # Tasks hashing completed pieces
+        self.verifying = set()
+        # Called with the index of every piece we complete, so peers can be told about it
+        self.piece_listeners = []
         self.downloading_pieces = []
-        self.downloading_blocks = []
+        # peer_id -> {(index, begin): [block, request time in ms]}
+        self.downloading_blocks = defaultdict(dict)
+        # (index, begin) -> peer_ids the block is requested from, more than one only in endgame
+        self.requesters = {}
+        # peer_id -> Peer, for cancelling endgame duplicates
+        self.peers = {}
         self.download_amount = 0
+        self.upload_amount = 0
         #
         self.download_during_duration = 0
         self.download_speed = 0
-        self.download_limit = meta_info.max_download
-        #
+        # Shared by every peer of the torrent, the per-peer rates are for the peers' own buckets
+        self.download_limiter = RateLimiter(kib(meta_info.max_download))
+        self.upload_limiter = RateLimiter(kib(meta_info.max_upload))
+        # Every bucket a peer's traffic is charged to besides its own, a session adds its global ones
+        self.download_limiters = (self.download_limiter,)
+        self.upload_limiters = (self.upload_limiter,)
+        self.peer_download_rate = kib(meta_info.max_peer_download)
+        self.peer_upload_rate = kib(meta_info.max_peer_upload)
+        # Seconds, from a request to its block, for a run of blocks to be written, and to choose a block
+        self.request_rtt = Histogram()
+        self.write_latency = Histogram()
+        self.picker_time = Histogram(PICKER_BUCKETS)
+        self.hash_failures = 0
+        self.write_failures = 0
+        self.last_progress = 0
         self.download_progress(self.download_amount)
         loop = asyncio.get_event_loop()
         self.download_task = loop.create_task(self.calculate_download_speed())
+        self.flush_task = loop.create_task(self.flush_periodically())
+        # Streaming: the window starts at the first missing piece from the cursor, None downloads rarest-first
+        self.cursor = None
+        self.window = STREAM_WINDOW
+        # piece -> monotonic time it is wanted by, for pieces in the window
+        self.deadlines = {}
+        # piece -> Event set once the piece is verified, for readers waiting on it
+        self.waiters = {}
 
-    def piece_initialise(self):
-        tmp = []
-        hash_offset = 0
-        tmp_length = self.length
-        for i in range(self.num_pieces):
-            if tmp_length > self.piece_size:
-                tmp.append(Piece(i, self.torrent_hash[hash_offset:hash_offset + 20], self.piece_size))
-            else:
-                tmp.append(Piece(i, self.torrent_hash[hash_offset:hash_offset + 20], tmp_length))
-            hash_offset += 20
-            tmp_length -= self.piece_size
+    def close(self):
+        self.download_task.cancel()
+        self.flush_task.cancel()
+        for task in self.verifying:
+            task.cancel()
+        if self.flush_job:
+            self.flush_job.cancel()
+        if self.own_hasher:
+            self.hasher.close()
+        self.storage.close()
+
+    def piece_length(self, index):
+        return min(self.piece_size, self.length - index * self.piece_size)
+
+    def mark_complete(self, index):
+        # The piece is already on disk and verified
+        if not self.my_bitfield[index]:
+            self.my_bitfield.set(index)
+            self.picker.remove(index)
+            self.download_amount += self.piece_length(index)
+            self.piece_verified(index)
+
+    def has_piece(self, index):
+        # Verified, whether or not it is on disk yet
+        return self.my_bitfield[index] or index in self.write_cache.pieces
 
-        self.initialise_files()
+    def piece_verified(self, index):
+        self.deadlines.pop(index, None)
+        waiter = self.waiters.pop(index, None)
+        if waiter:
+            waiter.set()
 
-        return tmp
+    async def wait_verified(self, index):
+        if not self.has_piece(index):
+            await self.waiters.setdefault(index, asyncio.Event()).wait()
+
+    def set_cursor(self, index):
+        # Pieces that fell behind the cursor lose their deadlines, those still in the window keep theirs
+        self.cursor = min(max(index, 0), self.num_pieces)
+        window = set(self.window_pieces())
+        for piece in [piece for piece in self.deadlines if piece not in window]:
+            del self.deadlines[piece]
+
+    def window_pieces(self):
+        # Missing pieces from the cursor on, each given a deadline when it first enters the window
+        start = self.cursor
+        while start < self.num_pieces and self.has_piece(start):
+            start += 1
+        self.cursor = start
+        now = time.monotonic()
+        pieces = []
+        for index in range(start, min(start + self.window, self.num_pieces)):
+            if not self.has_piece(index):
+                self.deadlines.setdefault(index, now + PIECE_DEADLINE * (index - start + 1))
+                pieces.append(index)
+        return pieces
+
+    def start_piece(self, index):
+        piece = Piece(index, self.piece_hashes[index], self.piece_length(index),
+                      self.buffer_pool)
+        self.pending_pieces[index] = piece
+        self.downloading_pieces.append(index)
+        return piece
 
     async def calculate_download_speed(self):
         while not self.is_complete():
@@ -60,22 +167,50 @@ class BlockHandler:
             self.download_during_duration = 0
             await asyncio.sleep(1)
 
-    def initialise_files(self):
-        if self.mode == 1:
-            self.file_names[0]["start"] = 0
-            for i in range(1, len(self.file_names)):
-                self.file_names[i]["start"] = self.file_names[i - 1]["length"] + self.file_names[i - 1]["start"]
+    def add_peer(self, peer):
+        self.peers[peer.remote_id] = peer
+
+    def remove_peer(self, peer):
+        if self.peers.get(peer.remote_id) is peer:
+            del self.peers[peer.remote_id]
+        self.remove_bitfield(peer.remote_id)
 
     def add_bitfield(self, peer_id, bitfield):
+        if peer_id in self.bitfields:
+            self.picker.remove_bitfield(self.bitfields[peer_id])
         self.bitfields[peer_id] = bitfield
+        self.picker.add_bitfield(bitfield)
 
     def remove_bitfield(self, peer_id):
         if peer_id in self.bitfields.keys():
+            self.picker.remove_bitfield(self.bitfields[peer_id])
             del self.bitfields[peer_id]
+        self.release_blocks(peer_id)
 
     def update_bitfield(self, peer_id, index):
-        if peer_id in self.bitfields:
-            self.bitfields[peer_id][index] = 1
+        if not 0 <= index < self.num_pieces:
+            return
+        if peer_id not in self.bitfields:
+            # The bitfield message is optional, a peer that starts with nothing only ever sends haves
+            self.add_bitfield(peer_id, Bitfield(self.num_pieces))
+        if not self.bitfields[peer_id][index]:
+            self.bitfields[peer_id].set(index)
+            self.picker.have(index)
+
+    def track_request(self, peer_id, block):
+        key = (block[0], block[1])
+        self.downloading_blocks[peer_id][key] = [block, int(round(time.time() * 1000))]
+        self.requesters.setdefault(key, set()).add(peer_id)
+
+    def drop_request(self, peer_id, key):
+        # Returns the other peers the block is still requested from
+        requesters = self.requesters.get(key)
+        if requesters is None:
+            return set()
+        requesters.discard(peer_id)
+        if not requesters:
+            del self.requesters[key]
+        return requesters
 
     def find_block(self, peer_id):
         if peer_id not in self.bitfields.keys():
@@ -83,31 +218,76 @@ class BlockHandler:
 
         expired_block = self.get_expired(peer_id)
         if expired_block is None:
-            block = self.get_next_block_from_piece(peer_id)
+            block = self.window_block(peer_id) if self.cursor is not None else None
+            if not block:
+                block = self.get_next_block_from_piece(peer_id)
             if not block:
                 index = self.rarest_piece_algorithm(peer_id)
                 if index is not None:
                     block = self.pending_pieces[index].request_block_download()
                     if block:
-                        self.downloading_blocks.append([block, int(round(time.time() * 1000))])
+                        self.track_request(peer_id, block)
+            if not block and self.in_endgame():
+                block = self.endgame_block(peer_id)
             return block
         else:
             return expired_block
 
-    def rarest_piece_algorithm(self, peer_id):
-        piece_count = defaultdict(int)
-        for i in range(self.num_pieces):
-            if self.my_bitfield[i] or not self.bitfields[peer_id][i] or i in self.downloading_pieces:
+    def in_endgame(self):
+        # Every block left is already requested, so an idle peer may as well race the slow ones
+        return self.picker.remaining() == 0 and all(piece.fully_requested() for piece in self.pending_pieces.values())
+
+    def window_block(self, peer_id):
+        # The window is filled in order, then its late pieces are raced between peers like in endgame
+        bitfield = self.bitfields[peer_id]
+        pieces = self.window_pieces()
+        for index in pieces:
+            if index in self.pending_pieces and bitfield[index]:
+                block = self.pending_pieces[index].request_block_download()
+                if block:
+                    self.track_request(peer_id, block)
+                    return block
+
+        index = self.picker.pick_first(bitfield, pieces)
+        if index is not None:
+            self.picker.remove(index)
+            block = self.start_piece(index).request_block_download()
+            self.track_request(peer_id, block)
+            return block
+
+        now = time.monotonic()
+        urgent = [index for index in pieces if index in self.pending_pieces and
+                  self.deadlines[index] - now <= DEADLINE_MARGIN]
+        return self.endgame_block(peer_id, urgent) if urgent else None
+
+    def endgame_block(self, peer_id, pieces=None):
+        best = None
+        best_count = ENDGAME_REQUESTERS
+        for index in self.downloading_pieces if pieces is None else pieces:
+            if not self.bitfields[peer_id][index]:
                 continue
-            for p in self.bitfields:
-                if self.bitfields[p][i]:
-                    piece_count[i] += 1
+            for begin, length in self.pending_pieces[index].pending_blocks():
+                requesters = self.requesters.get((index, begin), ())
+                if peer_id in requesters or len(requesters) >= best_count:
+                    continue
+                best = (index, begin, length)
+                best_count = len(requesters)
+                if best_count <= 1:
+                    break
+            if best and best_count <= 1:
+                break
+
+        if best:
+            self.track_request(peer_id, best)
+        return best
 
-        if not piece_count:
+    def rarest_piece_algorithm(self, peer_id):
+        rarest_piece = self.picker.pick(self.bitfields[peer_id])
+        if rarest_piece is None:
             return None
 
-        rarest_piece = min(piece_count, key=lambda q: piece_count[q])
-        self.downloading_pieces.append(rarest_piece)
+        self.picker.remove(rarest_piece)
+        self.start_piece(rarest_piece)
         return rarest_piece
 
     def get_next_block_from_piece(self, peer_id):
@@ -115,98 +295,161 @@ class BlockHandler:
             if self.bitfields[peer_id][i]:
                 next_block = self.pending_pieces[i].request_block_download()
                 if next_block:
-                    self.downloading_blocks.append([next_block, int(round(time.time() * 1000))])
+                    self.track_request(peer_id, next_block)
                     return next_block
         return None
 
-    async def block_received(self, index, begin, data):
-        for i in range(len(self.downloading_blocks)):
-            if self.downloading_blocks[i][0][1] == index and self.downloading_blocks[i][0][2] == begin:
-                del self.downloading_blocks[i]
-                break
+    async def block_received(self, peer_id, index, begin, data):
+        key = (index, begin)
+        self.downloading_blocks[peer_id].pop(key, None)
+        others = self.drop_request(peer_id, key)
 
-        piece = None
-        for i in self.downloading_pieces:
-            if i == index:
-                piece = i
-                break
-        if piece is not None:
-            self.download_amount += len(data)
-            self.download_during_duration += len(data)
-            self.download_progress(self.download_amount)
-
-            self.pending_pieces[index].block_received(begin, data)
-            if self.pending_pieces[index].completed():
-                if self.pending_pieces[index].verify_piece():
-                    await self.write(self.pending_pieces[index])
-                    self.downloading_pieces.remove(index)
-                    self.my_bitfield.set(1, index)
-                    self.pending_pieces[index].clear_data()
-                    if self.is_complete():
-                        print("\n")
+        piece = self.pending_pieces.get(index)
+        if piece is None:
+            return
+        if not piece.block_received(begin, data):
+            if not others:
+                # A bad block leaves nobody fetching it, so it can be requested again
+                piece.cancel_block(begin)
+            return
+
+        # The duplicates requested in endgame are no longer needed
+        for other in others:
+            self.downloading_blocks[other].pop(key, None)
+            peer = self.peers.get(other)
+            if peer:
+                peer.send_cancel(index, begin, len(data))
+        self.requesters.pop(key, None)
+
+        self.download_amount += len(data)
+        self.download_during_duration += len(data)
+        self.download_progress(self.download_amount)
+
+        if piece.completed():
+            # Drop the piece while it is hashed and written, so nothing touches the buffer and a late
+            # duplicate block cannot complete it twice
+            self.downloading_pieces.remove(index)
+            del self.pending_pieces[index]
+            task = asyncio.ensure_future(self.verify(piece))
+            self.verifying.add(task)
+            task.add_done_callback(self.verifying.discard)
+            # The peer still waits for the hash, which holds it back when the hasher falls behind. Shielded, so
+            # a peer closed meanwhile leaves the piece to be verified rather than losing it.
+            await asyncio.shield(task)
+
+    async def verify(self, piece):
+        stored = False
+        try:
+            digest = await self.hasher.digest(piece.get_data())
+            if piece.verify_piece(digest):
+                stored = True
+                await self.store(piece)
+            else:
+                self.hash_failures += 1
+        finally:
+            if not stored:
+                # Failed its hash or never got one, every block is downloaded again
+                piece.reset()
+                self.pending_pieces[piece.index] = piece
+                self.downloading_pieces.append(piece.index)
 
     def get_expired(self, peer_id):
         now = int(round(time.time() * 1000))
-        for i in self.downloading_blocks:
-            if self.bitfields[peer_id][i[0][1]]:
-                if i[1] + 5000 < now:
-                    i[1] = int(round(time.time() * 1000))
-                    return i[0]
+        for i in self.downloading_blocks[peer_id].values():
+            if i[1] + 5000 < now:
+                i[1] = now
+                return i[0]
         return None
 
+    def release_blocks(self, peer_id):
+        # Hand the peer's outstanding blocks back so that other peers can request them
+        for block, _ in self.downloading_blocks.pop(peer_id, {}).values():
+            # Still pending while an endgame duplicate is out at another peer
+            if not self.drop_request(peer_id, (block[0], block[1])) and block[0] in self.pending_pieces:
+                self.pending_pieces[block[0]].cancel_block(block[1])
+
+    async def read_piece(self, index):
+        # Peers ask for a piece block by block, so read it once and serve every block from memory
+        return await self.read_cache.get(
+            index, lambda: self.storage.read(index * self.piece_size, self.piece_length(index)))
+
     async def read(self, index, begin, length):
-        piece = self.pending_pieces[index]
-        async with aiofiles.open(self.file_names[0][0], 'rb') as fd:
-            pos = piece.index * self.piece_size + begin
-            await fd.seek(pos, 0)
-            await fd.read(length)
-
-    async def write(self, piece):
-        if self.mode == 0:
-            path = os.path.join(self.path, self.file_names[0][0].decode())
-            if not os.path.exists(path):
-                with open(path, 'w'):
-                    pass
-            async with aiofiles.open(path, 'rb+') as fd:
-                pos = piece.index * self.piece_size
-                await fd.seek(pos, 0)
-                await fd.write(piece.get_data())
-        else:
-            try:
-                path = self.path
-                data = piece.get_data()
-                file_index = get_file(piece, self.file_names, self.piece_size)
-                offset = 0
-                while len(data) > 0:
-                    temp_file = self.file_names[file_index + offset]
-                    ###
-                    length_to_write = min(len(data), temp_file['length'] - temp_file['downloaded'],
-                                          abs(temp_file["start"] + temp_file["length"] - piece.index * self.piece_size),
-                                          temp_file["length"])
-                    try:
-                        os.makedirs(os.path.join(path, b"/".join(temp_file["path"][:-1]).decode()), exist_ok=True)
-                    except (Exception,):
-                        pass
-                    fd = os.open(os.path.join(path, b"/".join(temp_file["path"]).decode()), os.O_RDWR | os.O_CREAT)
-                    pos = max(temp_file["start"], piece.index * self.piece_size) - temp_file["start"]
-                    os.lseek(fd, pos, os.SEEK_SET)
-                    os.write(fd, data[:length_to_write])
-                    ###
-                    self.file_names[file_index + offset]['downloaded'] += length_to_write
-                    data = data[length_to_write:]
-                    offset += 1
-                    os.close(fd)
-            except Exception as e:
-                print(e)
+        piece = self.write_cache.pieces.get(index)
+        if piece is not None:
+            # Verified but not written yet, a copy since the buffer goes back to the pool once it is
+            return bytes(piece.get_data()[begin:begin + length])
+        piece = await self.read_piece(index)
+        return piece[begin:begin + length]
+
+    async def store(self, piece):
+        self.write_cache.add(piece)
+        self.piece_verified(piece.index)
+        # Written straight away once the cache is full or nothing else is left to download
+        if self.write_cache.full() or (not self.pending_pieces and self.picker.remaining() == 0):
+            await self.flush()
+
+    async def flush(self):
+        # Writes run in a task of our own, a caller cancelled mid-write cannot cut one short and lose its pieces
+        if self.flush_job is None or self.flush_job.done():
+            self.flush_job = asyncio.ensure_future(self.write_out())
+        await asyncio.shield(self.flush_job)
+
+    async def write_out(self):
+        # Until the cache is empty, pieces verified during a write go out in the next round
+        wrote = False
+        while self.write_cache.pieces:
+            for run in self.write_cache.take_runs():
+                started = time.monotonic()
+                written = False
+                try:
+                    await self.storage.writev(run[0].index * self.piece_size, [piece.get_data() for piece in run])
+                    written = True
+                except OSError as e:
+                    logger.error("Pieces from %d not written: %s", run[0].index, e)
+                    self.write_failures += 1
+                finally:
+                    self.write_cache.written(run)
+                    self.write_latency.observe(time.monotonic() - started)
+                    for piece in run:
+                        piece.clear_data()
+                        if written:
+                            self.my_bitfield.set(piece.index)
+                            for listener in self.piece_listeners:
+                                listener(piece.index)
+                        else:
+                            # Never advertised, so the piece can simply be downloaded again
+                            self.picker.restore(piece.index)
+                wrote = True
+        if wrote and self.is_complete():
+            print("\n")
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            if self.write_cache.pieces:
+                await self.flush()
 
     def is_complete(self):
-        for i in self.my_bitfield:
-            if not i:
-                return False
+        return self.my_bitfield.complete()
 
-        return True
+    def metrics(self):
+        return {"downloaded": self.download_amount, "uploaded": self.upload_amount,
+                "pieces": self.my_bitfield.count, "num_pieces": self.num_pieces,
+                "pending_pieces": len(self.pending_pieces), "picker_remaining": self.picker.remaining(),
+                "outstanding_requests": sum(len(blocks) for blocks in self.downloading_blocks.values()),
+                "endgame_duplicates": sum(len(peers) - 1 for peers in self.requesters.values()),
+                "read_cache_bytes": self.read_cache.size, "write_cache_bytes": self.write_cache.size,
+                "hash_failures": self.hash_failures, "write_failures": self.write_failures,
+                "request_rtt_seconds": self.request_rtt.metrics(),
+                "write_latency_seconds": self.write_latency.metrics(),
+                "picker_seconds": self.picker_time.metrics()}
 
-    def download_progress(self, downloaded):
+    def download_progress(self, downloaded, force=False):
+        # Redrawn at most every PROGRESS_INTERVAL, writing to the terminal for every block is not free
+        now = time.monotonic()
+        if not force and now - self.last_progress < PROGRESS_INTERVAL and downloaded < self.length:
+            return
+        self.last_progress = now
         done = int(50 * downloaded / self.length)
         percent = str(round(100 * downloaded / self.length, 2))
         download = f"{str(round(self.download_amount / 1024 ** 2, 2))} out of {str(round(self.length / 1024 ** 2, 2))}"
@@ -0,0 +1,87 @@
+import asyncio
+from collections import OrderedDict
+
+READ_CACHE_BUDGET = 64 * 2 ** 20
+WRITE_CACHE_BUDGET = 32 * 2 ** 20
+
+
+class ReadCache:
+    def __init__(self, budget=READ_CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        # index -> piece data, least recently used first
+        self.pieces = OrderedDict()
+        # index -> task reading the piece, so concurrent misses share one read
+        self.loading = {}
+
+    async def get(self, index, load):
+        data = self.pieces.get(index)
+        if data is not None:
+            self.pieces.move_to_end(index)
+            return data
+
+        task = self.loading.get(index)
+        if task is None:
+            task = asyncio.ensure_future(load())
+            self.loading[index] = task
+            task.add_done_callback(lambda t: self.loaded(index, t))
+        return await asyncio.shield(task)
+
+    def loaded(self, index, task):
+        del self.loading[index]
+        if not task.cancelled() and task.exception() is None:
+            self.put(index, task.result())
+
+    def resize(self, budget):
+        self.budget = budget
+        while self.size > self.budget:
+            _, old = self.pieces.popitem(last=False)
+            self.size -= len(old)
+
+    def put(self, index, data):
+        if len(data) > self.budget:
+            return
+        self.discard(index)
+        while self.size + len(data) > self.budget:
+            _, old = self.pieces.popitem(last=False)
+            self.size -= len(old)
+        self.pieces[index] = data
+        self.size += len(data)
+
+    def discard(self, index):
+        data = self.pieces.pop(index, None)
+        if data is not None:
+            self.size -= len(data)
+
+
+class WriteCache:
+    def __init__(self, budget=WRITE_CACHE_BUDGET):
+        self.budget = budget
+        # Bytes held, pieces being written included
+        self.size = 0
+        # index -> verified Piece waiting to be written
+        self.pieces = {}
+
+    def add(self, piece):
+        self.pieces[piece.index] = piece
+        self.size += piece.size
+
+    def full(self):
+        return self.size >= self.budget
+
+    def take_runs(self):
+        # Every waiting piece, grouped into runs of consecutive indices that can go out in one write. They
+        # stay readable here until written, only one flush runs at a time so no run is taken twice.
+        runs = []
+        for index in sorted(self.pieces):
+            piece = self.pieces[index]
+            if runs and runs[-1][-1].index == index - 1:
+                runs[-1].append(piece)
+            else:
+                runs.append([piece])
+        return runs
+
+    def written(self, run):
+        for piece in run:
+            del self.pieces[piece.index]
+        self.size -= sum(piece.size for piece in run)
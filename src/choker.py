@@ -0,0 +1,85 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+DEFAULT_UNCHOKE_SLOTS = 4
+CHOKE_INTERVAL = 10
+OPTIMISTIC_INTERVAL = 30
+RATE_WINDOW = 20
+
+
+class RateMeter:
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.started = time.monotonic()
+        # [second, bytes] for each second that saw traffic, oldest first
+        self.samples = deque()
+        self.total = 0
+
+    def expire(self, second):
+        while self.samples and self.samples[0][0] <= second - self.window:
+            self.total -= self.samples.popleft()[1]
+
+    def add(self, amount):
+        second = int(time.monotonic())
+        if self.samples and self.samples[-1][0] == second:
+            self.samples[-1][1] += amount
+        else:
+            self.samples.append([second, amount])
+        self.total += amount
+        self.expire(second)
+
+    def rate(self):
+        # Bytes per second over the window, or over the connection's lifetime while that is shorter
+        now = time.monotonic()
+        self.expire(int(now))
+        return self.total / min(self.window, max(now - self.started, 1))
+
+
+class Choker:
+    def __init__(self, connection_manager, block_handler, slots=None):
+        self.connection_manager = connection_manager
+        self.block_handler = block_handler
+        # One of the slots is kept for the optimistic unchoke
+        self.slots = max(int(slots) if slots else DEFAULT_UNCHOKE_SLOTS, 1)
+        self.optimistic = None
+        self.last_optimistic = 0
+
+    def rate(self, peer, seeding):
+        # Leeching we reward the peers that give us the most, seeding those that take our data fastest
+        return peer.upload_rate.rate() if seeding else peer.download_rate.rate()
+
+    def choose(self, now):
+        interested = [peer for peer in self.connection_manager.peers.values() if peer.peer_interested == 1]
+        seeding = self.block_handler.is_complete()
+        # Peers already unchoked win ties, so equal rates do not make us flap
+        interested.sort(key=lambda peer: (self.rate(peer, seeding), peer.am_choking == 0), reverse=True)
+        regular = interested[:self.slots - 1]
+
+        others = [peer for peer in interested if peer not in regular]
+        if self.optimistic not in others or now - self.last_optimistic >= OPTIMISTIC_INTERVAL:
+            self.optimistic = random.choice(others) if others else None
+            self.last_optimistic = now
+
+        unchoked = set(regular)
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+        return unchoked
+
+    async def rechoke(self):
+        unchoked = self.choose(time.monotonic())
+        for peer in list(self.connection_manager.peers.values()):
+            try:
+                if peer in unchoked and peer.am_choking == 1:
+                    await peer.send_unchoke()
+                elif peer not in unchoked and peer.am_choking == 0:
+                    await peer.send_choke()
+            except ConnectionError:
+                # The peer's own task notices and closes it
+                pass
+
+    async def run(self):
+        while True:
+            await self.rechoke()
+            await asyncio.sleep(CHOKE_INTERVAL)
@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import random
+import time
+
+from peer import Peer
+
+DEFAULT_MAX_PEERS = 50
+MAX_HALF_OPEN = 16
+CONNECT_TIMEOUT = 10
+MANAGE_INTERVAL = 1
+# How often the slowest peer may be swapped for a fresh candidate, and how long a peer gets to prove itself
+REPLACE_INTERVAL = 30
+RETRY_BACKOFF = 30
+MAX_FAILURES = 5
+
+
+class Candidate:
+    __slots__ = ("address", "failures", "rate", "retry_at", "tiebreak")
+
+    def __init__(self, address):
+        self.address = address
+        self.failures = 0
+        # Best download rate seen from this address, in bytes per ms
+        self.rate = 0
+        self.retry_at = 0
+        self.tiebreak = random.random()
+
+    def score(self):
+        # Fast peers first, then those that failed least, ties broken at random
+        return self.rate, -self.failures, self.tiebreak
+
+    def failed(self, now):
+        self.failures += 1
+        self.retry_at = now + RETRY_BACKOFF * 2 ** (self.failures - 1)
+
+
+class ConnectionManager:
+    def __init__(self, torrent, max_peers=None, max_half_open=MAX_HALF_OPEN):
+        self.torrent = torrent
+        self.meta_info = torrent.meta_info
+        self.block_handler = torrent.block_handler
+        # What the torrent asked for, max_peers is that or less when a session shares out its connections
+        self.peer_limit = int(max_peers) if max_peers else DEFAULT_MAX_PEERS
+        self.max_peers = self.peer_limit
+        self.max_half_open = max_half_open
+        # (ip, port) -> Candidate
+        self.candidates = {}
+        # (ip, port) -> Peer
+        self.peers = {}
+        # (ip, port) of connections still being dialled
+        self.half_open = set()
+        self.dial_slots = asyncio.Semaphore(max_half_open)
+        self.last_replace = time.monotonic()
+        self.block_handler.piece_listeners.append(self.broadcast_have)
+
+    def add_candidates(self, addresses):
+        for address in addresses:
+            if address not in self.candidates:
+                self.candidates[address] = Candidate(address)
+
+    def eligible(self, now):
+        return [candidate for address, candidate in self.candidates.items()
+                if address not in self.peers and address not in self.half_open and candidate.retry_at <= now
+                and candidate.failures < MAX_FAILURES]
+
+    def add_peer(self, peer):
+        address = (peer.ip, peer.port)
+        if len(self.peers) >= self.max_peers or address in self.peers:
+            peer.close()
+            return False
+
+        self.peers[address] = peer
+        peer.task.add_done_callback(lambda _: self.peer_closed(address, peer))
+        return True
+
+    def peer_closed(self, address, peer):
+        if self.peers.get(address) is peer:
+            del self.peers[address]
+        self.block_handler.remove_peer(peer)
+
+        candidate = self.candidates.get(address)
+        if candidate is None:
+            return
+        candidate.rate = max(candidate.rate, peer.statistics["download_speed"])
+        if peer.data_received == 0:
+            # Never got as far as sending us anything useful
+            candidate.failed(time.monotonic())
+        else:
+            candidate.failures = 0
+            candidate.retry_at = time.monotonic() + RETRY_BACKOFF
+
+    def broadcast_have(self, index):
+        for peer in self.peers.values():
+            peer.send_have(index)
+
+    async def dial(self, address):
+        async with self.dial_slots:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                self.candidates[address].failed(time.monotonic())
+                return
+            finally:
+                self.half_open.discard(address)
+
+        peer = Peer(self.meta_info.id, self.meta_info.info_hash, self.meta_info.num_pieces, address[0], address[1],
+                    self.block_handler, (reader, writer), self.meta_info.pipeline_depth, outbound=True)
+        self.add_peer(peer)
+
+    def connect_more(self, now):
+        free = self.max_peers - len(self.peers) - len(self.half_open)
+        if free <= 0:
+            return
+
+        candidates = self.eligible(now)
+        if not candidates:
+            self.torrent.request_peers()
+            return
+
+        # Never queue more dials than can be half-open at once, the rest wait for the next round
+        count = min(free, self.max_half_open - len(self.half_open))
+        for candidate in heapq.nlargest(count, candidates, key=Candidate.score):
+            self.half_open.add(candidate.address)
+            asyncio.create_task(self.dial(candidate.address))
+
+    def replace_slowest(self, now):
+        if self.block_handler.is_complete() or len(self.peers) < self.max_peers or not self.eligible(now):
+            return
+
+        settled = [peer for peer in self.peers.values() if now - peer.connected_at > REPLACE_INTERVAL]
+        if settled:
+            slowest = min(settled, key=lambda peer: peer.statistics["download_speed"])
+            slowest.close()
+
+    def manage(self):
+        now = time.monotonic()
+        if now - self.last_replace >= REPLACE_INTERVAL:
+            self.last_replace = now
+            self.replace_slowest(now)
+        self.shed_excess()
+        self.connect_more(now)
+
+    async def run(self):
+        while True:
+            self.manage()
+            await asyncio.sleep(MANAGE_INTERVAL)
+
+    def shed_excess(self):
+        # The session may have cut our share of connections, drop the slowest peers down to it. Seeding, the
+        # slowest are those taking the least from us, as the choker ranks them.
+        excess = len(self.peers) - self.max_peers
+        if excess > 0:
+            seeding = self.block_handler.is_complete()
+            rate = self.torrent.choker.rate
+            for peer in heapq.nsmallest(excess, self.peers.values(), key=lambda peer: rate(peer, seeding)):
+                peer.close()
+
+    def close(self):
+        for peer in list(self.peers.values()):
+            peer.close()
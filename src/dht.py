@@ -0,0 +1,539 @@
+import asyncio
+import hashlib
+import heapq
+import logging
+import os
+import random
+import socket
+import struct
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+
+import bencode
+
+logger = logging.getLogger("bittorrent")
+
+# BEP 5: nodes per bucket, and lookups keep this many queries in flight
+K = 8
+ALPHA = 3
+QUERY_TIMEOUT = 2
+# A node not heard from in this long is questionable, and a bucket untouched for it is refreshed
+NODE_TIMEOUT = 15 * 60
+# Unanswered queries in a row before a node is dropped for a replacement
+MAX_FAILURES = 2
+TOKEN_ROTATION = 5 * 60
+PEER_TIMEOUT = 30 * 60
+MAX_PEERS_PER_TORRENT = 500
+MAX_TORRENTS = 5000
+# Peers given out in one get_peers response, so that it fits in a datagram
+MAX_VALUES = 50
+MAINTENANCE_INTERVAL = 60
+# Re-announce and look for more peers this often, sooner when the connection manager runs out
+SEARCH_INTERVAL = 15 * 60
+MIN_SEARCH_GAP = 60
+BOOTSTRAP_NODES = (("router.bittorrent.com", 6881), ("dht.transmissionbt.com", 6881), ("router.utorrent.com", 6881))
+ID_SPACE = 2 ** 160
+GENERIC_ERROR = 201
+PROTOCOL_ERROR = 203
+UNKNOWN_METHOD = 204
+
+
+class DHTError(Exception):
+    pass
+
+
+def check_id(value):
+    # Node ids, targets and info hashes are all 20 bytes, anything else is a protocol error
+    if not isinstance(value, bytes) or len(value) != 20:
+        raise ValueError("Not a 20 byte id")
+    return value
+
+
+def distance(a, b):
+    return int.from_bytes(a, "big") ^ int.from_bytes(b, "big")
+
+
+def compact_nodes(nodes):
+    return b''.join(node.id + socket.inet_aton(node.address[0]) + struct.pack("!H", node.address[1])
+                    for node in nodes)
+
+
+def parse_nodes(data):
+    nodes = []
+    for offset in range(0, len(data) - 25, 26):
+        ip = socket.inet_ntoa(data[offset + 20:offset + 24])
+        port = struct.unpack_from("!H", data, offset + 24)[0]
+        if port:
+            nodes.append(Node(bytes(data[offset:offset + 20]), (ip, port)))
+    return nodes
+
+
+def parse_peers(values):
+    peers = []
+    for value in values:
+        if isinstance(value, bytes) and len(value) == 6:
+            port = struct.unpack_from("!H", value, 4)[0]
+            if port:
+                peers.append((socket.inet_ntoa(value[:4]), port))
+    return peers
+
+
+class Node:
+    __slots__ = ("id", "address", "last_seen", "failures")
+
+    def __init__(self, node_id, address, last_seen=0):
+        self.id = node_id
+        self.address = address
+        self.last_seen = last_seen
+        self.failures = 0
+
+    def good(self, now):
+        return self.failures == 0 and now - self.last_seen < NODE_TIMEOUT
+
+
+class Bucket:
+    __slots__ = ("low", "high", "nodes", "replacements", "last_changed")
+
+    def __init__(self, low, high):
+        # Covers ids in [low, high)
+        self.low = low
+        self.high = high
+        # id -> Node, least recently seen first
+        self.nodes = OrderedDict()
+        # Nodes waiting for a place, newest last
+        self.replacements = OrderedDict()
+        self.last_changed = time.monotonic()
+
+    def covers(self, value):
+        return self.low <= value < self.high
+
+
+class RoutingTable:
+    def __init__(self, own_id):
+        self.own_id = own_id
+        self.own = int.from_bytes(own_id, "big")
+        self.buckets = [Bucket(0, ID_SPACE)]
+        # Lower bound of every bucket, for bisecting
+        self.lows = [0]
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def bucket_for(self, node_id):
+        return self.buckets[bisect_right(self.lows, int.from_bytes(node_id, "big")) - 1]
+
+    def split(self, bucket):
+        middle = (bucket.low + bucket.high) // 2
+        upper = Bucket(middle, bucket.high)
+        bucket.high = middle
+        for table in ("nodes", "replacements"):
+            for node_id, node in list(getattr(bucket, table).items()):
+                if int.from_bytes(node_id, "big") >= middle:
+                    del getattr(bucket, table)[node_id]
+                    getattr(upper, table)[node_id] = node
+        index = self.buckets.index(bucket) + 1
+        self.buckets.insert(index, upper)
+        self.lows.insert(index, middle)
+
+    def seen(self, node_id, address, now):
+        # A node we heard from. Returns a node worth pinging, the stalest one of a bucket it could not get into.
+        if node_id == self.own_id:
+            return None
+        while True:
+            bucket = self.bucket_for(node_id)
+            node = bucket.nodes.get(node_id)
+            if node:
+                node.address = address
+                node.last_seen = now
+                node.failures = 0
+                bucket.nodes.move_to_end(node_id)
+                bucket.last_changed = now
+                return None
+            if len(bucket.nodes) < K:
+                bucket.nodes[node_id] = Node(node_id, address, now)
+                bucket.replacements.pop(node_id, None)
+                bucket.last_changed = now
+                return None
+            # Only the bucket holding our own id splits, so the table stays finest around us
+            if bucket.covers(self.own) and bucket.high - bucket.low > K:
+                self.split(bucket)
+                continue
+            break
+
+        for stale in bucket.nodes.values():
+            if stale.failures >= MAX_FAILURES:
+                del bucket.nodes[stale.id]
+                bucket.nodes[node_id] = Node(node_id, address, now)
+                bucket.last_changed = now
+                return None
+        bucket.replacements.pop(node_id, None)
+        bucket.replacements[node_id] = Node(node_id, address, now)
+        if len(bucket.replacements) > K:
+            bucket.replacements.popitem(last=False)
+        oldest = next(iter(bucket.nodes.values()))
+        return None if oldest.good(now) else oldest
+
+    def failed(self, node_id):
+        bucket = self.bucket_for(node_id)
+        node = bucket.nodes.get(node_id)
+        if node is None:
+            return
+        node.failures += 1
+        if node.failures >= MAX_FAILURES and bucket.replacements:
+            del bucket.nodes[node_id]
+            _, replacement = bucket.replacements.popitem()
+            bucket.nodes[replacement.id] = replacement
+
+    def closest(self, target, count=K):
+        target = int.from_bytes(target, "big")
+        nodes = (node for bucket in self.buckets for node in bucket.nodes.values() if node.failures < MAX_FAILURES)
+        return heapq.nsmallest(count, nodes, key=lambda node: int.from_bytes(node.id, "big") ^ target)
+
+    def nodes(self):
+        return [node for bucket in self.buckets for node in bucket.nodes.values()]
+
+    def stale_buckets(self, now):
+        return [bucket for bucket in self.buckets if now - bucket.last_changed > NODE_TIMEOUT]
+
+
+class DHTProtocol(asyncio.DatagramProtocol):
+    def __init__(self, dht):
+        self.dht = dht
+
+    def datagram_received(self, data, addr):
+        self.dht.received(data, addr)
+
+    def error_received(self, exc):
+        # ICMP errors for some earlier datagram, the query it belonged to times out on its own
+        pass
+
+
+class DHT:
+    # A BEP 5 node. It answers other nodes, keeps a routing table of those it hears from and looks up and
+    # announces peers for our torrents.
+    def __init__(self, port=6881, state_file=None, bootstrap=BOOTSTRAP_NODES, host="0.0.0.0"):
+        self.port = port
+        self.host = host
+        self.state_file = state_file
+        self.bootstrap_nodes = bootstrap
+        self.node_id = os.urandom(20)
+        saved_nodes = []
+        if state_file:
+            saved_id, saved_nodes = self.load()
+            self.node_id = saved_id or self.node_id
+        # Tried before the bootstrap routers
+        self.saved_nodes = saved_nodes
+        self.table = RoutingTable(self.node_id)
+        # transaction id -> (future, address queried)
+        self.pending = {}
+        self.next_transaction = random.getrandbits(16)
+        # Tokens are a hash of the asker's ip and a secret, the previous secret is still honoured
+        self.secrets = [os.urandom(8), os.urandom(8)]
+        self.secret_changed = time.monotonic()
+        # info_hash -> {(ip, port): time announced}
+        self.peers = {}
+        self.transport = None
+        self.maintenance_task = None
+        self.ready = asyncio.Event()
+        self.queries_sent = 0
+        self.queries_received = 0
+        self.timeouts = 0
+
+    def load(self):
+        try:
+            with open(self.state_file, "rb") as f:
+                state = bencode.decode(f.read())
+            node_id = state[b'id']
+            return (node_id if len(node_id) == 20 else None), [node.address for node in parse_nodes(state[b'nodes'])]
+        except (OSError, bencode.BencodeError, KeyError, TypeError):
+            return None, []
+
+    def save(self):
+        if not self.state_file:
+            return
+        now = time.monotonic()
+        nodes = sorted(self.table.nodes(), key=lambda node: (not node.good(now), node.failures))
+        tmp_path = self.state_file + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(bencode.encode({b'id': self.node_id, b'nodes': compact_nodes(nodes)}))
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logger.error("DHT state not saved: %s", e)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: DHTProtocol(self),
+                                                                local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info("sockname")[1]
+        self.maintenance_task = asyncio.create_task(self.maintain())
+
+    def close(self):
+        if self.maintenance_task:
+            self.maintenance_task.cancel()
+        for waiter, _ in self.pending.values():
+            if not waiter.done():
+                waiter.cancel()
+        self.pending.clear()
+        if self.transport:
+            self.save()
+            self.transport.close()
+            self.transport = None
+
+    def send(self, message, address):
+        if self.transport:
+            self.transport.sendto(bencode.encode(message), address)
+
+    async def query(self, address, method, args):
+        # The response's arguments, None if the node did not answer in time
+        self.next_transaction = (self.next_transaction + 1) & 0xffff
+        transaction = struct.pack("!H", self.next_transaction)
+        waiter = asyncio.get_running_loop().create_future()
+        self.pending[transaction] = (waiter, address)
+        self.queries_sent += 1
+        self.send({b't': transaction, b'y': b'q', b'q': method, b'a': {b'id': self.node_id, **args}}, address)
+        try:
+            return await asyncio.wait_for(waiter, QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None
+        except DHTError:
+            return None
+        finally:
+            self.pending.pop(transaction, None)
+
+    async def query_node(self, node, method, args):
+        response = await self.query(node.address, method, args)
+        if response is None:
+            self.table.failed(node.id)
+        return node, response
+
+    def received(self, data, address):
+        try:
+            message = bencode.decode(data)
+            kind = message[b'y']
+            transaction = message[b't']
+            # Anything else is dropped, a transaction id has to be hashable to be looked up
+            if not isinstance(transaction, bytes) or kind not in (b'q', b'r', b'e'):
+                return
+        except (bencode.BencodeError, KeyError, TypeError):
+            return
+        if kind == b'q':
+            self.queries_received += 1
+            self.on_query(message, transaction, address)
+            return
+        pending = self.pending.get(transaction)
+        # Answers only from the address that was asked, anyone else could be guessing transaction ids
+        if pending is None or pending[1] != address or pending[0].done():
+            return
+        waiter = pending[0]
+        if kind == b'r':
+            response = message.get(b'r')
+            node_id = response.get(b'id') if isinstance(response, bencode.Dict) else None
+            if not isinstance(node_id, bytes) or len(node_id) != 20:
+                waiter.set_exception(DHTError("Malformed response"))
+                return
+            self.node_seen(node_id, address)
+            waiter.set_result(response)
+        else:
+            waiter.set_exception(DHTError(f"Error response {message.get(b'e')!r}"))
+
+    def node_seen(self, node_id, address):
+        stale = self.table.seen(node_id, address, time.monotonic())
+        if stale:
+            # Whether the bucket's oldest node is still there decides if the new one gets its place
+            asyncio.ensure_future(self.query_node(stale, b'ping', {}))
+
+    def on_query(self, message, transaction, address):
+        try:
+            method = message[b'q']
+            args = message[b'a']
+            node_id = check_id(args[b'id'])
+            handler = self.handlers.get(method)
+            if handler is None:
+                self.send({b't': transaction, b'y': b'e', b'e': [UNKNOWN_METHOD, b'Method Unknown']}, address)
+                return
+            response = handler(self, args, address)
+        except (KeyError, TypeError, ValueError, AttributeError, bencode.BencodeError):
+            self.send({b't': transaction, b'y': b'e', b'e': [PROTOCOL_ERROR, b'Protocol Error']}, address)
+            return
+        except DHTError as e:
+            self.send({b't': transaction, b'y': b'e', b'e': [GENERIC_ERROR, str(e).encode()]}, address)
+            return
+        self.node_seen(node_id, address)
+        self.send({b't': transaction, b'y': b'r', b'r': {b'id': self.node_id, **response}}, address)
+
+    def token(self, ip, secret=None):
+        return hashlib.sha1((secret or self.secrets[0]) + socket.inet_aton(ip)).digest()[:8]
+
+    def on_ping(self, args, address):
+        return {}
+
+    def on_find_node(self, args, address):
+        return {b'nodes': compact_nodes(self.table.closest(check_id(args[b'target'])))}
+
+    def on_get_peers(self, args, address):
+        info_hash = check_id(args[b'info_hash'])
+        response = {b'token': self.token(address[0])}
+        peers = self.peers.get(info_hash)
+        if peers:
+            sample = random.sample(list(peers), min(len(peers), MAX_VALUES))
+            response[b'values'] = [socket.inet_aton(ip) + struct.pack("!H", port) for ip, port in sample]
+        else:
+            response[b'nodes'] = compact_nodes(self.table.closest(info_hash))
+        return response
+
+    def on_announce_peer(self, args, address):
+        if args[b'token'] not in (self.token(address[0], secret) for secret in self.secrets):
+            raise DHTError("Bad token")
+        info_hash = check_id(args[b'info_hash'])
+        port = address[1] if args.get(b'implied_port') else args[b'port']
+        if not 0 < port < 65536:
+            raise ValueError
+        if info_hash not in self.peers and len(self.peers) >= MAX_TORRENTS:
+            raise DHTError("Too many torrents")
+        peers = self.peers.setdefault(info_hash, {})
+        peers.pop((address[0], port), None)
+        peers[(address[0], port)] = time.monotonic()
+        if len(peers) > MAX_PEERS_PER_TORRENT:
+            del peers[next(iter(peers))]
+        return {}
+
+    handlers = {b'ping': on_ping, b'find_node': on_find_node, b'get_peers': on_get_peers,
+                b'announce_peer': on_announce_peer}
+
+    async def lookup(self, target, method=b'find_node', start=()):
+        # Iterative lookup: the closest nodes not yet asked are queried ALPHA at a time, each answer bringing
+        # closer ones, until the K closest that answered have all been asked.
+        # Returns the peers found and the closest nodes that answered, with their tokens.
+        key = "info_hash" if method == b'get_peers' else "target"
+        args = {key.encode(): target}
+        target_value = int.from_bytes(target, "big")
+        # id -> Node still in the running
+        shortlist = {node.id: node for node in (*self.table.closest(target, K * 2), *start)}
+        asked = set()
+        # id -> (Node, response)
+        answered = {}
+        peers = set()
+        running = set()
+        try:
+            while True:
+                best = heapq.nsmallest(K, shortlist.values(),
+                                       key=lambda node: int.from_bytes(node.id, "big") ^ target_value)
+                for node in best:
+                    if len(running) >= ALPHA:
+                        break
+                    if node.id not in asked:
+                        asked.add(node.id)
+                        running.add(asyncio.ensure_future(self.query_node(node, method, args)))
+                if not running:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node, response = task.result()
+                    if response is None:
+                        shortlist.pop(node.id, None)
+                        continue
+                    answered[node.id] = (node, response)
+                    nodes = response.get(b'nodes')
+                    if isinstance(nodes, bytes):
+                        for found in parse_nodes(nodes):
+                            if found.id != self.node_id and found.id not in asked:
+                                shortlist.setdefault(found.id, found)
+                    values = response.get(b'values')
+                    if isinstance(values, list):
+                        peers.update(parse_peers(values))
+        finally:
+            for task in running:
+                task.cancel()
+        closest = heapq.nsmallest(K, answered.values(), key=lambda pair: distance(pair[0].id, target))
+        return peers, closest
+
+    async def bootstrap(self):
+        # Ask the saved nodes, then the routers if that found nobody, for the nodes nearest our own id
+        loop = asyncio.get_running_loop()
+        for addresses in (self.saved_nodes, self.bootstrap_nodes):
+            resolved = []
+            for host, port in addresses:
+                try:
+                    infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                except OSError:
+                    continue
+                resolved.extend(info[4][:2] for info in infos[:1])
+            responses = await asyncio.gather(*(self.query(address, b'find_node', {b'target': self.node_id})
+                                               for address in resolved))
+            start = [node for response in responses if response and isinstance(response.get(b'nodes'), bytes)
+                     for node in parse_nodes(response[b'nodes']) if node.id != self.node_id]
+            if start or len(self.table):
+                await self.lookup(self.node_id, start=start)
+            if len(self.table):
+                break
+        self.ready.set()
+
+    async def maintain(self):
+        await self.bootstrap()
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            now = time.monotonic()
+            if now - self.secret_changed >= TOKEN_ROTATION:
+                self.secrets = [os.urandom(8), self.secrets[0]]
+                self.secret_changed = now
+            for info_hash in list(self.peers):
+                peers = self.peers[info_hash]
+                for address in [address for address, seen in peers.items() if now - seen > PEER_TIMEOUT]:
+                    del peers[address]
+                if not peers:
+                    del self.peers[info_hash]
+            if not len(self.table):
+                await self.bootstrap()
+            for bucket in self.table.stale_buckets(now):
+                # A random id in the bucket's range finds whoever lives there now
+                bucket.last_changed = now
+                target = random.randrange(bucket.low, bucket.high).to_bytes(20, "big")
+                await self.lookup(target)
+            self.save()
+
+    async def get_peers(self, info_hash, announce_port=None):
+        # Peers for the torrent, and our own address announced to the nodes nearest it if a port is given
+        await self.ready.wait()
+        peers, closest = await self.lookup(info_hash, b'get_peers')
+        if announce_port is not None:
+            args = {b'info_hash': info_hash, b'port': announce_port}
+            await asyncio.gather(*(self.query(node.address, b'announce_peer', {**args, b'token': response[b'token']})
+                                   for node, response in closest if isinstance(response.get(b'token'), bytes)))
+        return list(peers)
+
+    def metrics(self):
+        return {"nodes": len(self.table), "buckets": len(self.table.buckets), "torrents": len(self.peers),
+                "stored_peers": sum(len(peers) for peers in self.peers.values()),
+                "queries_sent": self.queries_sent, "queries_received": self.queries_received,
+                "timeouts": self.timeouts}
+
+
+class DHTSearch:
+    # Keeps looking a torrent up in the DHT, the way TrackerClient keeps announcing it
+    def __init__(self, dht, info_hash, port):
+        self.dht = dht
+        self.info_hash = info_hash
+        self.port = port
+        self.wakeup = asyncio.Event()
+        self.last_search = 0
+
+    def request_peers(self):
+        self.wakeup.set()
+
+    async def run(self, on_peers):
+        while True:
+            self.last_search = time.monotonic()
+            peers = await self.dht.get_peers(self.info_hash, self.port)
+            if peers:
+                on_peers(peers)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), SEARCH_INTERVAL)
+                remaining = self.last_search + MIN_SEARCH_GAP - time.monotonic()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,55 @@
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from stats import Histogram
+
+
+def sha1_digest(data):
+    return hashlib.sha1(data).digest()
+
+
+class Hasher:
+    def __init__(self, workers=None, processes=False, max_pending=None):
+        self.workers = int(workers) if workers else os.cpu_count() or 1
+        # hashlib drops the GIL on large buffers, so threads already hash in parallel and without copying the
+        # piece. Processes cost a copy per piece but keep the hashing clear of everything else in the interpreter.
+        self.processes = processes
+        if processes:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hasher")
+        # Pieces queued or being hashed. Past this callers wait, which stalls the peers feeding them
+        # rather than letting finished pieces pile up in memory.
+        self.slots = asyncio.Semaphore(int(max_pending) if max_pending else self.workers * 2)
+        self.pieces = 0
+        self.bytes = 0
+        # Seconds spent waiting for a slot and in the pool, summed over pieces
+        self.wait_time = 0
+        self.hash_time = 0
+        # Seconds from asking for a digest to getting it, queueing included
+        self.latency = Histogram()
+
+    async def digest(self, data):
+        loop = asyncio.get_running_loop()
+        queued = time.monotonic()
+        async with self.slots:
+            started = time.monotonic()
+            self.wait_time += started - queued
+            digest = await loop.run_in_executor(self.executor, sha1_digest, bytes(data) if self.processes else data)
+            self.hash_time += time.monotonic() - started
+        self.latency.observe(time.monotonic() - queued)
+        self.pieces += 1
+        self.bytes += len(data)
+        return digest
+
+    def metrics(self):
+        return {"pieces": self.pieces, "bytes": self.bytes, "wait_time": round(self.wait_time, 3),
+                "hash_time": round(self.hash_time, 3),
+                "throughput": round(self.bytes / self.hash_time) if self.hash_time else 0,
+                "latency_seconds": self.latency.metrics()}
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
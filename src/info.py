@@ -1,21 +1,40 @@
+import hashlib
 import os
 
-import bencodepy
+import bencode
+from utils import FileIndex, generate_peer_id
+
+
+class PieceHashes:
+    # The SHA-1 of every piece, as views into the pieces string of the torrent file
+    __slots__ = ("view",)
+
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view) // 20
+
+    def __getitem__(self, index):
+        return self.view[index * 20:index * 20 + 20]
 
 
 class MetaInfo:
-    def __init__(self, file, location=None, max_download=None, max_peers=None):
+    def __init__(self, file, location=None, max_download=None, max_peers=None, pipeline_depth=None, max_upload=None,
+                 max_peer_download=None, max_peer_upload=None):
         self.file = file
         self.left = 0
         self.downloaded = 0
         self.uploaded = 0
-        self.id = ""
-        self.info_hash = ""
-        self.peers = set()
+        self.id = generate_peer_id()
         with open(self.file, "rb") as f:
-            self.data = bencodepy.decode(f.read())
+            self.data = bencode.decode(f.read())
+        # Known before any announce, inbound connections are routed by it. Hashed from the bytes in the
+        # file, a re-encoding would differ for a torrent that is not quite canonical.
+        self.info_hash = hashlib.sha1(self.data.raw(b'info')).digest()
 
-        self.num_pieces = int(len(self.data[b'info'][b'pieces']) / 20)
+        self.pieces = PieceHashes(self.data[b'info'].view(b'pieces'))
+        self.num_pieces = len(self.pieces)
 
         if b'announce-list' in self.data:
             self.trackers = self.data[b'announce-list']
@@ -25,27 +44,30 @@ class MetaInfo:
             self.trackers = [self.trackers]
         self.mode = 1 if b'files' in self.data[b'info'].keys() else 0
 
-        if self.mode == 0:
-            self.length = self.data[b'info'][b'length']
+        self.files = []
+        if self.mode == 1:
+            # One pass over the file list, a torrent may list hundreds of thousands of files
+            for file in self.data[b'info'].plain(b'files'):
+                self.files.append({"path": file[b'path'], "length": file[b'length'], "downloaded": 0})
+            self.length = sum(file["length"] for file in self.files)
         else:
-            temp_len = 0
-            for item in self.data[b'info'][b'files']:
-                temp_len += item[b'length']
-            self.length = temp_len
+            self.length = self.data[b'info'][b'length']
+            self.files.append({"path": [self.data[b'info'][b'name']], "length": self.length, "downloaded": 0})
 
         if self.mode == 1:
             self.path = os.path.join(location if location else os.getcwd(), self.data[b'info'][b'name'].decode())
-            os.mkdir(self.path)
+            os.makedirs(self.path, exist_ok=True)
         else:
             self.path = location if location else os.getcwd()
+        self.resume_file = os.path.join(location if location else os.getcwd(),
+                                        f".{self.data[b'info'][b'name'].decode()}.resume")
 
-        self.files = []
-        if self.mode == 1:
-            for file in self.data[b'info'][b'files']:
-                self.files.append(
-                    {"path": file[b'path'], "length": file[b'length'], "downloaded": 0})
-        else:
-            self.files.append([self.data[b'info'][b'name']])
+        self.file_index = FileIndex(self.files, self.data[b'info'][b'piece length'])
 
-        self.max_download = max_download if max_download else 10000007
-        self.max_peers = max_peers if max_peers else 10000007
+        # KB/s, None for no limit
+        self.max_download = max_download
+        self.max_upload = max_upload
+        self.max_peer_download = max_peer_download
+        self.max_peer_upload = max_peer_upload
+        self.max_peers = max_peers
+        self.pipeline_depth = pipeline_depth
@@ -1,31 +1,98 @@
 import argparse
 import asyncio
+import logging
+import os
 import sys
 
-from torrent import Torrent
+from cache import READ_CACHE_BUDGET, WRITE_CACHE_BUDGET
+from profiler import SAMPLE_INTERVAL, profiling
+from seed import LISTEN_PORT
+from session import Session
+from supervisor import Supervisor
+
+logger = logging.getLogger("bittorrent")
 
 
 def exception_handler(loop, context):
-    # Log errors here
-    pass
+    # Errors nobody awaited, from callbacks and abandoned tasks. A peer dropping its connection is routine.
+    exception = context.get("exception")
+    level = logging.DEBUG if isinstance(exception, (ConnectionError, asyncio.CancelledError)) else logging.ERROR
+    logger.log(level, context.get("message", "Unhandled error in the event loop"),
+               exc_info=(type(exception), exception, exception.__traceback__) if exception else None)
+
+
+async def run_session(args):
+    cache_budget = int(float(args.cache_size) * 2 ** 20) if args.cache_size else READ_CACHE_BUDGET
+    write_cache_budget = int(float(args.write_cache) * 2 ** 20) if args.write_cache else WRITE_CACHE_BUDGET
+    # The DHT listens on UDP at the same port number as the peers' TCP listener unless told otherwise
+    dht_port = None if args.no_dht else int(args.dht_port if args.dht_port is not None else args.port)
+    dht_state = args.dht_state if args.dht_state else os.path.join(args.location or os.getcwd(), ".dht")
+    if args.workers:
+        supervisor = Supervisor(args.files, args.workers, args.location, int(args.port), args.max_connections,
+                                args.max_download, args.max_upload, cache_budget, args.hash_workers,
+                                args.hash_processes, write_cache_budget, max_peers=args.max_peers,
+                                pipeline_depth=args.pipeline_depth, recheck=args.recheck,
+                                max_peer_download=args.max_peer_download, max_peer_upload=args.max_peer_upload,
+                                unchoke_slots=args.unchoke_slots, sequential=args.sequential, seed=not args.no_seed,
+                                stats_port=args.stats_port, stats_file=args.stats_file, dht_port=dht_port,
+                                dht_state=dht_state)
+        await supervisor.run()
+        return
+
+    session = Session(int(args.port), args.max_connections, args.max_download, args.max_upload, cache_budget,
+                      hash_workers=args.hash_workers, hash_processes=args.hash_processes,
+                      write_cache_budget=write_cache_budget, stats_port=args.stats_port, stats_file=args.stats_file,
+                      dht_port=dht_port, dht_state=dht_state)
+    for file in args.files:
+        session.add(file, args.location, max_peers=args.max_peers, pipeline_depth=args.pipeline_depth,
+                    recheck=args.recheck, max_peer_download=args.max_peer_download,
+                    max_peer_upload=args.max_peer_upload, unchoke_slots=args.unchoke_slots,
+                    sequential=args.sequential, seed=not args.no_seed)
+    await session.run()
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='BitTorrent Client')
-    parser.add_argument("file", help="Define location to store")
+    parser.add_argument("files", nargs="+", help="Torrent files to download, all in one session")
     parser.add_argument("-l", "--location", help="Define location to store")
-    parser.add_argument("-md", "--max-download", help="Define location to store")
-    parser.add_argument("-mp", "--max-peers", help="Define location to store")
+    parser.add_argument("-md", "--max-download", help="Download limit for the whole session in KB/s")
+    parser.add_argument("-mu", "--max-upload", help="Upload limit for the whole session in KB/s")
+    parser.add_argument("--max-peer-download", help="Download limit for each peer in KB/s")
+    parser.add_argument("--max-peer-upload", help="Upload limit for each peer in KB/s")
+    parser.add_argument("-mp", "--max-peers", help="Maximum number of peers for each torrent")
+    parser.add_argument("--max-connections", help="Maximum number of peers for the whole session")
+    parser.add_argument("--cache-size", help="Read cache for the whole session in MB")
+    parser.add_argument("--write-cache", help="Verified pieces held back to be written together, in MB")
+    parser.add_argument("-p", "--port", default=LISTEN_PORT, help="Port to accept connections on")
+    parser.add_argument("-pd", "--pipeline-depth", help="Maximum number of block requests in flight per peer")
+    parser.add_argument("--unchoke-slots", help="Number of peers we upload to at once, one of them optimistic")
+    parser.add_argument("--hash-workers", help="Threads or processes hashing pieces, one per core by default")
+    parser.add_argument("--hash-processes", action="store_true", help="Hash pieces in processes instead of threads")
+    parser.add_argument("-w", "--workers", help="Spread the torrents over this many processes")
+    parser.add_argument("--sequential", action="store_true", help="Download in order, for playing files as they arrive")
+    parser.add_argument("--no-seed", action="store_true", help="Exit once every torrent is downloaded")
+    parser.add_argument("--no-dht", action="store_true", help="Find peers through the trackers only")
+    parser.add_argument("--dht-port", help="UDP port of the DHT node, the listening port by default")
+    parser.add_argument("--dht-state", help="File the DHT node id and known nodes are kept in between runs")
+    parser.add_argument("--stats-port", help="Serve metrics on this local port, Prometheus at /metrics and JSON")
+    parser.add_argument("--stats-file", help="Write the metrics as JSON to this file every few seconds")
+    parser.add_argument("--profile", help="Run under cProfile and save the stats to this file, main process only")
+    parser.add_argument("--sample", help="Sample the event loop's stack and save the stacks collapsed to this file")
+    parser.add_argument("--sample-interval", type=float, default=SAMPLE_INTERVAL * 1000,
+                        help="Milliseconds between samples")
+    parser.add_argument("--recheck", action="store_true", help="Hash the existing data instead of trusting the resume file")
 
     args = parser.parse_args()
+    # Below the progress bar's line rather than through it
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format="\n%(asctime)s %(levelname)s %(message)s")
 
-    a = Torrent(args.file, args.location, args.max_download, args.max_peers)
     event_loop = asyncio.get_event_loop()
-    task = event_loop.create_task(a.torrent_start())
+    task = event_loop.create_task(run_session(args))
 
     try:
         event_loop.set_exception_handler(exception_handler)
-        event_loop.run_until_complete(task)
+        with profiling(args.profile, args.sample, args.sample_interval / 1000):
+            event_loop.run_until_complete(task)
     except asyncio.CancelledError:
         print('Event loop was canceled')
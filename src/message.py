@@ -0,0 +1,177 @@
+import asyncio
+import struct
+from collections import namedtuple
+
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+PORT = 9
+
+HANDSHAKE_LENGTH = 68
+# How long a peer may stall in the middle of a message before the stream is given up on
+FRAME_TIMEOUT = 60.0
+# Large enough for a 16 KiB block or the bitfield of a torrent with millions of pieces
+MAX_MESSAGE_LENGTH = 2 ** 21
+
+
+class Handshake(namedtuple("Handshake", ["info_hash", "peer_id"])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!b19sq20s20s", 19, "BitTorrent protocol".encode(), 0, self.info_hash, self.peer_id)
+
+    @classmethod
+    def decode(cls, data):
+        decoded_msg = struct.unpack("!b19sq20s20s", data)
+        return cls(decoded_msg[3], decoded_msg[4])
+
+
+class KeepAlive(namedtuple("KeepAlive", [])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!i", 0)
+
+
+class Choke(namedtuple("Choke", [])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ib", 1, CHOKE)
+
+
+class Unchoke(namedtuple("Unchoke", [])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ib", 1, UNCHOKE)
+
+
+class Interested(namedtuple("Interested", [])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ib", 1, INTERESTED)
+
+
+class NotInterested(namedtuple("NotInterested", [])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ib", 1, NOT_INTERESTED)
+
+
+class Have(namedtuple("Have", ["index"])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ibi", 5, HAVE, self.index)
+
+
+class Bitfield(namedtuple("Bitfield", ["bitfield"])):
+    __slots__ = ()
+
+    def header(self):
+        return struct.pack("!ib", 1 + len(self.bitfield), BITFIELD)
+
+    def encode(self):
+        return self.header() + bytes(self.bitfield)
+
+
+class Request(namedtuple("Request", ["index", "begin", "length"])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ibiii", 13, REQUEST, self.index, self.begin, self.length)
+
+
+class Block(namedtuple("Block", ["index", "begin", "data"])):
+    # The piece message, data is a memoryview into the received frame
+    __slots__ = ()
+
+    def header(self):
+        return struct.pack("!ibii", 9 + len(self.data), PIECE, self.index, self.begin)
+
+    def encode(self):
+        return self.header() + bytes(self.data)
+
+
+class Cancel(namedtuple("Cancel", ["index", "begin", "length"])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ibiii", 13, CANCEL, self.index, self.begin, self.length)
+
+
+class Port(namedtuple("Port", ["port"])):
+    __slots__ = ()
+
+    def encode(self):
+        return struct.pack("!ibH", 3, PORT, self.port)
+
+
+class Unknown(namedtuple("Unknown", ["msg_id", "payload"])):
+    __slots__ = ()
+
+
+def decode(frame):
+    # frame is the message without its length prefix. Payloads are views into it, not copies.
+    msg_id = frame[0]
+    payload = memoryview(frame)[1:]
+    if msg_id == CHOKE:
+        return Choke()
+    elif msg_id == UNCHOKE:
+        return Unchoke()
+    elif msg_id == INTERESTED:
+        return Interested()
+    elif msg_id == NOT_INTERESTED:
+        return NotInterested()
+    elif msg_id == HAVE:
+        return Have(*struct.unpack_from("!i", frame, 1))
+    elif msg_id == BITFIELD:
+        return Bitfield(payload)
+    elif msg_id == REQUEST:
+        return Request(*struct.unpack_from("!iii", frame, 1))
+    elif msg_id == PIECE:
+        index, begin = struct.unpack_from("!ii", frame, 1)
+        return Block(index, begin, payload[8:])
+    elif msg_id == CANCEL:
+        return Cancel(*struct.unpack_from("!iii", frame, 1))
+    elif msg_id == PORT:
+        return Port(*struct.unpack_from("!H", frame, 1))
+    return Unknown(msg_id, payload)
+
+
+class MessageReader:
+    def __init__(self, reader, throttle=None):
+        self.reader = reader
+        # Awaited with the size of each frame before it is read, so a rate limit holds back the socket itself
+        self.throttle = throttle
+
+    async def read_handshake(self, timeout):
+        data = await asyncio.wait_for(self.reader.readexactly(HANDSHAKE_LENGTH), timeout)
+        return Handshake.decode(data)
+
+    async def read_message(self, timeout):
+        # Only the length prefix is read under the timeout. A cancelled readexactly consumes
+        # nothing, so an idle peer never leaves us out of step with the stream.
+        prefix = await asyncio.wait_for(self.reader.readexactly(4), timeout)
+        msg_len = struct.unpack("!I", prefix)[0]
+        if msg_len == 0:
+            return KeepAlive()
+        if msg_len > MAX_MESSAGE_LENGTH:
+            raise ValueError(f"Message of {msg_len} bytes is too large")
+        if self.throttle:
+            await self.throttle(msg_len)
+
+        try:
+            frame = await asyncio.wait_for(self.reader.readexactly(msg_len), FRAME_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError("Peer stalled in the middle of a message")
+        return decode(frame)
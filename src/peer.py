@@ -1,225 +1,332 @@
 import asyncio
-import struct
+import logging
+import math
 import time
+from collections import OrderedDict
 
-import bitstring
-
+from bitfield import Bitfield as PieceBitfield
+from choker import RateMeter
+from message import Bitfield, Block, Cancel, Choke, Handshake, Have, Interested, MessageReader, NotInterested, \
+    Request, Unchoke
+from rate_limiter import RateLimiter, acquire
 from utils import send_interested_message
 
+logger = logging.getLogger("bittorrent")
+
+BLOCK_SIZE = 2 ** 14
+MIN_PIPELINE_DEPTH = 2
+MAX_PIPELINE_DEPTH = 64
+# Requests beyond this are dropped rather than queued, as are blocks larger than any client asks for
+MAX_UPLOAD_QUEUE = 256
+MAX_REQUEST_LENGTH = 2 ** 17
+
 
 class Peer:
-    def __init__(self, peer_id, info_hash, num_pieces, ip, port, block_handler, peer=None):
+    def __init__(self, peer_id, info_hash, num_pieces, ip, port, block_handler, peer=None, pipeline_depth=None,
+                 outbound=False, handshake=None):
         self.ip = ip
         self.port = port
         self.am_choking = 1
         self.am_interested = 0
         self.peer_choking = 1
         self.peer_interested = 0
-        self.downloading = 0
+        # (index, begin) -> time the request was sent in ms
+        self.outstanding = {}
+        self.max_pipeline_depth = int(pipeline_depth) if pipeline_depth else MAX_PIPELINE_DEPTH
+        self.pipeline_depth = min(MIN_PIPELINE_DEPTH, self.max_pipeline_depth)
         self.__info_hash = info_hash
         self.__id = peer_id
         self.remote_id = ''
         self.num_pieces = num_pieces
         self.block_handler = block_handler
         self.task = asyncio.ensure_future(self.start())
+        self.connected_at = time.monotonic()
         self.data_downloaded = 0
-        self.statistics = {"send_time": 0, "receive_time": 0, "download_speed": 0, "prev_download_speed": 0}
+        self.data_received = 0
+        self.data_uploaded = 0
+        # Rolling rates the choker ranks peers by
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        # (index, begin, length) of blocks the peer asked for, in the order they arrived
+        self.upload_queue = OrderedDict()
+        self.upload_ready = asyncio.Event()
+        self.upload_task = None
+        # This peer's own bucket, then the torrent's and any the session shares between torrents
+        self.download_limiters = (RateLimiter(block_handler.peer_download_rate),) + block_handler.download_limiters
+        self.upload_limiters = (RateLimiter(block_handler.peer_upload_rate),) + block_handler.upload_limiters
+        self.statistics = {"download_speed": 0, "prev_download_speed": 0, "rtt": 0, "window_start": 0,
+                           "window_bytes": 0}
         self.reader = peer[0] if peer else None
         self.writer = peer[1] if peer else None
+        # Whether we opened the connection and so send the first handshake
+        self.outbound = outbound or peer is None
+        # The remote handshake of an inbound connection, when the listener already read it to route the connection
+        self.remote_handshake = handshake
+        self.messages = MessageReader(self.reader, self.throttle_download) if self.reader else None
+        self.handlers = {Choke: self.on_choke, Unchoke: self.on_unchoke, Interested: self.on_interested,
+                         NotInterested: self.on_not_interested, Have: self.on_have, Bitfield: self.on_bitfield,
+                         Request: self.on_request, Block: self.on_block, Cancel: self.on_cancel}
 
-    async def handshake(self, reader, writer):
-        msg = struct.pack("!b19sq20s20s", 19, "BitTorrent protocol".encode(), 0, self.__info_hash, self.__id.encode())
+    def metrics(self):
+        return {"id": f"{self.ip}:{self.port}", "downloaded": self.data_received, "uploaded": self.data_uploaded,
+                "download_rate": round(self.download_rate.rate()), "upload_rate": round(self.upload_rate.rate()),
+                "rtt_seconds": self.statistics["rtt"] / 1000, "outstanding_requests": len(self.outstanding),
+                "pipeline_depth": self.pipeline_depth, "upload_queue": len(self.upload_queue),
+                "am_choking": self.am_choking, "am_interested": self.am_interested,
+                "peer_choking": self.peer_choking, "peer_interested": self.peer_interested}
 
-        writer.write(msg)
-        await writer.drain()
-
-        resp_buffer = b''
-        tries = 0
-        while len(resp_buffer) < 68 and tries < 10:
-            data = await reader.read(65535)
-            if data:
-                resp_buffer += data
-            tries += 1
+    async def handshake(self):
+        self.writer.write(Handshake(self.__info_hash, self.__id.encode()).encode())
+        await self.writer.drain()
 
-        if tries >= 10:
-            writer.close()
-            self.task.cancel()
-            return None
+        handshake = await self.messages.read_handshake(10.0)
+        if handshake.info_hash != self.__info_hash:
+            return False
 
-        decoded_msg = struct.unpack("!b19sq20s20s", resp_buffer[:68])
-        if decoded_msg[3] != self.__info_hash:
-            writer.close()
-            self.task.cancel()
-            return None
+        self.remote_id = handshake.peer_id
+        return True
 
-        self.remote_id = decoded_msg[4]
-        return resp_buffer[68:]
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.upload_task:
+            self.upload_task.cancel()
+        self.task.cancel()
 
     async def send_unchoke(self):
-        if self.peer_interested == 1:
-            self.am_choking = 0
-            msg = struct.pack("!ib", 1, 1)
-            self.writer.write(msg)
-            await self.writer.drain()
+        self.am_choking = 0
+        self.writer.write(Unchoke().encode())
+        await self.writer.drain()
 
     async def send_choke(self):
         self.am_choking = 1
-        msg = struct.pack("!ib", 1, 0)
-        self.writer.write(msg)
+        # Choking discards whatever the peer has asked for so far
+        self.upload_queue.clear()
+        self.writer.write(Choke().encode())
         await self.writer.drain()
 
-    def download_speed(self):
+    def download_speed(self, now):
+        # Bytes per ms, sampled over roughly one second so that it reflects the whole pipeline
+        if self.statistics["window_start"] == 0:
+            self.statistics["window_start"] = now
+        self.statistics["window_bytes"] += self.data_downloaded
+        elapsed = now - self.statistics["window_start"]
+        if elapsed < 1000:
+            return
+
         self.statistics["prev_download_speed"] = self.statistics["prev_download_speed"] if \
             self.statistics["download_speed"] == 0 else self.statistics["download_speed"]
 
-        self.statistics["download_speed"] = max(0.0, self.data_downloaded / (
-                self.statistics["receive_time"] - self.statistics["send_time"]))
+        self.statistics["download_speed"] = self.statistics["window_bytes"] / elapsed
+        self.statistics["window_bytes"] = 0
+        self.statistics["window_start"] = now
+
+    def update_pipeline_depth(self, rtt):
+        # The smallest round trip seen is the best estimate of the link delay without our own queueing
+        self.statistics["rtt"] = rtt if self.statistics["rtt"] == 0 else min(self.statistics["rtt"], rtt)
+        bdp = self.statistics["download_speed"] * max(self.statistics["rtt"], 1)
+        # Keep twice the bandwidth-delay product in flight so a saturated window keeps growing
+        depth = math.ceil(2 * bdp / BLOCK_SIZE) + 1
+        self.pipeline_depth = max(MIN_PIPELINE_DEPTH, min(self.max_pipeline_depth, depth))
+
+    async def throttle_download(self, length):
+        await acquire(length, *self.download_limiters)
+
+    def clear_requests(self):
+        self.outstanding.clear()
+        self.block_handler.release_blocks(self.remote_id)
+
+    async def request_blocks(self):
+        if self.peer_choking == 1 or self.am_interested == 0:
+            return
+
+        requests = b''
+        while len(self.outstanding) < self.pipeline_depth:
+            if any(limiter.throttled() for limiter in self.download_limiters):
+                if self.outstanding:
+                    # What is already in flight covers the rate, asking for more only queues it at the peer
+                    break
+                # Nothing in flight to wake us up, so wait for the buckets to drain
+                await acquire(0, *self.download_limiters)
+            started = time.perf_counter()
+            block = self.block_handler.find_block(self.remote_id)
+            self.block_handler.picker_time.observe(time.perf_counter() - started)
+            if not block:
+                break
+            self.outstanding[(block[0], block[1])] = int(round(time.time() * 1000))
+            requests += Request(*block).encode()
+
+        if requests:
+            self.writer.write(requests)
+            await self.writer.drain()
 
     async def send_bitfield(self):
         bitfield = self.block_handler.my_bitfield
-        bitfield_bin = bitfield.bin
-        for i in range(len(bitfield_bin) % 8):
-            bitfield_bin.append('0b0')
-        bitfield_bytes = bitfield_bin.bytes
-
-        msg = struct.pack("!ib", 1 + len(bitfield_bin), 5)
-        msg += bitfield_bytes
-        self.writer.write(msg)
+        # The bytes go out as they are kept, already in wire order with the spare bits zero
+        self.writer.writelines((Bitfield(bitfield.view()).header(), bitfield.view()))
         await self.writer.drain()
 
+    async def update_interest(self, wanted):
+        if wanted and self.am_interested == 0:
+            await send_interested_message(self.writer)
+            self.am_interested = 1
+        elif not wanted and self.am_interested == 1:
+            self.writer.write(NotInterested().encode())
+            self.am_interested = 0
+
+    def send_cancel(self, index, begin, length):
+        self.outstanding.pop((index, begin), None)
+        if self.writer:
+            self.writer.write(Cancel(index, begin, length).encode())
+
+    def send_have(self, index):
+        if self.writer and self.remote_id:
+            self.writer.write(Have(index).encode())
+            if self.am_interested == 1 and self.block_handler.my_bitfield.complete():
+                self.writer.write(NotInterested().encode())
+                self.am_interested = 0
+
+    async def serve_uploads(self):
+        while True:
+            await self.upload_ready.wait()
+            if not self.upload_queue:
+                self.upload_ready.clear()
+                continue
+
+            # Serve every queued block of the oldest request's piece from a single read
+            index = next(iter(self.upload_queue))[0]
+            batch = sorted(request for request in self.upload_queue if request[0] == index)
+            try:
+                piece = memoryview(await self.block_handler.read_piece(index))
+            except (OSError, EOFError) as e:
+                logger.error("Piece %d not read for upload: %s", index, e)
+                for request in batch:
+                    self.upload_queue.pop(request, None)
+                continue
+
+            for request in batch:
+                _, begin, length = request
+                if request not in self.upload_queue:
+                    continue
+                await acquire(length, *self.upload_limiters)
+                # Cancelled or choked while the piece was being read or the bandwidth waited for
+                if request not in self.upload_queue:
+                    continue
+                del self.upload_queue[request]
+                block = Block(index, begin, piece[begin:begin + length])
+                # The block goes out as a view of the cached piece rather than a copy
+                self.writer.writelines((block.header(), block.data))
+                self.data_uploaded += length
+                self.upload_rate.add(length)
+                self.block_handler.upload_amount += length
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                # The read loop notices the dead connection and closes the peer
+                return
+
+    async def on_choke(self, message):
+        self.peer_choking = 1
+        # A choke discards every request we have queued at the peer
+        self.clear_requests()
+
+    async def on_unchoke(self, message):
+        self.peer_choking = 0
+
+    async def on_interested(self, message):
+        self.peer_interested = 1
+
+    async def on_not_interested(self, message):
+        self.peer_interested = 0
+
+    async def on_have(self, message):
+        self.block_handler.update_bitfield(self.remote_id, message.index)
+        if self.am_interested == 0 and 0 <= message.index < self.num_pieces and \
+                not self.block_handler.my_bitfield[message.index]:
+            await self.update_interest(True)
+
+    async def on_bitfield(self, message):
+        bitfield = PieceBitfield(self.num_pieces, message.bitfield)
+        self.block_handler.add_bitfield(self.remote_id, bitfield)
+        # Only worth asking for unchokes if the peer has something we lack
+        await self.update_interest(bitfield.andnot(self.block_handler.my_bitfield).any())
+
+    async def on_request(self, message):
+        index, begin, length = message
+        if self.am_choking == 1 or len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+            return
+        if not 0 <= index < self.num_pieces or not self.block_handler.my_bitfield[index]:
+            return
+        if begin < 0 or not 0 < length <= MAX_REQUEST_LENGTH or \
+                begin + length > self.block_handler.piece_length(index):
+            return
+
+        self.upload_queue[(index, begin, length)] = None
+        self.upload_ready.set()
+
+    async def on_block(self, message):
+        now = int(round(time.time() * 1000))
+        self.data_downloaded = len(message.data)
+        self.data_received += self.data_downloaded
+        self.download_rate.add(self.data_downloaded)
+        self.download_speed(now)
+        send_time = self.outstanding.pop((message.index, message.begin), None)
+        if send_time is not None:
+            self.update_pipeline_depth(now - send_time)
+            self.block_handler.request_rtt.observe((now - send_time) / 1000)
+        await self.block_handler.block_received(self.remote_id, message.index, message.begin, message.data)
+
+    async def on_cancel(self, message):
+        self.upload_queue.pop(tuple(message), None)
+
     async def start(self):
         try:
-            resp_buffer = b''
             if not self.reader:
                 self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+                self.messages = MessageReader(self.reader, self.throttle_download)
 
-                resp_buffer = await self.handshake(self.reader, self.writer)
-                if resp_buffer is None:
+            if self.outbound:
+                if not await self.handshake():
                     self.writer.close()
                     self.task.cancel()
                     return None
 
-                await send_interested_message(self.writer)
-                self.am_interested = 1
+                if self.block_handler.my_bitfield.any():
+                    await self.send_bitfield()
+                # A seed has nothing to ask for
+                if not self.block_handler.is_complete():
+                    await send_interested_message(self.writer)
+                    self.am_interested = 1
             else:
-                tries = 0
-                while len(resp_buffer) < 68 and tries < 10:
-                    data = await self.reader.read(65535)
-                    if data:
-                        resp_buffer += data
-                    tries += 1
-
-                if tries >= 10:
-                    self.writer.close()
-                    self.task.cancel()
-                    return None
-
-                decoded_msg = struct.unpack("!b19sq20s20s", resp_buffer[:68])
-                if decoded_msg[3] != self.__info_hash:
+                handshake = self.remote_handshake or await self.messages.read_handshake(10.0)
+                if handshake.info_hash != self.__info_hash:
                     self.writer.close()
                     self.task.cancel()
                     return None
 
-                self.remote_id = decoded_msg[4]
-                msg = struct.pack("!b19sq20s20s", 19, "BitTorrent protocol".encode(), 0, self.__info_hash,
-                                  self.__id.encode())
-
-                self.writer.write(msg)
+                self.remote_id = handshake.peer_id
+                self.writer.write(Handshake(self.__info_hash, self.__id.encode()).encode())
                 await self.writer.drain()
                 await self.send_bitfield()
-                resp_buffer = resp_buffer[68:]
 
+            self.block_handler.add_peer(self)
+            self.upload_task = asyncio.create_task(self.serve_uploads())
             while True:
+                await self.request_blocks()
                 try:
-                    recv_data = await asyncio.wait_for(self.reader.read(65535), 10.0)
-                    if recv_data:
-                        resp_buffer += recv_data
-                    if not resp_buffer and not recv_data:
-                        self.writer.close()
-                        self.task.cancel()
-                        return None
-                    while len(resp_buffer) > 4:
-                        msg_len = struct.unpack("!i", resp_buffer[:4])[0]
-                        msg_id = int(resp_buffer[4])
-                        if msg_len == 0:
-                            resp_buffer = resp_buffer[4:]
-                        elif msg_len == 1:
-                            if msg_id == 0:
-                                self.peer_choking = 1
-                            elif msg_id == 1:
-                                if self.peer_choking == 1:
-                                    self.peer_choking = 0
-                            elif msg_id == 2:
-                                self.peer_interested = 1
-                            elif msg_id == 3:
-                                self.peer_interested = 0
-                            resp_buffer = resp_buffer[4 + msg_len:]
-                        elif msg_len == 5:
-                            if len(resp_buffer) >= 4 + msg_len:
-                                if msg_id == 4:
-                                    piece_index = struct.unpack("!i", resp_buffer[5:9])[0]
-                                    self.block_handler.update_bitfield(self.remote_id, piece_index)
-                                    resp_buffer = resp_buffer[4 + msg_len:]
-                            else:
-                                break
-                        elif msg_len == 13 and msg_id == 8:
-                            print(f"{self.remote_id} Cancel")
-                            self.downloading = 0
-                            resp_buffer = resp_buffer[4 + msg_len:]
-                        elif msg_len == 13 and msg_id == 6:
-                            print(f"Received request from {self.remote_id}")
-                            resp = struct.unpack("!ibiii", resp_buffer[:4 + msg_len])
-                            data = await self.block_handler.read(resp[2], resp[3], resp[4])
-                            msg = struct.pack("!ibii", 9 + len(data), resp[2], resp[3])
-                            msg += data
-                            self.writer.write(msg)
-                            await self.writer.drain()
-                            resp_buffer = resp_buffer[4 + msg_len:]
-                        elif msg_id == 5:
-                            if len(resp_buffer) >= 4 + msg_len:
-                                recv_bitfield = resp_buffer[5:5 + msg_len]
-                                resp_buffer = resp_buffer[4 + msg_len:]
-                                bitfield = bitstring.BitArray(recv_bitfield)
-                                self.block_handler.add_bitfield(self.remote_id, bitfield)
-                            else:
-                                break
-                        elif msg_id == 7:
-                            if len(resp_buffer) >= 4 + msg_len:
-                                self.statistics["receive_time"] = int(round(time.time() * 1000))
-                                self.data_downloaded = len(resp_buffer[13:msg_len + 4])
-                                self.download_speed()
-                                block_index, block_begin = struct.unpack("!ii", resp_buffer[5:13])
-                                await self.block_handler.block_received(block_index, block_begin,
-                                                                        resp_buffer[13:msg_len + 4])
-                                self.downloading = 0
-                                resp_buffer = resp_buffer[msg_len + 4:]
-                            else:
-                                break
-                        elif msg_len == 3 and msg_id == 9:
-                            resp_buffer = resp_buffer[4 + msg_len:]
-
-                        if self.peer_choking == 0 and self.am_interested == 1 and self.downloading == 0 and \
-                                self.block_handler.download_speed <= int(self.block_handler.download_limit):
-                            block = self.block_handler.find_block(self.remote_id)
-                            if block:
-                                self.statistics["send_time"] = int(round(time.time() * 1000))
-                                self.downloading = 1
-                                request_msg = struct.pack("!ibiii", 13, 6, block[1], block[2], block[3])
-                                self.writer.write(request_msg)
-                                await self.writer.drain()
-                            else:
-                                break
-                except ConnectionResetError:
-                    self.writer.close()
-                    await self.writer.wait_closed()
-                    self.task.exception()
-                    self.task.cancel()
-                    return None
-                except (Exception,):
-                    self.task.exception()
-                    pass
+                    message = await self.messages.read_message(10.0)
+                except asyncio.TimeoutError:
+                    # Nothing arrived, go round again so expired requests get re-issued
+                    continue
+
+                handler = self.handlers.get(type(message))
+                if handler:
+                    await handler(message)
 
         except (Exception,):
-            self.task.exception()
+            if self.writer:
+                self.writer.close()
+            if self.upload_task:
+                self.upload_task.cancel()
             self.task.cancel()
             return None
@@ -0,0 +1,99 @@
+import random
+from collections import defaultdict
+
+# Random probes into a bucket before falling back to scanning it
+PICK_PROBES = 8
+
+
+class PiecePicker:
+    def __init__(self, num_pieces):
+        self.num_pieces = num_pieces
+        self.peers = 0
+        self.availability = [0] * num_pieces
+        # availability -> wanted pieces seen by that many peers, in no particular order
+        self.buckets = defaultdict(list)
+        # piece -> position in its bucket, None once the piece is no longer wanted
+        self.positions = [None] * num_pieces
+        for i in range(num_pieces):
+            self.bucket_add(i)
+
+    def bucket_add(self, piece):
+        bucket = self.buckets[self.availability[piece]]
+        self.positions[piece] = len(bucket)
+        bucket.append(piece)
+
+    def bucket_remove(self, piece):
+        # Swap with the last entry so removal does not shift the bucket
+        bucket = self.buckets[self.availability[piece]]
+        position = self.positions[piece]
+        last = bucket.pop()
+        if last != piece:
+            bucket[position] = last
+            self.positions[last] = position
+        self.positions[piece] = None
+
+    def change_availability(self, piece, delta):
+        wanted = self.positions[piece] is not None
+        if wanted:
+            self.bucket_remove(piece)
+        self.availability[piece] += delta
+        if wanted:
+            self.bucket_add(piece)
+
+    def pieces_in(self, bitfield):
+        return bitfield.ones()
+
+    def add_bitfield(self, bitfield):
+        self.peers += 1
+        for i in self.pieces_in(bitfield):
+            self.change_availability(i, 1)
+
+    def remove_bitfield(self, bitfield):
+        self.peers -= 1
+        for i in self.pieces_in(bitfield):
+            self.change_availability(i, -1)
+
+    def have(self, index):
+        self.change_availability(index, 1)
+
+    def remove(self, piece):
+        # The piece has been started or completed and should not be picked again
+        if self.positions[piece] is not None:
+            self.bucket_remove(piece)
+
+    def restore(self, piece):
+        if self.positions[piece] is None:
+            self.bucket_add(piece)
+
+    def remaining(self):
+        # Wanted pieces that have not been started
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def pick(self, bitfield):
+        # No piece can be seen by more peers than we have bitfields for
+        for count in range(1, self.peers + 1):
+            bucket = self.buckets.get(count)
+            if not bucket:
+                continue
+
+            # Pieces tied on rarity are chosen at random, usually in a few probes
+            size = len(bucket)
+            for _ in range(min(size, PICK_PROBES)):
+                piece = bucket[random.randrange(size)]
+                if bitfield[piece]:
+                    return piece
+
+            start = random.randrange(size)
+            for i in range(size):
+                piece = bucket[(start + i) % size]
+                if bitfield[piece]:
+                    return piece
+
+        return None
+
+    def pick_first(self, bitfield, pieces):
+        # In order rather than by rarity, for the streaming window
+        for piece in pieces:
+            if self.positions[piece] is not None and bitfield[piece]:
+                return piece
+        return None
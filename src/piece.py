@@ -1,74 +1,112 @@
-import hashlib
 import math
+from array import array
 
+BLOCK_SIZE = 2 ** 14
 
-class Piece:
-    def __init__(self, index, hash_value, size):
-        self.hash = hash_value
-        self.index = index
-        self.blocks = []
-        self.size = size
+# Block states
+MISSING = 0
+PENDING = 1
+RECEIVED = 2
 
-        num_blocks = math.ceil(size / 2 ** 14)
-        # 0 - Not downloaded, 1 - Pending, 2 - Downloaded
-        # block - [status, index, offset, length, data]
+# Memory kept in idle piece buffers for reuse
+POOL_BUDGET = 64 * 2 ** 20
 
-        remaining_size = size
-        for i in range(num_blocks):
-            self.blocks.append([0, index, i * (2 ** 14), 2 ** 14, b''])
-            remaining_size -= 2 ** 14
-        if size % (2 ** 14) != 0:
-            last_block = self.blocks[-1]
-            last_block[3] = size % (2 ** 14)
-            self.blocks[-1] = last_block
 
-    def request_block_download(self):
-        blocks_list = []
-        for block in self.blocks:
-            if block[0] == 0:
-                blocks_list.append(block)
+class BufferPool:
+    def __init__(self, buffer_size, budget=POOL_BUDGET):
+        self.buffer_size = buffer_size
+        self.max_free = max(1, budget // buffer_size)
+        self.free = []
 
-        if blocks_list:
-            block = blocks_list[0]
-            block[0] = 1
-            return block
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        return bytearray(self.buffer_size)
 
-        return None
+    def release(self, buffer):
+        if len(self.free) < self.max_free:
+            self.free.append(buffer)
 
-    def block_received(self, offset, data):
-        block = None
-        for i in self.blocks:
-            if i[2] == offset:
-                block = i
-                break
 
-        if block is not None:
-            block[4] = data
-            block[0] = 2
+class Piece:
+    __slots__ = ("index", "hash", "size", "num_blocks", "status", "received", "next_missing", "pool", "buffer")
 
-    def completed(self):
-        for i in self.blocks:
-            if i[0] != 2:
-                return False
+    def __init__(self, index, hash_value, size, pool=None):
+        self.hash = hash_value
+        self.index = index
+        self.size = size
+        self.num_blocks = math.ceil(size / BLOCK_SIZE)
+        # One byte of state per block, a block is found from its offset by arithmetic
+        self.status = array('B', bytes(self.num_blocks))
+        self.received = 0
+        # No block before this one is missing
+        self.next_missing = 0
+        self.pool = pool if pool else BufferPool(size, size)
+        # Blocks are written straight into one buffer, taken from the pool on the first block
+        self.buffer = None
+
+    def block_length(self, block):
+        return min(BLOCK_SIZE, self.size - block * BLOCK_SIZE)
 
-        return True
+    def request_block_download(self):
+        # A block is returned as (piece index, offset, length)
+        try:
+            block = self.status.index(MISSING, self.next_missing)
+        except ValueError:
+            self.next_missing = self.num_blocks
+            return None
+
+        self.status[block] = PENDING
+        self.next_missing = block + 1
+        return self.index, block * BLOCK_SIZE, self.block_length(block)
+
+    def cancel_block(self, offset):
+        block = offset // BLOCK_SIZE
+        if 0 <= block < self.num_blocks and self.status[block] == PENDING:
+            self.status[block] = MISSING
+            self.next_missing = min(self.next_missing, block)
+
+    def pending_blocks(self):
+        for block, status in enumerate(self.status):
+            if status == PENDING:
+                yield block * BLOCK_SIZE, self.block_length(block)
+
+    def fully_requested(self):
+        return MISSING not in self.status
 
-    def verify_piece(self):
-        piece_data = b''
-        for i in self.blocks:
-            piece_data += i[4]
+    def block_received(self, offset, data):
+        # Whether the block was new and taken into the piece
+        block, remainder = divmod(offset, BLOCK_SIZE)
+        if remainder or not 0 <= block < self.num_blocks or len(data) != self.block_length(block):
+            return False
+
+        if self.status[block] == RECEIVED:
+            return False
+
+        if self.buffer is None:
+            self.buffer = self.pool.acquire()
+        self.buffer[offset:offset + len(data)] = data
+        self.status[block] = RECEIVED
+        self.received += 1
+        return True
 
-        piece_hash = hashlib.sha1(piece_data).digest()
+    def completed(self):
+        return self.received == self.num_blocks
 
-        return piece_hash == self.hash
+    def verify_piece(self, digest):
+        # The digest of get_data, worked out off the event loop
+        return self.completed() and digest == self.hash
 
     def get_data(self):
-        piece_data = b''
-        for i in self.blocks:
-            piece_data += i[4]
-
-        return piece_data
+        return memoryview(self.buffer)[:self.size]
 
     def clear_data(self):
-        for i in self.blocks:
-            i[4] = b''
+        if self.buffer is not None:
+            self.pool.release(self.buffer)
+            self.buffer = None
+
+    def reset(self):
+        # The piece failed its hash check, every block has to be downloaded again
+        self.status = array('B', bytes(self.num_blocks))
+        self.received = 0
+        self.next_missing = 0
@@ -0,0 +1,87 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+SAMPLE_INTERVAL = 0.005
+# Functions listed in the summary printed at exit
+REPORT_LINES = 25
+
+
+class SamplingProfiler:
+    # Samples one thread's stack from a background thread. Unlike cProfile it costs the sampled code
+    # nothing per call, so it can be left on in a live session.
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        # "outermost;...;innermost" -> samples, the collapsed format flame graph tools read
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def report(self, lines=REPORT_LINES, stream=sys.stderr):
+        # Share of the samples each function was running in, on its own and with what it called
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        samples = max(self.samples, 1)
+        stream.write(f"{self.samples} samples every {self.interval * 1000:g} ms\n{'own':>7} {'total':>7}\n")
+        for name, count in own.most_common(lines):
+            stream.write(f"{100 * count / samples:6.1f}% {100 * total[name] / samples:6.1f}%  {name}\n")
+
+
+@contextmanager
+def profiling(profile_path=None, sample_path=None, interval=SAMPLE_INTERVAL):
+    # cProfile stats for pstats or snakeviz, sampled stacks for flame graphs, and a summary of each on stderr
+    profile = cProfile.Profile() if profile_path else None
+    sampler = SamplingProfiler(interval) if sample_path else None
+    if sampler:
+        sampler.start()
+    if profile:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(profile_path)
+            pstats.Stats(profile, stream=sys.stderr).sort_stats("cumulative").print_stats(REPORT_LINES)
+        if sampler:
+            sampler.stop()
+            sampler.write(sample_path)
+            sampler.report()
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+# Seconds of traffic a quiet bucket may save up, so a link that was idle can briefly catch up
+BURST_SECONDS = 0.5
+MIN_BURST = 2 ** 16
+
+
+class RateLimiter:
+    def __init__(self, rate=None):
+        # Bytes per second, None or 0 for no limit
+        self.rate = rate
+        self.capacity = max(rate * BURST_SECONDS, MIN_BURST) if rate else 0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # asyncio.Lock wakes waiters in the order they arrived, which is what shares the bandwidth fairly
+        self.lock = asyncio.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def throttled(self):
+        if not self.rate:
+            return False
+        self.refill(time.monotonic())
+        return self.tokens < 0 or self.lock.locked()
+
+    async def acquire(self, amount):
+        # Tokens may go negative, the next caller then waits out the debt. This lets a block larger than
+        # the bucket through and keeps the link busy while still holding the average to the rate.
+        if not self.rate:
+            return
+        async with self.lock:
+            self.refill(time.monotonic())
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+                self.refill(time.monotonic())
+            self.tokens -= amount
+
+
+async def acquire(amount, *limiters):
+    # The peer's own bucket first, so a peer at its cap waits without holding up the shared one
+    for limiter in limiters:
+        await limiter.acquire(amount)
+
+
+def kib(value):
+    # Command line limits are in KB/s
+    return int(float(value) * 1024) if value else None
@@ -0,0 +1,56 @@
+import os
+
+
+class TorrentReader:
+    # File-like access to a byte range of the torrent, reads wait until the pieces they cover are verified
+    def __init__(self, block_handler, offset=0, length=None):
+        self.block_handler = block_handler
+        self.start = offset
+        self.length = block_handler.length - offset if length is None else length
+        self.position = 0
+        self.closed = False
+        self.follow()
+
+    def follow(self):
+        # The streaming window moves with the last reader to read or seek
+        if self.position < self.length:
+            self.block_handler.set_cursor((self.start + self.position) // self.block_handler.piece_size)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        self.follow()
+        return self.position
+
+    async def read(self, size=-1):
+        if self.closed:
+            raise ValueError("read from a closed reader")
+        end = self.length if size is None or size < 0 else min(self.position + size, self.length)
+        chunks = []
+        piece_size = self.block_handler.piece_size
+        while self.position < end:
+            offset = self.start + self.position
+            index, begin = divmod(offset, piece_size)
+            length = min(piece_size - begin, end - self.position)
+            await self.block_handler.wait_verified(index)
+            chunks.append(await self.block_handler.read(index, begin, length))
+            self.position += length
+            self.follow()
+        return b''.join(chunks)
+
+    def close(self):
+        self.closed = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
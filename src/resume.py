@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import time
+
+import bencode
+from bitfield import Bitfield
+
+logger = logging.getLogger("bittorrent")
+
+
+class Resume:
+    def __init__(self, meta_info, block_handler):
+        self.meta_info = meta_info
+        self.block_handler = block_handler
+        self.storage = block_handler.storage
+        self.path = meta_info.resume_file
+        self.torrent_id = hashlib.sha1(meta_info.pieces.view).digest()
+        # Number of pieces we had when the resume file was last written
+        self.saved = -1
+
+    def file_stats(self):
+        stats = []
+        for path, _ in self.storage.files:
+            try:
+                stat = os.stat(path)
+                stats.append([stat.st_size, stat.st_mtime_ns])
+            except OSError:
+                stats.append([-1, 0])
+        return stats
+
+    def load(self):
+        # The saved bitfield, or None if the resume file is missing or the data has changed since
+        try:
+            with open(self.path, "rb") as f:
+                data = bencode.decode(f.read())
+        except (OSError, bencode.BencodeError):
+            return None
+
+        if data.get(b'torrent') != self.torrent_id or \
+                data.get(b'num pieces') != self.meta_info.num_pieces or data.get(b'files') != self.file_stats():
+            return None
+
+        return Bitfield(self.meta_info.num_pieces, data[b'bitfield'])
+
+    def save(self):
+        bitfield = self.block_handler.my_bitfield
+        data = {b'torrent': self.torrent_id, b'num pieces': self.meta_info.num_pieces,
+                b'bitfield': bitfield.tobytes(), b'files': self.file_stats()}
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(bencode.encode(data))
+            os.replace(tmp_path, self.path)
+            self.saved = bitfield.count
+        except OSError as e:
+            logger.error("Resume file not saved: %s", e)
+
+    def save_if_changed(self):
+        if self.block_handler.my_bitfield.count != self.saved:
+            self.save()
+
+    async def restore(self, recheck=False):
+        bitfield = None if recheck else self.load()
+        if bitfield is not None:
+            for i in bitfield.ones():
+                self.block_handler.mark_complete(i)
+            self.saved = bitfield.count
+        elif recheck or self.storage.preexisting:
+            await self.recheck()
+            self.save()
+        # What we already had, drawn now rather than when the first block arrives, which may be never
+        self.block_handler.download_progress(self.block_handler.download_amount, force=True)
+
+    def report_progress(self, checked, verified):
+        total = self.meta_info.num_pieces
+        sys.stdout.write(f"\rChecking pieces: {checked}/{total} ({verified} verified)")
+        sys.stdout.flush()
+
+    async def recheck(self):
+        hasher = self.block_handler.hasher
+        # Reads stay on the storage thread and hashing goes to the hasher's pool. The semaphore bounds how
+        # many pieces are held in memory at once, the hasher only bounds those waiting to be hashed.
+        in_flight = asyncio.Semaphore(hasher.workers * 2)
+        progress = {"checked": 0, "verified": 0, "reported": 0}
+
+        async def check(index):
+            try:
+                length = self.block_handler.piece_length(index)
+                data = await self.storage.read(index * self.block_handler.piece_size, length)
+                digest = await hasher.digest(data)
+                if digest == self.meta_info.pieces[index]:
+                    self.block_handler.mark_complete(index)
+                    progress["verified"] += 1
+            except (OSError, EOFError):
+                pass
+            finally:
+                in_flight.release()
+                progress["checked"] += 1
+                now = time.monotonic()
+                if now - progress["reported"] > 0.5:
+                    progress["reported"] = now
+                    self.report_progress(progress["checked"], progress["verified"])
+
+        tasks = []
+        for index in range(self.meta_info.num_pieces):
+            await in_flight.acquire()
+            tasks.append(asyncio.create_task(check(index)))
+        await asyncio.gather(*tasks)
+
+        self.report_progress(progress["checked"], progress["verified"])
+        print()
@@ -1,18 +1,44 @@
 import asyncio
+import logging
 
-from peer import Peer
+from message import MessageReader
+
+logger = logging.getLogger("bittorrent")
+
+LISTEN_PORT = 6885
+HANDSHAKE_TIMEOUT = 10.0
 
 
 class Seeder:
-    def __init__(self, torrent, block_handler):
-        self.torrent = torrent
-        self.block_handler = block_handler
-        self.clients = []
-        self.server = asyncio.start_server(client_connected_cb=self.client_connected, host="0.0.0.0", port=6885)
+    def __init__(self, torrents, port=LISTEN_PORT):
+        # info_hash -> Torrent, an inbound connection goes to the torrent named in its handshake
+        self.torrents = torrents
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self.client_connected, host="0.0.0.0", port=self.port)
+        except OSError as e:
+            # Still able to download, just not to accept incoming connections
+            logger.error("Not listening for peers: %s", e)
 
     async def client_connected(self, reader, writer):
-        address = writer.get_extra_info('peername')
-        peer = Peer(self.torrent.meta_info.id, self.torrent.meta_info.info_hash, self.torrent.meta_info.num_pieces,
-                    address[0], address[1], self.block_handler, (reader, writer))
-        self.clients.append(peer)
-        self.torrent.add_peer(peer)
+        try:
+            handshake = await MessageReader(reader).read_handshake(HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        self.route(reader, writer, handshake)
+
+    def route(self, reader, writer, handshake):
+        torrent = self.torrents.get(handshake.info_hash)
+        if torrent is None or not torrent.active:
+            writer.close()
+            return
+        torrent.accept(reader, writer, handshake)
+
+    def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+
+from cache import READ_CACHE_BUDGET, WRITE_CACHE_BUDGET
+from dht import DHT
+from hasher import Hasher
+from rate_limiter import RateLimiter, kib
+from seed import LISTEN_PORT, Seeder
+from stats import LoopMonitor, StatsFile, StatsServer
+from torrent import Torrent
+from utils import generate_peer_id
+
+logger = logging.getLogger("bittorrent")
+
+DEFAULT_MAX_CONNECTIONS = 500
+
+
+class Session:
+    def __init__(self, port=LISTEN_PORT, max_connections=None, max_download=None, max_upload=None,
+                 cache_budget=READ_CACHE_BUDGET, listen=True, hash_workers=None, hash_processes=False,
+                 write_cache_budget=WRITE_CACHE_BUDGET, stats_port=None, stats_file=None, dht_port=None,
+                 dht_state=None):
+        self.peer_id = generate_peer_id()
+        self.port = port
+        # info_hash -> Torrent, paused ones included
+        self.torrents = {}
+        # info_hash -> task running the torrent, only for those that are not paused
+        self.tasks = {}
+        # One listener for every torrent, it routes connections by the info hash in their handshake
+        self.seeder = Seeder(self.torrents, port)
+        # A worker of a supervisor gets its connections passed in rather than listening itself
+        self.listen = listen
+        # Shared out evenly between running torrents whenever one starts or stops
+        self.max_connections = int(max_connections) if max_connections else DEFAULT_MAX_CONNECTIONS
+        self.cache_budget = cache_budget
+        self.write_cache_budget = write_cache_budget
+        # Charged by every peer of every torrent, so busy torrents get what idle ones leave
+        self.download_limiter = RateLimiter(kib(max_download))
+        self.upload_limiter = RateLimiter(kib(max_upload))
+        # One pool hashes the pieces of every torrent, so the cores are not oversubscribed
+        self.hasher = Hasher(hash_workers, hash_processes)
+        self.monitor = LoopMonitor()
+        self.idle = asyncio.Event()
+        # Optional views of metrics() for outside tools
+        self.stats_server = StatsServer(self.metrics, int(stats_port)) if stats_port else None
+        self.stats_file = StatsFile(self.metrics, stats_file) if stats_file else None
+        # One DHT node finds peers for every torrent, None to rely on trackers alone
+        self.dht = DHT(int(dht_port), dht_state) if dht_port is not None else None
+
+    def add(self, file, location=None, paused=False, **options):
+        torrent = Torrent(file, location, port=self.port, listen=False, hasher=self.hasher, dht=self.dht, **options)
+        info_hash = torrent.meta_info.info_hash
+        if info_hash in self.torrents:
+            torrent.close()
+            return info_hash
+
+        torrent.meta_info.id = self.peer_id
+        torrent.block_handler.download_limiters += (self.download_limiter,)
+        torrent.block_handler.upload_limiters += (self.upload_limiter,)
+        self.torrents[info_hash] = torrent
+        if not paused:
+            self.resume(info_hash)
+        return info_hash
+
+    def resume(self, info_hash):
+        if info_hash in self.tasks or info_hash not in self.torrents:
+            return
+        task = asyncio.create_task(self.torrents[info_hash].torrent_start())
+        task.add_done_callback(lambda _: self.stopped(info_hash, task))
+        self.tasks[info_hash] = task
+        self.idle.clear()
+        self.rebalance()
+
+    def pause(self, info_hash):
+        task = self.tasks.pop(info_hash, None)
+        if task:
+            task.cancel()
+            self.rebalance()
+        return task
+
+    async def remove(self, info_hash):
+        task = self.pause(info_hash)
+        if task:
+            # Let the torrent disconnect and save its resume file before its files are closed
+            await asyncio.gather(task, return_exceptions=True)
+        torrent = self.torrents.pop(info_hash, None)
+        if torrent:
+            torrent.close()
+        self.check_idle()
+
+    def stopped(self, info_hash, task):
+        if self.tasks.get(info_hash) is task:
+            del self.tasks[info_hash]
+            self.rebalance()
+        self.check_idle()
+
+    def check_idle(self):
+        # Paused torrents may still be resumed, only finished ones leave the session with nothing to do. A seeding
+        # torrent never finishes, so the session runs until it is paused or removed.
+        if not self.tasks and all(torrent.block_handler.is_complete() for torrent in self.torrents.values()):
+            self.idle.set()
+
+    def rebalance(self):
+        running = [self.torrents[info_hash] for info_hash in self.tasks]
+        if not running:
+            return
+        connections = max(self.max_connections // len(running), 1)
+        cache_budget = self.cache_budget // len(running)
+        write_cache_budget = self.write_cache_budget // len(running)
+        for torrent in running:
+            torrent.connection_manager.max_peers = min(torrent.connection_manager.peer_limit, connections)
+            torrent.block_handler.read_cache.resize(cache_budget)
+            # A smaller write budget takes effect at the next piece, which flushes if it is over
+            torrent.block_handler.write_cache.budget = write_cache_budget
+
+    async def run(self):
+        # Until every torrent has finished
+        if self.listen:
+            await self.seeder.start()
+        await self.start_dht()
+        tasks = [asyncio.create_task(self.monitor.run())]
+        if self.stats_server:
+            await self.stats_server.start()
+        if self.stats_file:
+            tasks.append(asyncio.create_task(self.stats_file.run()))
+        self.check_idle()
+        try:
+            await self.idle.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.stats_server:
+                self.stats_server.close()
+            # The final numbers, while the torrents are still there to report them
+            if self.stats_file:
+                self.stats_file.write()
+            await self.close()
+
+    async def start_dht(self):
+        if not self.dht:
+            return
+        try:
+            await self.dht.start()
+        except OSError as e:
+            # The torrents still have their trackers
+            logger.warning("DHT disabled: %s", e)
+            self.dht = None
+            for torrent in self.torrents.values():
+                torrent.dht_search = None
+
+    async def close(self):
+        self.seeder.close()
+        if self.dht:
+            self.dht.close()
+        # All at once, each may wait on its trackers for the stopped announce
+        await asyncio.gather(*(self.remove(info_hash) for info_hash in list(self.torrents)))
+        self.hasher.close()
+
+    def metrics(self):
+        return {"loop_lag": self.monitor.metrics(), "hasher": self.hasher.metrics(),
+                "dht": self.dht.metrics() if self.dht else {},
+                "torrents": [{**torrent.metrics(), "running": info_hash in self.tasks}
+                             for info_hash, torrent in self.torrents.items()]}
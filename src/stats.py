@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import os
+from bisect import bisect_left
+from collections import deque
+
+logger = logging.getLogger("bittorrent")
+
+LAG_INTERVAL = 0.1
+# Samples kept, a minute at the default interval
+LAG_SAMPLES = 600
+# Upper bounds in seconds, for round trips, hashing, disk writes and loop lag
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Choosing a block should take microseconds
+PICKER_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+STATS_FILE_INTERVAL = 5
+HTTP_TIMEOUT = 5
+# Each entry of a list of entities becomes a label of this name, valued by the entry's id
+LABELS = {"torrents": "torrent", "peers": "peer", "workers": "worker"}
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # Observations per bucket, the last past every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def metrics(self):
+        # Cumulative like Prometheus buckets, the count is the +Inf one
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets.append([bound, total])
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": buckets}
+
+
+class LoopMonitor:
+    def __init__(self, interval=LAG_INTERVAL, samples=LAG_SAMPLES):
+        self.interval = interval
+        # How much later than asked for each wakeup came, in seconds
+        self.lags = deque(maxlen=samples)
+        self.max_lag = 0
+        self.histogram = Histogram()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0)
+            self.lags.append(lag)
+            self.histogram.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def metrics(self):
+        # Milliseconds, over the recent samples apart from the all time maximum
+        if not self.lags:
+            return {"mean": 0, "p99": 0, "max": 0, "seconds": self.histogram.metrics()}
+        lags = sorted(self.lags)
+        return {"mean": round(1000 * sum(lags) / len(lags), 3), "p99": round(1000 * lags[int(len(lags) * 0.99)], 3),
+                "max": round(1000 * self.max_lag, 3), "seconds": self.histogram.metrics()}
+
+
+def label_text(labels):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}" if labels else ""
+
+
+def flatten(name, value, labels, families):
+    # families: metric name -> (type, sample lines)
+    if isinstance(value, dict) and "buckets" in value:
+        family = families.setdefault(name, ("histogram", []))[1]
+        for bound, count in value["buckets"]:
+            family.append(f"{name}_bucket{label_text(labels + (('le', bound),))} {count}")
+        family.append(f"{name}_bucket{label_text(labels + (('le', '+Inf'),))} {value['count']}")
+        family.append(f"{name}_sum{label_text(labels)} {value['sum']}")
+        family.append(f"{name}_count{label_text(labels)} {value['count']}")
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            flatten(f"{name}_{key}", item, labels, families)
+    elif isinstance(value, list):
+        label = LABELS.get(name.rsplit("_", 1)[-1], "index")
+        for i, item in enumerate(value):
+            if isinstance(item, dict):
+                flatten(name, {key: v for key, v in item.items() if key != "id"},
+                        labels + ((label, item.get("id", i)),), families)
+    elif isinstance(value, (int, float)):
+        families.setdefault(name, ("gauge", []))[1].append(f"{name}{label_text(labels)} {float(value)}")
+
+
+def prometheus(metrics, prefix="bittorrent"):
+    # The text exposition format, strings are left out and nested keys joined into the metric name
+    families = {}
+    flatten(prefix, metrics, (), families)
+    lines = []
+    for name, (kind, samples) in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class StatsServer:
+    # Local HTTP endpoint: /metrics for Prometheus, anything else the same numbers as JSON
+    def __init__(self, collect, port, host="127.0.0.1"):
+        self.collect = collect
+        self.port = port
+        self.host = host
+        self.server = None
+
+    async def start(self):
+        try:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            logger.error("Stats server not started: %s", e)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_TIMEOUT)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b"/"
+            if path.startswith(b"/metrics"):
+                body = prometheus(self.collect()).encode()
+                content_type = "text/plain; version=0.0.4"
+            else:
+                body = json.dumps(self.collect()).encode()
+                content_type = "application/json"
+            writer.write(f"HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+
+class StatsFile:
+    # The JSON stats rewritten every interval, replaced whole so readers never see half of it
+    def __init__(self, collect, path, interval=STATS_FILE_INTERVAL):
+        self.collect = collect
+        self.path = path
+        self.interval = interval
+
+    def write(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.collect(), f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error("Stats file not written: %s", e)
+
+    async def run(self):
+        while True:
+            self.write()
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,114 @@
+import asyncio
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_OPEN_FILES = 64
+# Buffers a single pwritev call may take
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+
+class Storage:
+    def __init__(self, path, files, file_index, max_open=MAX_OPEN_FILES):
+        # [full path, length]
+        self.files = [[os.path.join(path, *[part.decode() for part in file["path"]]), file["length"]] for file in files]
+        self.file_index = file_index
+        self.max_open = max_open
+        # LRU pool of open descriptors, file index -> fd
+        self.fds = OrderedDict()
+        # All disk access runs on one thread, so the event loop never blocks on I/O and the
+        # descriptor pool is never touched concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        # Whether any file already held data before we allocated, only then is there anything to recheck
+        self.preexisting = False
+        self.allocate()
+
+    def allocate(self):
+        directories = set(os.path.dirname(file[0]) for file in self.files)
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+
+        for i, file in enumerate(self.files):
+            fd = self.open(i)
+            size = os.fstat(fd).st_size
+            self.preexisting = self.preexisting or size > 0
+            if size < file[1]:
+                # Sparse files reserve the full length without writing it out
+                os.ftruncate(fd, file[1])
+
+    def open(self, file_index):
+        fd = self.fds.get(file_index)
+        if fd is not None:
+            self.fds.move_to_end(file_index)
+            return fd
+
+        if len(self.fds) >= self.max_open:
+            _, old_fd = self.fds.popitem(last=False)
+            os.close(old_fd)
+        fd = os.open(self.files[file_index][0], os.O_RDWR | os.O_CREAT, 0o644)
+        self.fds[file_index] = fd
+        return fd
+
+    def writev_sync(self, offset, buffers):
+        # The buffers are contiguous in the torrent, each file they cross gets one vectored write
+        views = [memoryview(buffer) for buffer in buffers]
+        total = sum(len(view) for view in views)
+        for file_index, file_offset, length in self.file_index.range_spans(offset, total):
+            chunk = []
+            while length > 0:
+                part = views[0][:length]
+                chunk.append(part)
+                length -= len(part)
+                if len(part) == len(views[0]):
+                    views.pop(0)
+                else:
+                    views[0] = views[0][len(part):]
+            self.pwritev(self.open(file_index), chunk, file_offset)
+
+    def pwritev(self, fd, views, offset):
+        if not hasattr(os, "pwritev"):
+            for view in views:
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+            return
+
+        while views:
+            written = os.pwritev(fd, views[:IOV_MAX], offset)
+            offset += written
+            # Drop whatever went out, a partial write leaves the rest of a buffer for the next call
+            while written:
+                if written >= len(views[0]):
+                    written -= len(views[0])
+                    views.pop(0)
+                else:
+                    views[0] = views[0][written:]
+                    written = 0
+
+    def read_sync(self, offset, length):
+        data = bytearray()
+        for file_index, file_offset, span_length in self.file_index.range_spans(offset, length):
+            fd = self.open(file_index)
+            while span_length > 0:
+                chunk = os.pread(fd, span_length, file_offset)
+                if not chunk:
+                    raise EOFError(f"Short read from {self.files[file_index][0]}")
+                data += chunk
+                file_offset += len(chunk)
+                span_length -= len(chunk)
+        return bytes(data)
+
+    async def writev(self, offset, buffers):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.writev_sync, offset, buffers)
+
+    async def read(self, offset, length):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.read_sync, offset, length)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while self.fds:
+            _, fd = self.fds.popitem()
+            os.close(fd)
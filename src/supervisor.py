@@ -0,0 +1,352 @@
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+
+import bencode
+from cache import READ_CACHE_BUDGET, WRITE_CACHE_BUDGET
+from message import HANDSHAKE_LENGTH, Handshake
+from seed import HANDSHAKE_TIMEOUT, LISTEN_PORT
+from session import DEFAULT_MAX_CONNECTIONS, Session
+from stats import StatsFile, StatsServer
+
+logger = logging.getLogger("bittorrent")
+
+STATS_INTERVAL = 2
+MAX_PACKET = 2 ** 20
+
+
+def info_hash_of(file):
+    with open(file, "rb") as f:
+        return hashlib.sha1(bencode.decode(f.read()).raw(b'info')).digest()
+
+
+def share(value, parts):
+    # A session-wide rate split evenly between workers, None stays unlimited
+    return float(value) / parts if value else None
+
+
+def send_message(channel, message, fds=()):
+    socket.send_fds(channel, [json.dumps(message).encode()], list(fds))
+
+
+def receive_messages(channel):
+    # Every packet waiting on a non-blocking channel, a None message means the other end has gone
+    while True:
+        try:
+            data, fds, _, _ = socket.recv_fds(channel, MAX_PACKET, 1)
+        except BlockingIOError:
+            return
+        if not data:
+            yield None, fds
+            return
+        yield json.loads(data), fds
+
+
+class Worker:
+    def __init__(self, index, channel, files, location, session_options, torrent_options):
+        self.index = index
+        self.channel = channel
+        self.files = files
+        self.location = location
+        self.torrent_options = torrent_options
+        # Connections arrive over the channel, the supervisor holds the listening socket
+        self.session = Session(listen=False, **session_options)
+        self.handlers = {"connection": self.on_connection, "add": self.on_add, "pause": self.on_pause,
+                         "resume": self.on_resume, "remove": self.on_remove}
+
+    def stats(self):
+        # Totals for each torrent without its peers, which at a few hundred peers would outgrow one packet
+        metrics = self.session.metrics()
+        metrics["torrents"] = [{key: value for key, value in torrent.items() if key != "peers"}
+                               for torrent in metrics["torrents"]]
+        return {"type": "stats", "worker": self.index, **metrics}
+
+    async def send(self, message):
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(self.channel, json.dumps(message).encode())
+
+    async def report(self):
+        while True:
+            try:
+                await self.send(self.stats())
+            except OSError:
+                # A report that did not fit or a channel that is gone, the next round tries again and the
+                # channel's reader notices if the supervisor has left
+                pass
+            await asyncio.sleep(STATS_INTERVAL)
+
+    def receive(self):
+        for message, fds in receive_messages(self.channel):
+            if message is None:
+                # The supervisor is gone, nobody is left to route connections or read our stats
+                asyncio.ensure_future(self.session.close())
+                return
+            handler = self.handlers.get(message["type"])
+            if handler:
+                handler(message, fds)
+            else:
+                for fd in fds:
+                    os.close(fd)
+
+    def on_connection(self, message, fds):
+        if fds:
+            asyncio.ensure_future(self.accept(fds[0], bytes.fromhex(message["handshake"])))
+
+    async def accept(self, fd, handshake):
+        sock = socket.socket(fileno=fd)
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except OSError:
+            sock.close()
+            return
+        self.session.seeder.route(reader, writer, Handshake.decode(handshake))
+
+    def on_add(self, message, fds):
+        self.session.add(message["file"], self.location, **self.torrent_options)
+
+    def on_pause(self, message, fds):
+        self.session.pause(bytes.fromhex(message["info_hash"]))
+
+    def on_resume(self, message, fds):
+        self.session.resume(bytes.fromhex(message["info_hash"]))
+
+    def on_remove(self, message, fds):
+        asyncio.ensure_future(self.session.remove(bytes.fromhex(message["info_hash"])))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.channel.setblocking(False)
+        loop.add_reader(self.channel.fileno(), self.receive)
+        for file in self.files:
+            self.session.add(file, self.location, **self.torrent_options)
+        await self.session.start_dht()
+
+        report_task = asyncio.create_task(self.report())
+        monitor_task = asyncio.create_task(self.session.monitor.run())
+        try:
+            # Session.run without the listener, and with the final stats sent before the torrents are closed
+            self.session.check_idle()
+            await self.session.idle.wait()
+            report_task.cancel()
+            await self.send(self.stats())
+        except OSError:
+            pass
+        finally:
+            report_task.cancel()
+            monitor_task.cancel()
+            loop.remove_reader(self.channel.fileno())
+            await self.session.close()
+            self.channel.close()
+
+
+def run_worker(index, channel, files, location, session_options, torrent_options):
+    # The supervisor reports for every worker, a progress bar from each process would only garble the terminal
+    sys.stdout = open(os.devnull, "w")
+    # Spawned, so nothing of the supervisor's logging setup carries over
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format=f"\n%(asctime)s worker {index} %(levelname)s %(message)s")
+    asyncio.run(Worker(index, channel, files, location, session_options, torrent_options).run())
+
+
+class Supervisor:
+    def __init__(self, files, workers=None, location=None, port=LISTEN_PORT, max_connections=None, max_download=None,
+                 max_upload=None, cache_budget=READ_CACHE_BUDGET, hash_workers=None, hash_processes=False,
+                 write_cache_budget=WRITE_CACHE_BUDGET, stats_port=None, stats_file=None, dht_port=None, dht_state=None,
+                 **torrent_options):
+        count = max(min(int(workers) if workers else os.cpu_count() or 1, len(files)), 1)
+        self.port = port
+        self.location = location
+        self.torrent_options = torrent_options
+        # Processes cannot share buckets or caches, so each worker gets an even slice of the budgets
+        connections = int(max_connections) if max_connections else DEFAULT_MAX_CONNECTIONS
+        hash_workers = int(hash_workers) if hash_workers else max((os.cpu_count() or 1) // count, 1)
+        self.session_options = {"port": port, "max_connections": max(connections // count, 1),
+                                "max_download": share(max_download, count), "max_upload": share(max_upload, count),
+                                "cache_budget": cache_budget // count,
+                                "hash_workers": hash_workers, "hash_processes": hash_processes,
+                                "write_cache_budget": write_cache_budget // count,
+                                "dht_port": int(dht_port) if dht_port is not None else None, "dht_state": dht_state}
+        # worker -> torrent files it was started with
+        self.shards = [[] for _ in range(count)]
+        # info_hash -> worker running the torrent
+        self.owners = {}
+        for i, file in enumerate(files):
+            self.assign(file, i % count)
+        self.processes = []
+        self.channels = []
+        # worker -> its last stats message
+        self.stats = [{} for _ in range(count)]
+        # The workers' stats are served from here, they have no listener of their own
+        self.stats_server = StatsServer(self.metrics, int(stats_port)) if stats_port else None
+        self.stats_file = StatsFile(self.metrics, stats_file) if stats_file else None
+
+    def assign(self, file, index):
+        info_hash = info_hash_of(file)
+        if info_hash in self.owners:
+            return None
+        self.owners[info_hash] = index
+        self.shards[index].append(file)
+        return info_hash
+
+    def worker_session_options(self, index):
+        # Workers cannot share a UDP socket or a node id, each runs its own DHT node on the next port along
+        options = dict(self.session_options)
+        if options["dht_port"]:
+            options["dht_port"] += index
+        if options["dht_state"]:
+            options["dht_state"] = f"{options['dht_state']}.{index}"
+        return options
+
+    def receive(self, index):
+        for message, fds in receive_messages(self.channels[index]):
+            for fd in fds:
+                os.close(fd)
+            if message is None:
+                asyncio.get_running_loop().remove_reader(self.channels[index].fileno())
+                return
+            if message["type"] == "stats":
+                self.stats[index] = message
+
+    async def send(self, index, message):
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(self.channels[index], json.dumps(message).encode())
+
+    async def add(self, file):
+        alive = [i for i, process in enumerate(self.processes) if process.is_alive()]
+        if not alive:
+            return None
+        index = min(alive, key=lambda i: len(self.shards[i]))
+        info_hash = self.assign(file, index)
+        if info_hash:
+            await self.send(index, {"type": "add", "file": file})
+        return info_hash
+
+    async def control(self, info_hash, action):
+        index = self.owners.get(info_hash)
+        if index is None or not self.processes[index].is_alive():
+            return False
+        await self.send(index, {"type": action, "info_hash": info_hash.hex()})
+        return True
+
+    async def pause(self, info_hash):
+        return await self.control(info_hash, "pause")
+
+    async def resume(self, info_hash):
+        return await self.control(info_hash, "resume")
+
+    async def remove(self, info_hash):
+        removed = await self.control(info_hash, "remove")
+        self.owners.pop(info_hash, None)
+        return removed
+
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        try:
+            server = socket.create_server(("0.0.0.0", self.port))
+        except OSError as e:
+            logger.error("Not listening for peers: %s", e)
+            return
+        server.setblocking(False)
+        with server:
+            while True:
+                conn, _ = await loop.sock_accept(server)
+                asyncio.create_task(self.route(conn))
+
+    async def route(self, conn):
+        loop = asyncio.get_running_loop()
+        try:
+            # Exactly the handshake is read, anything the peer sent after it stays in the socket for the worker
+            data = b''
+            while len(data) < HANDSHAKE_LENGTH:
+                chunk = await asyncio.wait_for(loop.sock_recv(conn, HANDSHAKE_LENGTH - len(data)), HANDSHAKE_TIMEOUT)
+                if not chunk:
+                    return
+                data += chunk
+
+            index = self.owners.get(Handshake.decode(data).info_hash)
+            if index is not None and self.processes[index].is_alive():
+                # The worker gets its own copy of the descriptor, ours is closed below
+                send_message(self.channels[index], {"type": "connection", "handshake": data.hex()}, [conn.fileno()])
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            conn.close()
+
+    def aggregate(self):
+        torrents = [torrent for worker in self.stats for torrent in worker.get("torrents", ())]
+        lags = [worker["loop_lag"] for worker in self.stats if "loop_lag" in worker]
+        hashers = [worker["hasher"] for worker in self.stats if "hasher" in worker]
+        return {"loop_lag_p99": max((lag["p99"] for lag in lags), default=0),
+                "loop_lag_max": max((lag["max"] for lag in lags), default=0),
+                "hashed": sum(hasher["bytes"] for hasher in hashers), "torrents": len(torrents),
+                "complete": sum(torrent["complete"] for torrent in torrents),
+                "peers": sum(torrent["connected"] for torrent in torrents),
+                "length": sum(torrent["length"] for torrent in torrents),
+                "downloaded": sum(torrent["downloaded"] for torrent in torrents),
+                "uploaded": sum(torrent["uploaded"] for torrent in torrents)}
+
+    def metrics(self):
+        workers = [{"id": index, **{key: value for key, value in stats.items() if key not in ("type", "worker")}}
+                   for index, stats in enumerate(self.stats)]
+        return {**self.aggregate(), "workers": workers}
+
+    def report_progress(self):
+        stats = self.aggregate()
+        downloaded = round(stats['downloaded'] / 1024 ** 2, 2)
+        length = round(stats['length'] / 1024 ** 2, 2)
+        uploaded = round(stats['uploaded'] / 1024 ** 2, 2)
+        sys.stdout.write(f"\r{stats['complete']}/{stats['torrents']} complete, {stats['peers']} peers, "
+                         f"{downloaded} out of {length} MB down, {uploaded} MB up, "
+                         f"loop lag p99 {stats['loop_lag_p99']} ms")
+        sys.stdout.flush()
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            self.report_progress()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # Spawned rather than forked, a forked child would inherit this process's running event loop
+        context = multiprocessing.get_context("spawn")
+        for index, files in enumerate(self.shards):
+            channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            # Not daemonic, so that a worker may start its own hashing processes
+            process = context.Process(target=run_worker,
+                                      args=(index, child, files, self.location, self.worker_session_options(index),
+                                            self.torrent_options))
+            process.start()
+            child.close()
+            channel.setblocking(False)
+            loop.add_reader(channel.fileno(), self.receive, index)
+            self.processes.append(process)
+            self.channels.append(channel)
+
+        tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.report())]
+        if self.stats_server:
+            await self.stats_server.start()
+        if self.stats_file:
+            tasks.append(asyncio.create_task(self.stats_file.run()))
+        try:
+            await asyncio.gather(*(loop.run_in_executor(None, process.join) for process in self.processes))
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.stats_server:
+                self.stats_server.close()
+            if self.stats_file:
+                self.stats_file.write()
+            for channel in self.channels:
+                loop.remove_reader(channel.fileno())
+                channel.close()
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+
+        self.report_progress()
+        print()
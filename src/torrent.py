@@ -1,207 +1,152 @@
 import asyncio
-import hashlib
-import random
-import socket
-import ssl
 import struct
-import sys
-import time
-import urllib
-from socket import *
-
-import bencodepy
+import urllib.parse
+from socket import inet_ntoa
 
 from block_handler import BlockHandler
+from cache import WRITE_CACHE_BUDGET
+from choker import Choker
+from connection_manager import ConnectionManager
+from dht import DHTSearch
 from info import MetaInfo
 from peer import Peer
-from seed import Seeder
-
-DOWNLOAD_REQUEST_SIZE = 2 ** 14
+from reader import TorrentReader
+from resume import Resume
+from seed import LISTEN_PORT, Seeder
+from tracker import TrackerClient
 
 
 class Torrent:
-    def __init__(self, file, location=None, max_download=None, max_peers=None):
-        self.meta_info = MetaInfo(file, location, max_download, max_peers)
-        self.downloading_peers = []
-        self.block_handler = BlockHandler(self.meta_info)
-        self.last_tracker_request = 0
-        self.unchoked_peers = []
-        self.seeder = Seeder(self, self.block_handler)
-
-    async def top_four(self):
-        while True:
-            for peer in self.unchoked_peers:
-                await peer.send_choke()
-            temp_peers = [peer for peer in self.downloading_peers]
-            temp_peers.sort(key=lambda x: x.statistics["download_speed"])
-            top_peers = temp_peers[-4:]
-            for peer in top_peers:
-                await peer.send_unchoke()
-            self.unchoked_peers = top_peers
-            await asyncio.sleep(10.0)
-
-    def add_peer(self, peer):
-        self.downloading_peers.append(peer)
-
-    def make_request(self, meta_info, url):
-        parsed_url = urllib.parse.urlparse(self.meta_info.data[b'announce'].decode())
-        try:
-            host, port = parsed_url.netloc.split(":")
-        except ValueError:
-            host = parsed_url.netloc
-            port = None
-
-        if parsed_url.scheme == 'https' or parsed_url.scheme == 'http':
-            client = socket(AF_INET, SOCK_STREAM)
-
-            if parsed_url.scheme == 'https':
-                try:
-                    client.connect((parsed_url.netloc, 443))
-                except Exception:
-                    client.close()
-                    raise Exception("Failed while connecting to tracker")
-                client = ssl.wrap_socket(client, keyfile=None, certfile=None, server_side=False,
-                                         cert_reqs=ssl.CERT_NONE,
-                                         ssl_version=ssl.PROTOCOL_SSLv23)
-            elif parsed_url.scheme == 'http':
-                try:
-                    client.connect((host, int(port) if port else 80))
-                except Exception:
-                    client.close()
-                    raise Exception("Failed while connecting to tracker")
-            msg = f"GET /announce?{meta_info} HTTP/1.1\r\nHost: {host}\r\nnConnection: close\r\n\r\n"
-            client.send(msg.encode())
-            response = b''
-            while True:
-                data = client.recv(65535)
-                if not data:
-                    client.close()
-                    break
-                response += data
-            index = response.find(b'\r\n\r\n')
-            if index >= 0:
-                return response[index + 4:]
-            return response
-        elif parsed_url.scheme == 'udp':
-            client = socket(AF_INET, SOCK_DGRAM)
-            transaction_id = random.getrandbits(16)
-            msg = struct.pack('!qii', 0x41727101980, 0, transaction_id)
-            client.sendto(msg, (host, int(port)))
-            client.settimeout(10.0)
-            while True:
-                try:
-                    data = client.recvfrom(1024)
-                    break
-                except:
-                    client.close()
-                    raise Exception("UDP Timeout")
-            client.settimeout(120)
-            try:
-                decoded_data = struct.unpack("!iiq", data[0])
-                if int(decoded_data[1]) != int(transaction_id):
-                    raise Exception("Transaction ID does not match")
-                transaction_id = random.getrandbits(16)
-                msg = struct.pack('!qii20s20sqqqiiiih', decoded_data[2], 1, transaction_id, url['info_hash'],
-                                  url['peer_id'].encode(), url['downloaded'], url['left'], url['uploaded'], 0, 0,
-                                  transaction_id, -1, url['port'])
-                client.sendto(msg, (host, int(port)))
-                old_time = client.gettimeout()
-                client.settimeout(15)
-                while True:
-                    try:
-                        announce_data = client.recvfrom(65535)
-                        break
-                    except (Exception,):
-                        client.settimeout(15)
-                        client.sendto(msg, (host, int(port)))
-                        old_time -= 15
-                        if old_time < 0:
-                            client.close()
-                            raise Exception("Announce timed out")
-
-                decoded_announce_data = struct.unpack(f"!iiiii{len(announce_data[0]) - 20}s", announce_data[0])
-                if transaction_id != decoded_announce_data[1]:
-                    raise Exception("Transaction ID does not match")
-                announce_data_dict = {'complete': decoded_announce_data[4], 'incomplete': decoded_announce_data[3],
-                                      'interval': decoded_announce_data[2], 'peers': decoded_announce_data[5]}
-                response = bencodepy.encode(announce_data_dict)
-                return response
-            except Exception as e:
-                client.close()
-                raise Exception(e)
+    def __init__(self, file, location=None, max_download=None, max_peers=None, pipeline_depth=None, recheck=False,
+                 max_upload=None, max_peer_download=None, max_peer_upload=None, unchoke_slots=None, port=LISTEN_PORT,
+                 listen=True, hasher=None, write_cache_budget=WRITE_CACHE_BUDGET, sequential=False, dht=None,
+                 seed=True):
+        self.meta_info = MetaInfo(file, location, max_download, max_peers, pipeline_depth, max_upload,
+                                  max_peer_download, max_peer_upload)
+        self.block_handler = BlockHandler(self.meta_info, hasher, write_cache_budget)
+        self.connection_manager = ConnectionManager(self, self.meta_info.max_peers)
+        self.resume = Resume(self.meta_info, self.block_handler)
+        self.recheck = recheck
+        # Download in order from the start, readers opened on the torrent move the window themselves
+        self.sequential = sequential
+        self.restored = False
+        # Stay connected and upload once complete
+        self.seed = seed
+        self.tracker = TrackerClient(self.meta_info.trackers)
+        # BEP 27, peers of a private torrent come from its trackers only
+        private = self.meta_info.data[b'info'].get(b'private') == 1
+        self.dht_search = DHTSearch(dht, self.meta_info.info_hash, port) if dht and not private else None
+        # Set by the first tracker response or the first peers from the DHT, whichever comes first
+        self.has_peers = asyncio.Event()
+        self.choker = Choker(self.connection_manager, self.block_handler, unchoke_slots)
+        self.port = port
+        # Inside a session the session's listener routes connections to us instead
+        self.seeder = Seeder({self.meta_info.info_hash: self}, port) if listen else None
+        self.active = False
 
     def create_url(self):
-        info = self.meta_info.data[b'info']
-        self.meta_info.left = self.meta_info.length if self.meta_info.left == 0 else \
-            self.meta_info.length - self.block_handler.download_amount
-
-        encoded_info = bencodepy.encode(info)
-        info_hash = hashlib.sha1(encoded_info).digest()
-        self.meta_info.info_hash = info_hash
-        peer_id = '-PC3153-' + ''.join(
-            [str(random.randint(0, 9)) for _ in range(12)]) if self.meta_info.id == "" else self.meta_info.id
-        self.meta_info.id = peer_id
-        url = {'info_hash': info_hash, 'peer_id': self.meta_info.id, 'port': 6885, 'left': self.meta_info.left,
-               'uploaded': 0, 'downloaded': self.block_handler.download_amount, 'compact': 1}
+        self.meta_info.left = self.meta_info.length - self.block_handler.download_amount
+        url = {'info_hash': self.meta_info.info_hash, 'peer_id': self.meta_info.id, 'port': self.port,
+               'left': self.meta_info.left, 'uploaded': self.block_handler.upload_amount,
+               'downloaded': self.block_handler.download_amount, 'compact': 1}
         encoded_url = urllib.parse.urlencode(url)
         return encoded_url, url
 
-    def parse_response(self, response_data):
-        decoded_response = bencodepy.decode(response_data)
-        peers = decoded_response[b'peers']
-        offset = 0
-        while offset < len(peers):
-            ip_number = struct.unpack_from("!I", peers, offset)[0]
-            ip = inet_ntoa(struct.pack("!I", ip_number))
-            offset += 4
-            port = struct.unpack_from("!H", peers, offset)[0]
-            offset += 2
-            self.meta_info.peers.add((ip, port))
+    def parse_response(self, decoded_response):
+        peers = decoded_response.get(b'peers', b'')
+        if isinstance(peers, list):
+            # Trackers that ignore compact=1 send a list of dictionaries
+            found = [(peer[b'ip'].decode(), peer[b'port']) for peer in peers]
+        else:
+            found = []
+            offset = 0
+            while offset + 6 <= len(peers):
+                ip_number = struct.unpack_from("!I", peers, offset)[0]
+                ip = inet_ntoa(struct.pack("!I", ip_number))
+                offset += 4
+                port = struct.unpack_from("!H", peers, offset)[0]
+                offset += 2
+                found.append((ip, port))
+        self.add_peers(found)
+
+    def add_peers(self, found):
+        self.connection_manager.add_candidates(found)
+        self.has_peers.set()
+
+    def request_peers(self):
+        self.tracker.request_peers()
+        if self.dht_search:
+            self.dht_search.request_peers()
+
+    def accept(self, reader, writer, handshake):
+        # An inbound connection whose handshake has already been read
+        address = writer.get_extra_info('peername')
+        peer = Peer(self.meta_info.id, self.meta_info.info_hash, self.meta_info.num_pieces, address[0], address[1],
+                    self.block_handler, (reader, writer), self.meta_info.pipeline_depth, handshake=handshake)
+        self.connection_manager.add_peer(peer)
 
     async def message_peers(self):
-        for index, value in enumerate(self.meta_info.peers):
-            if index < int(self.meta_info.max_peers):
-                self.downloading_peers.append(
-                    Peer(self.meta_info.id, self.meta_info.info_hash, self.meta_info.num_pieces, value[0], value[1],
-                         self.block_handler))
-
-        top_peers_task = asyncio.create_task(self.top_four())
-
-        while True:
+        while not self.block_handler.is_complete():
             await asyncio.sleep(5)
-            for peer in self.downloading_peers:
-                if peer.task.cancelled():
-                    self.downloading_peers.remove(peer)
-                    self.block_handler.remove_bitfield(peer.remote_id)
-                    self.meta_info.peers.discard((peer.ip, peer.port))
-
-            current_time = int(round(time.time() * 1000))
-            if self.last_tracker_request + 120000 < current_time:
-                await asyncio.to_thread(self.tracker_request)
-            if self.block_handler.is_complete():
-                top_peers_task.cancel()
-                break
-
-        print("COMPLETED")
-
-    def tracker_request(self):
-        self.last_tracker_request = int(round(time.time() * 1000))
-        encoded_url, url = self.create_url()
-        i = 0
-        response_data = ""
-        while i < len(self.meta_info.trackers):
-            try:
-                self.meta_info.data[b'announce'] = self.meta_info.trackers[i][0]
-                response_data = self.make_request(encoded_url, url)
-                break
-            except (Exception,):
-                i += 1
-                if i == len(self.meta_info.trackers):
-                    print("Failed to establish connection with trackers")
-                    sys.exit(0)
-
-        self.parse_response(response_data)
+            self.resume.save_if_changed()
 
     async def torrent_start(self):
-        self.tracker_request()
-        await self.message_peers()
+        # Downloads, then seeds until the torrent is paused or removed, both of which cancel this task. Without
+        # seed it returns once the download completes. Started again it picks up where it left off.
+        self.active = True
+        tasks = []
+        try:
+            if not self.restored:
+                await self.resume.restore(self.recheck)
+                self.restored = True
+                if self.sequential and self.block_handler.cursor is None:
+                    self.block_handler.set_cursor(0)
+            if self.block_handler.is_complete() and not self.seed:
+                # Nothing to download or upload, so no reason to wait on trackers that may never answer
+                return
+            if self.seeder:
+                await self.seeder.start()
+            # Inbound peers may arrive before any tracker answers, they get unchoked all the same
+            tasks.append(asyncio.create_task(self.choker.run()))
+            tasks.append(asyncio.create_task(self.tracker.run(lambda: self.create_url()[1], self.parse_response)))
+            if self.dht_search:
+                tasks.append(asyncio.create_task(self.dht_search.run(self.add_peers)))
+            await self.has_peers.wait()
+            tasks.append(asyncio.create_task(self.connection_manager.run()))
+
+            # Only a download we saw finish is announced as completed
+            downloading = not self.block_handler.is_complete()
+            await self.message_peers()
+            if downloading:
+                print("COMPLETED")
+                await self.tracker.announce(self.create_url()[1], "completed")
+            if self.seed:
+                # The trackers keep announcing us and the choker keeps serving, until we are cancelled
+                await asyncio.Event().wait()
+        finally:
+            self.active = False
+            for task in tasks:
+                task.cancel()
+            if self.seeder:
+                self.seeder.close()
+            self.connection_manager.close()
+            await self.block_handler.flush()
+            self.resume.save_if_changed()
+            await self.tracker.stop(self.create_url()[1])
+
+    def metrics(self):
+        peers = list(self.connection_manager.peers.values())
+        name = self.meta_info.data[b'info'][b'name'].decode(errors="replace")
+        return {"id": self.meta_info.info_hash.hex(), "name": name, "length": self.meta_info.length,
+                "complete": self.block_handler.is_complete(), "connected": len(peers),
+                "unchoked": sum(peer.am_choking == 0 for peer in peers),
+                "unchoked_by": sum(peer.peer_choking == 0 for peer in peers),
+                **self.block_handler.metrics(), "peers": [peer.metrics() for peer in peers]}
+
+    def open(self, file=0):
+        # A reader over one of the torrent's files, it streams that file while the torrent runs
+        index = self.meta_info.file_index
+        return TorrentReader(self.block_handler, index.starts[file], index.lengths[file])
+
+    def close(self):
+        self.block_handler.close()
@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import random
+import ssl
+import struct
+import time
+import urllib.parse
+
+import bencode
+
+logger = logging.getLogger("bittorrent")
+
+UDP_PROTOCOL_ID = 0x41727101980
+UDP_CONNECT = 0
+UDP_ANNOUNCE = 1
+UDP_ERROR = 3
+UDP_EVENTS = {"": 0, "completed": 1, "started": 2, "stopped": 3}
+# BEP 15, a connection id may be reused for one minute
+CONNECTION_ID_LIFETIME = 60
+UDP_TIMEOUT = 5
+UDP_RETRIES = 3
+HTTP_TIMEOUT = 15
+MIN_BACKOFF = 15
+MAX_BACKOFF = 1800
+DEFAULT_INTERVAL = 120
+# Early announces for more peers are never closer together than this, whatever min interval says
+EARLY_ANNOUNCE_GAP = 60
+# How long a pause or removal waits for the trackers to take our stopped announce
+STOPPED_TIMEOUT = 5
+
+
+class TrackerError(Exception):
+    pass
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        # transaction id -> future waiting for the response
+        self.waiters = {}
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack_from("!i", data, 4)[0]
+        waiter = self.waiters.pop(transaction_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        self.fail(exc)
+
+    def connection_lost(self, exc):
+        self.fail(exc if exc else TrackerError("Socket closed"))
+
+    def fail(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.waiters.clear()
+
+
+class Tracker:
+    def __init__(self, url):
+        self.url = url
+        self.parsed_url = urllib.parse.urlparse(url)
+        try:
+            self.port = self.parsed_url.port
+        except ValueError:
+            self.port = None
+        self.failures = 0
+        # time.monotonic() before which the tracker is backing off
+        self.next_attempt = 0
+        self.connection_id = None
+        self.connection_time = 0
+
+    def supported(self):
+        if self.parsed_url.hostname is None:
+            return False
+        if self.parsed_url.scheme == "udp":
+            return self.port is not None
+        return self.parsed_url.scheme in ("http", "https")
+
+    def available(self, now):
+        return self.supported() and now >= self.next_attempt
+
+    def succeeded(self):
+        self.failures = 0
+        self.next_attempt = 0
+
+    def failed(self):
+        self.failures += 1
+        delay = min(MAX_BACKOFF, MIN_BACKOFF * 2 ** (self.failures - 1))
+        # Jitter so that trackers which failed together do not retry together
+        self.next_attempt = time.monotonic() + delay * random.uniform(0.75, 1.25)
+
+    async def announce(self, params, event=""):
+        if self.parsed_url.scheme == "udp":
+            return await self.udp_announce(params, event)
+        return await self.http_announce(params, event)
+
+    async def http_announce(self, params, event):
+        query = dict(params)
+        if event:
+            query["event"] = event
+        encoded_query = urllib.parse.urlencode(query)
+        path = self.parsed_url.path if self.parsed_url.path else "/"
+        if self.parsed_url.query:
+            path += f"?{self.parsed_url.query}&{encoded_query}"
+        else:
+            path += f"?{encoded_query}"
+
+        host = self.parsed_url.hostname
+        https = self.parsed_url.scheme == "https"
+        port = self.port if self.port else (443 if https else 80)
+        context = ssl.create_default_context() if https else None
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context), HTTP_TIMEOUT)
+        try:
+            # HTTP/1.0 so that the body is never chunked and ends when the connection closes
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {self.parsed_url.netloc}\r\nConnection: close\r\n\r\n".encode())
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), HTTP_TIMEOUT)
+        finally:
+            writer.close()
+
+        header, _, body = response.partition(b'\r\n\r\n')
+        status_line = header.split(b'\r\n', 1)[0]
+        status = status_line.split()
+        if len(status) < 2 or status[1] != b'200':
+            raise TrackerError(f"Tracker replied {status_line!r}")
+
+        decoded_response = bencode.decode(body)
+        if not isinstance(decoded_response, bencode.Dict):
+            raise TrackerError("Tracker replied with something other than a dictionary")
+        if b'failure reason' in decoded_response:
+            raise TrackerError(decoded_response[b'failure reason'].decode(errors="replace"))
+        return decoded_response
+
+    async def udp_request(self, transport, protocol, msg, transaction_id):
+        loop = asyncio.get_running_loop()
+        for attempt in range(UDP_RETRIES):
+            waiter = loop.create_future()
+            protocol.waiters[transaction_id] = waiter
+            transport.sendto(msg)
+            try:
+                data = await asyncio.wait_for(waiter, UDP_TIMEOUT * 2 ** attempt)
+            except asyncio.TimeoutError:
+                continue
+
+            action = struct.unpack_from("!i", data)[0]
+            if action == UDP_ERROR:
+                # Most errors are an expired connection id, so make sure it is not reused
+                self.connection_id = None
+                raise TrackerError(data[8:].decode(errors="replace"))
+            return data
+        raise TrackerError("UDP tracker timed out")
+
+    async def udp_connect(self, transport, protocol):
+        now = time.monotonic()
+        if self.connection_id is not None and now - self.connection_time < CONNECTION_ID_LIFETIME:
+            return self.connection_id
+
+        transaction_id = random.getrandbits(31)
+        msg = struct.pack("!qii", UDP_PROTOCOL_ID, UDP_CONNECT, transaction_id)
+        data = await self.udp_request(transport, protocol, msg, transaction_id)
+        if len(data) < 16:
+            raise TrackerError("Short connect response")
+        self.connection_id = struct.unpack_from("!q", data, 8)[0]
+        self.connection_time = now
+        return self.connection_id
+
+    async def udp_announce(self, params, event):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            UDPTrackerProtocol, remote_addr=(self.parsed_url.hostname, self.port))
+        try:
+            connection_id = await self.udp_connect(transport, protocol)
+            transaction_id = random.getrandbits(31)
+            msg = struct.pack("!qii20s20sqqqiiiiH", connection_id, UDP_ANNOUNCE, transaction_id,
+                              params['info_hash'], params['peer_id'].encode(), params['downloaded'], params['left'],
+                              params['uploaded'], UDP_EVENTS[event], 0, random.getrandbits(31), -1, params['port'])
+            data = await self.udp_request(transport, protocol, msg, transaction_id)
+        finally:
+            transport.close()
+
+        if len(data) < 20:
+            raise TrackerError("Short announce response")
+        _, _, interval, leechers, seeders = struct.unpack_from("!iiiii", data)
+        return {b'interval': interval, b'incomplete': leechers, b'complete': seeders, b'peers': data[20:]}
+
+
+class TrackerClient:
+    def __init__(self, trackers):
+        # BEP 12, trackers are tried tier by tier and each tier starts out shuffled
+        self.tiers = []
+        for tier in trackers:
+            urls = [url.decode() if isinstance(url, bytes) else url for url in tier]
+            random.shuffle(urls)
+            self.tiers.append([Tracker(url) for url in urls])
+        self.event = "started"
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = 0
+        self.last_announce = 0
+        self.wakeup = asyncio.Event()
+
+    async def try_announce(self, tracker, params, event):
+        try:
+            response = await tracker.announce(params, event)
+        except Exception:
+            # Whatever one tracker sends or fails with is its own failure, the others and later announces carry on
+            tracker.failed()
+            return None
+        tracker.succeeded()
+        return response
+
+    async def announce(self, params, event=""):
+        # Announces to every usable tracker of the first tier that answers, all at once
+        now = time.monotonic()
+        for tier in self.tiers:
+            candidates = [tracker for tracker in tier if tracker.available(now)]
+            if not candidates:
+                continue
+
+            results = await asyncio.gather(*(self.try_announce(tracker, params, event) for tracker in candidates))
+            responses = []
+            for tracker, response in zip(candidates, results):
+                if response is not None:
+                    # A tracker that answered moves to the front of its tier
+                    tier.remove(tracker)
+                    tier.insert(0, tracker)
+                    responses.append(response)
+            if responses:
+                return responses
+        return []
+
+    def request_peers(self):
+        # Ask for an early announce, still no sooner than the tracker's min interval allows
+        self.wakeup.set()
+
+    def retry_delay(self):
+        now = time.monotonic()
+        attempts = [tracker.next_attempt for tier in self.tiers for tracker in tier if tracker.supported()]
+        if not attempts:
+            return MAX_BACKOFF
+        return max(MIN_BACKOFF, min(attempts) - now)
+
+    def intervals(self, response):
+        try:
+            interval = max(int(response.get(b'interval', DEFAULT_INTERVAL)), 1)
+            return interval, min(int(response.get(b'min interval', 0)), interval)
+        except (TypeError, ValueError):
+            return DEFAULT_INTERVAL, 0
+
+    async def stop(self, params):
+        # Only trackers that took our started announce have us listed
+        if self.event:
+            return
+        self.event = "started"
+        try:
+            await asyncio.wait_for(self.announce(params, "stopped"), STOPPED_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self, get_params, on_response):
+        while True:
+            responses = await self.announce(get_params(), self.event)
+            self.last_announce = time.monotonic()
+            if responses:
+                self.event = ""
+                self.interval, self.min_interval = self.intervals(responses[0])
+                for response in responses:
+                    try:
+                        on_response(response)
+                    except (KeyError, TypeError, ValueError, AttributeError) as e:
+                        # A malformed response is dropped, the announces carry on
+                        logger.warning("Bad tracker response: %r", e)
+                delay = self.interval
+            else:
+                logger.warning("Failed to establish connection with trackers, retrying")
+                delay = self.retry_delay()
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+                # Woken early for more peers, which is only worth it once the trackers are answering
+                gap = max(self.min_interval, EARLY_ANNOUNCE_GAP) if responses else delay
+                remaining = self.last_announce + gap - time.monotonic()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+            except asyncio.TimeoutError:
+                pass
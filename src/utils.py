@@ -1,4 +1,7 @@
+import random
 import struct
+from bisect import bisect_right
+from itertools import accumulate
 
 
 async def send_interested_message(writer) -> None:
@@ -7,12 +10,33 @@ async def send_interested_message(writer) -> None:
     await writer.drain()
 
 
-def get_file(piece, files, piece_size) -> int:
-    piece_start = piece.index * piece_size
-    file_index = 0
-    for index, file in enumerate(files):
-        if file['start'] <= piece_start:
-            file_index = index
-        else:
-            break
-    return file_index
+def generate_peer_id():
+    return '-PC3153-' + ''.join([str(random.randint(0, 9)) for _ in range(12)])
+
+
+class FileIndex:
+    def __init__(self, files, piece_size):
+        self.piece_size = piece_size
+        self.lengths = [file["length"] for file in files]
+        # Offset of each file's first byte in the torrent, sorted so that it can be bisected
+        self.starts = list(accumulate(self.lengths, initial=0))
+        self.length = self.starts.pop()
+
+    def range_spans(self, offset, length) -> list:
+        # (file index, offset in the file, length) for every file the torrent range touches
+        spans = []
+        end = min(offset + length, self.length)
+        i = bisect_right(self.starts, offset) - 1
+        while i < len(self.starts) and self.starts[i] < end:
+            start = self.starts[i]
+            if self.lengths[i]:
+                file_offset = max(offset, start) - start
+                spans.append((i, file_offset, min(start + self.lengths[i], end) - start - file_offset))
+            i += 1
+        return spans
+
+    def spans(self, piece, begin=0, length=None) -> list:
+        offset = piece * self.piece_size + begin
+        if length is None:
+            length = self.piece_size - begin
+        return self.range_spans(offset, length)
@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode  # noqa: E402
+from bencode import MAX_DEPTH, BencodeError  # noqa: E402
+
+
+class DecodeTest(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(bencode.decode(b'i-42e'), -42)
+        self.assertEqual(bencode.decode(b'4:spam'), b'spam')
+        self.assertEqual(bencode.decode(b'0:'), b'')
+        self.assertEqual(bencode.decode(b'li1e3:abce'), [1, b'abc'])
+        value = bencode.decode(b'd1:ai1e1:bl1:xee')
+        self.assertIsInstance(value, bencode.Dict)
+        self.assertEqual(dict(value), {b'a': 1, b'b': [b'x']})
+
+    def test_truncated(self):
+        for data in (b'', b'i12', b'5:abc', b'l', b'li1e', b'd', b'd1:a', b'd1:ai1e', b'd1:al', b'12'):
+            with self.subTest(data=data), self.assertRaises(BencodeError):
+                bencode.decode(data)
+
+    def test_trailing_data(self):
+        with self.assertRaises(BencodeError):
+            bencode.decode(b'i1ei2e')
+
+    def test_non_canonical_ints(self):
+        for data in (b'i01e', b'i-0e', b'i+1e', b'i 1e', b'i1_0e', b'ie', b'i-e', b'03:abc', b'-1:a'):
+            with self.subTest(data=data), self.assertRaises(BencodeError):
+                bencode.decode(data)
+
+    def test_nesting_depth(self):
+        value, levels = bencode.decode(b'l' * MAX_DEPTH + b'e' * MAX_DEPTH), 1
+        while value:
+            value, levels = value[0], levels + 1
+        self.assertEqual(levels, MAX_DEPTH)
+        deep = (b'l' * (MAX_DEPTH + 1) + b'e' * (MAX_DEPTH + 1), b'd1:a' * 3000 + b'i1e' + b'e' * 3000,
+                b'l' * 3000 + b'e' * 3000, b'd1:al' + b'l' * 100 + b'e' * 102)
+        for data in deep:
+            with self.subTest(data=data[:8]), self.assertRaises(BencodeError):
+                bencode.decode(data)
+
+    def test_plain(self):
+        value = bencode.decode(b'd5:filesld6:lengthi3e4:pathl1:aeeee')
+        self.assertEqual(value.plain(b'files'), [{b'length': 3, b'path': [b'a']}])
+        with self.assertRaises(BencodeError):
+            bencode.decode(b'd5:filesld6:lengtheee').plain(b'files')
+
+
+class RoundTripTest(unittest.TestCase):
+    def test_raw_and_encode(self):
+        info = {b'name': b'a.bin', b'piece length': 2 ** 14, b'pieces': bytes(range(40)),
+                b'files': [{b'length': 5, b'path': [b'dir', b'a']}]}
+        data = bencode.encode({b'announce': b'http://tracker/announce', b'info': info})
+        value = bencode.decode(data)
+        self.assertEqual(bytes(value.raw(b'info')), bencode.encode(info))
+        self.assertEqual(bytes(value.raw()), data)
+        self.assertEqual(bytes(value[b'info'].view(b'pieces')), info[b'pieces'])
+        # A decoded Dict encodes back to the bytes it came from, nested inside a new value or not
+        self.assertEqual(bencode.encode(value), data)
+        self.assertEqual(bencode.encode([value[b'info']]), b'l' + bencode.encode(info) + b'e')
+
+    def test_encode_sorts_keys(self):
+        self.assertEqual(bencode.encode({"b": 1, b'a': [b'x', "y"]}), b'd1:al1:x1:ye1:bi1ee')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode  # noqa: E402
+from dht import DHT, PROTOCOL_ERROR  # noqa: E402
+
+
+class Client(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.replies.put_nowait(bencode.decode(data))
+
+
+class DHTMessageTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.node = DHT(0, os.path.join(self.directory.name, "node.dht"), (), host="127.0.0.1")
+        await self.node.start()
+        loop = asyncio.get_running_loop()
+        self.errors = []
+        loop.set_exception_handler(lambda loop, context: self.errors.append(context))
+        self.transport, self.client = await loop.create_datagram_endpoint(
+            Client, remote_addr=("127.0.0.1", self.node.port))
+
+    async def asyncTearDown(self):
+        self.transport.close()
+        self.node.close()
+        self.directory.cleanup()
+
+    async def query(self, method, args, transaction=b'aa'):
+        self.transport.sendto(bencode.encode({b't': transaction, b'y': b'q', b'q': method,
+                                              b'a': {b'id': b'n' * 20, **args}}))
+        return await asyncio.wait_for(self.client.replies.get(), 2)
+
+    async def test_malformed_datagrams_are_dropped(self):
+        hostile = [bencode.encode({b't': [b'a'], b'y': b'r', b'r': {b'id': b'n' * 20}}),
+                   bencode.encode({b't': {b'a': 1}, b'y': b'r', b'r': {b'id': b'n' * 20}}),
+                   bencode.encode({b't': b'aa', b'y': [b'r']}),
+                   bencode.encode({b't': b'aa', b'y': b'x'}),
+                   b'd1:t' + b'l' * 3000 + b'e' * 3000 + b'1:y1:re',
+                   b'l' * 3000 + b'e' * 3000, b'garbage']
+        for data in hostile:
+            self.transport.sendto(data)
+        # Still answering, and nothing reached the loop's exception handler
+        reply = await self.query(b'ping', {})
+        self.assertEqual(reply[b'y'], b'r')
+        self.assertEqual(self.client.replies.qsize(), 0)
+        self.assertEqual(self.errors, [])
+
+    async def test_ids_must_be_20_bytes(self):
+        for method, key in ((b'get_peers', b'info_hash'), (b'find_node', b'target')):
+            for value in (b'abc', b'x' * 21, 20):
+                with self.subTest(method=method, value=value):
+                    reply = await self.query(method, {key: value})
+                    self.assertEqual(reply[b'y'], b'e')
+                    self.assertEqual(reply[b'e'][0], PROTOCOL_ERROR)
+            reply = await self.query(method, {key: b'x' * 20})
+            self.assertEqual(reply[b'y'], b'r')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import os
+import random
+import socket
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode  # noqa: E402
+from message import Block, Handshake, Interested, MessageReader, Request, Unchoke  # noqa: E402
+from message import Bitfield as BitfieldMessage  # noqa: E402
+from torrent import Torrent  # noqa: E402
+
+PIECE_LENGTH = 2 ** 15
+LENGTH = 5 * PIECE_LENGTH + 1234
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class SeedingTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.data = random.Random(1).randbytes(LENGTH)
+        with open(os.path.join(self.directory.name, "seeded.bin"), "wb") as f:
+            f.write(self.data)
+        pieces = b''.join(hashlib.sha1(self.data[i:i + PIECE_LENGTH]).digest() for i in range(0, LENGTH, PIECE_LENGTH))
+        info = {b'name': b'seeded.bin', b'piece length': PIECE_LENGTH, b'pieces': pieces, b'length': LENGTH}
+        self.info_hash = hashlib.sha1(bencode.encode(info)).digest()
+        self.torrent_path = os.path.join(self.directory.name, "seeded.torrent")
+        # Nothing listens there, so no tracker ever answers
+        with open(self.torrent_path, "wb") as f:
+            f.write(bencode.encode({b'announce': b'http://127.0.0.1:1/announce', b'info': info}))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def read_until(self, messages, kind):
+        while True:
+            message = await messages.read_message(5)
+            if isinstance(message, kind):
+                return message
+
+    @mock.patch("choker.CHOKE_INTERVAL", 0.1)
+    async def test_complete_torrent_serves_peers(self):
+        port = free_port()
+        torrent = Torrent(self.torrent_path, self.directory.name, port=port)
+        task = asyncio.create_task(torrent.torrent_start())
+        try:
+            # Complete from the data already on disk, and listening even though no tracker has answered
+            for _ in range(100):
+                if torrent.block_handler.is_complete() and torrent.seeder.server:
+                    break
+                await asyncio.sleep(0.05)
+            self.assertTrue(torrent.block_handler.is_complete())
+            self.assertFalse(task.done())
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            messages = MessageReader(reader)
+            writer.write(Handshake(self.info_hash, b'-TS0001-' + b'0' * 12).encode())
+            handshake = await messages.read_handshake(5)
+            self.assertEqual(handshake.info_hash, self.info_hash)
+            bitfield = await self.read_until(messages, BitfieldMessage)
+            self.assertEqual(bytes(bitfield.bitfield), bytes(torrent.block_handler.my_bitfield.view()))
+
+            writer.write(Interested().encode())
+            await asyncio.wait_for(self.read_until(messages, Unchoke), 5)
+            last = LENGTH // PIECE_LENGTH
+            for index, begin, length in ((0, 0, 2 ** 14), (last, 0, LENGTH - last * PIECE_LENGTH)):
+                writer.write(Request(index, begin, length).encode())
+                block = await self.read_until(messages, Block)
+                offset = index * PIECE_LENGTH + begin
+                self.assertEqual((block.index, block.begin), (index, begin))
+                self.assertEqual(bytes(block.data), self.data[offset:offset + length])
+
+            peer = next(iter(torrent.connection_manager.peers.values()))
+            self.assertEqual(peer.data_uploaded, 2 ** 14 + LENGTH - last * PIECE_LENGTH)
+            # Seeding, peers are ranked by how fast they take our data
+            self.assertEqual(torrent.choker.rate(peer, True), peer.upload_rate.rate())
+            self.assertGreater(torrent.choker.rate(peer, True), 0)
+            writer.close()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            torrent.close()
+
+    async def test_complete_torrent_without_seeding_returns(self):
+        torrent = Torrent(self.torrent_path, self.directory.name, port=free_port(), seed=False)
+        try:
+            # No tracker ever answers, a torrent complete on disk is done without one
+            await asyncio.wait_for(torrent.torrent_start(), 5)
+            self.assertTrue(torrent.block_handler.is_complete())
+            self.assertFalse(torrent.active)
+        finally:
+            torrent.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import socket
+import struct
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import bencode  # noqa: E402
+from tracker import TrackerClient  # noqa: E402
+
+PEER = ("10.0.0.1", 6881)
+PARAMS = {'info_hash': b'x' * 20, 'peer_id': '-TS0001-000000000000', 'port': 6881, 'left': 0, 'uploaded': 0,
+          'downloaded': 0, 'compact': 1}
+GOOD = bencode.encode({b'interval': 1800, b'peers': socket.inet_aton(PEER[0]) + struct.pack("!H", PEER[1])})
+
+
+class HTTPTracker:
+    # Answers each announce with the next of its bodies, the last one over and over
+    def __init__(self, *bodies):
+        self.bodies = list(bodies)
+        self.announces = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/announce"
+
+    async def handle(self, reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        body = self.bodies[min(self.announces, len(self.bodies) - 1)]
+        self.announces += 1
+        writer.write(b'HTTP/1.0 200 OK\r\n\r\n' + body)
+        await writer.drain()
+        writer.close()
+
+    def close(self):
+        self.server.close()
+
+
+class TrackerClientTest(unittest.IsolatedAsyncioTestCase):
+    async def run_until_peers(self, client):
+        found = asyncio.get_running_loop().create_future()
+
+        def on_response(response):
+            peers = response[b'peers']
+            if not found.done():
+                found.set_result((socket.inet_ntoa(peers[:4]), struct.unpack("!H", peers[4:6])[0]))
+
+        task = asyncio.create_task(client.run(lambda: PARAMS, on_response))
+        try:
+            return await asyncio.wait_for(asyncio.shield(found), 5)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def test_garbage_falls_through_to_the_next_tier(self):
+        garbage = [HTTPTracker(b'l' * 3000 + b'e' * 3000), HTTPTracker(b'\xff\x00 not bencode')]
+        good = HTTPTracker(GOOD)
+        urls = [await tracker.start() for tracker in garbage]
+        client = TrackerClient([urls, [await good.start()]])
+        # Not even an exception a tracker is expected to raise stops the others
+        broken = TrackerClient([[urls[0]]]).tiers[0][0]
+        broken.announce = mock.AsyncMock(side_effect=RuntimeError("boom"))
+        client.tiers[0].append(broken)
+        try:
+            self.assertEqual(await self.run_until_peers(client), PEER)
+            self.assertEqual([tracker.announces for tracker in garbage], [1, 1])
+            self.assertEqual(good.announces, 1)
+            self.assertTrue(all(tracker.failures == 1 and tracker.next_attempt for tracker in client.tiers[0]))
+        finally:
+            for tracker in garbage + [good]:
+                tracker.close()
+
+    @mock.patch("tracker.MIN_BACKOFF", 0.1)
+    async def test_garbage_is_retried_after_backoff(self):
+        tracker = HTTPTracker(b'<html>not a tracker</html>', GOOD)
+        client = TrackerClient([[await tracker.start()]])
+        try:
+            self.assertEqual(await self.run_until_peers(client), PEER)
+            self.assertEqual(tracker.announces, 2)
+            self.assertEqual(client.interval, 1800)
+        finally:
+            tracker.close()
+
+
+if __name__ == "__main__":
+    unittest.main()